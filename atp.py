@@ -1,20 +1,42 @@
 #! .venv/bin/python
 import os
+import sys
+import subprocess
 from pathlib import Path
 import logging
 import subinitial.automation as automation
 from src.test_steps import *
 from src.connections import connection_manager
+from src.publisher import ReportPublisher
+from src.outbox import ReportOutbox, RcloneTarget, SyncWorker
+from src.measurements import MeasurementStore
+from src.profiler import ProfileHistory, format_breakdown, format_percentiles, format_top
 
 
 logger = logging.getLogger(__name__)
 
+REPORT_ROOT = Path("~/ttatp_reports")
+outbox = ReportOutbox(REPORT_ROOT / "outbox.sqlite")  # every report, and whether it reached the cloud and USB drives
+publisher = ReportPublisher(outbox=outbox)  # copies reports to USB drives in the background
+profile_history = ProfileHistory(REPORT_ROOT / "profile_history.jsonl")  # step times of every profiled run
+measurements = MeasurementStore(REPORT_ROOT / "measurements.sqlite")  # every assertion, for SPC queries
+# Simulated and replayed runs are never uploaded
+sync = SyncWorker(outbox, RcloneTarget(config.sync_remote, REPORT_ROOT)) if config.sync_remote and not (sim or replay) else None
+
 
 class Atp(automation.TestDefinition):
     def init(self):
         self.title = "RCTF TRAIL TRACER ATP"
+        if len(slots) > 1:
+            self.title += " SLOT %s" % fixture.slot
         # ATP version/revision, displaying in TestCenter and generated SiSteps docs
         self.version = "v{major}.{minor}.{patch}".format(major=0, minor=1, patch=0)
+        # With several slots, the run_slots() parent process publishes and syncs every slot's reports
+        if len(slots) == 1:
+            publisher.start()
+            publisher.publish_pending()
+            if sync:
+                sync.start()
         
         
 
@@ -41,18 +63,16 @@ class Atp(automation.TestDefinition):
             automation.Field("CpuTemp", default="[AUTOMATIC]", is_static=True)
             # ...
         )
+        if fixture.stats:
+            self.fields.add(automation.Field("CommandStats", default="[AUTOMATIC]", is_static=True))
+        if profiler.enabled:
+            self.fields.add(automation.Field("StepProfile", default="[AUTOMATIC]", is_static=True))
         
         # Define the test tree
         self.steps.add(
             DutDetect(title='DUT Detection', skip=False),
-            PowerUp(title='DUT Power Up Erase', imax=0.05, boot=True, skip=False,)(
-                EraseAll(title='Erase All')
-            ),
-            PowerUp(title='DUT Power Up Flash Main', boot=True, skip=False)(
-                FlashMain(title='Flash Main')
-            ),
-            PowerUp(title='DUT Power Up Flash Boot', boot=True, skip=False)(
-                FlashBootchecker(title='Flash Bootchecker')
+            PowerUp(title='DUT Power Up Flash', imax=0.05, boot=True, skip=False,)(
+                FlashDut(title='Flash DUT')
             ),
             ConnectDutUart(title='Connect to DUT')(
                 PowerUp(title='DUT Power Up Functional Test', imax=0.5, lcd='Functional Test', skip=False)(
@@ -75,10 +95,16 @@ class Atp(automation.TestDefinition):
         return connection_manager.disconnect()
 
     def pre_run(self, data: Data):
+        if fixture.stats:
+            fixture.stats.reset()
+        profiler.begin_run()
+        serials.begin_run()
+        if sim:
+            sim.next_dut()
         # Generate automatic fields
         fixture.stm.set_rgb_str('#FFFF00')
         fixture.stm.set_lcd_text('TESTING...')
-        fixture.stm.set_lcd_text('', 1)
+        fixture.stm.set_lcd_text('SLOT %s' % fixture.slot if len(slots) > 1 else '', 1)
         self.fields.update_entries({
             "DateTime": self.get_datetime(),
             # "PartNumber": 'AutoPartNum',  # TODO read
@@ -91,38 +117,52 @@ class Atp(automation.TestDefinition):
             # ...
         })
         fixture.dut_uid = None
+        captures.begin(slot=fixture.slot, version=self.version)
 
     def post_run(self, data: Data):
         self.fields.update_entries({
             "STM32 UID": fixture.dut_uid
         })
+        if fixture.stats:
+            self.fields.update_entries({"CommandStats": fixture.stats.format_summary()})
+        if profiler.enabled:
+            profile = profiler.end_run()
+            self.fields.update_entries({"StepProfile": format_top(profile)})
         # Write the full test outcome to a .CSV file     
         part_number, serial_number, datetime = self.fields.get_entries("PartNumber", "STM32 UID", "DateTime")
         passfail = 'PASS' if self.result else 'FAIL'
-        filename = f"{part_number}_{passfail}_{datetime}_{serial_number}_Report.csv".replace("/", "-").replace("\\", "-").replace(":", "-").replace(' ', '_')
-        ats_num = self.config[fixture.get_rpi_serial()]
-        automation.CsvPublisher(self, Path("~/ttatp_reports", ats_num, filename)).generate()
+        slot_tag = f"_SLOT{fixture.slot}" if len(slots) > 1 else ""
+        filename = f"{part_number}_{passfail}_{datetime}_{serial_number}{slot_tag}_Report.csv".replace("/", "-").replace("\\", "-").replace(":", "-").replace(' ', '_')
+        rpi_serial = fixture.get_rpi_serial()
+        ats_num = self.config[rpi_serial]
+        report_path = Path(REPORT_ROOT, ats_num, filename)
+        automation.CsvPublisher(self, report_path).generate()
+        if fixture.stats:
+            fixture.stats.dump(report_path.with_suffix('.stats.json'), report=filename, result=passfail)
+        if profiler.enabled:
+            profile_history.append(profile, report=filename, result=passfail, slot=fixture.slot)
+            if profiler.trace:
+                profiler.dump_trace(report_path.with_suffix('.trace.json'))
+            logger.info('Step times (s):\n%s', format_breakdown(profile))
+            logger.info('Station step times, last %d runs (s):\n%s', profile_history.maxlen,
+                        format_percentiles(profile_history.percentiles()))
+        try:
+            measurements.add_report(report_path, ats_num, fixture.slot, result=passfail)
+        except Exception as ex:
+            logger.warning('Measurement store update failed: %s', ex)
         # print(self.result)
         
-        # Look for USB drives and save data there if possible        
-        lsblk = os.popen('lsblk | grep sd | grep part').read().strip()  # find all USB drives
-        lsblk = lsblk.split('\n')
-        for i in lsblk:
-            if '/' in i:  # drive mounted
-                mount_path = re.search(r'.*part (\/.*)', i).group(1)
-                if 'atp_reports' in os.listdir(mount_path):  # find target folder, otherwise ignore                    
-                    automation.CsvPublisher(self, Path(mount_path, 'atp_reports', ats_num, filename)).generate()
-                    
-            elif i != '':  # drive not mounted
-                sd_name = re.search(r'(sd\S{2,5})', i).group(1)            
-                blkid = os.popen('sudo blkid | grep %s' % sd_name).read().strip()
-                uuid = re.search(r'UUID="(\S*)" BLOCK', blkid).group(1)
-                mount_path = os.path.join('../media', uuid)
-                if uuid not in os.listdir('../media'):
-                    os.mkdir(mount_path)
-                os.popen('sudo mount /dev/%s %s' % (sd_name, mount_path)).read()
-                if 'atp_reports' in os.listdir(mount_path): # find target folder, otherwise ignore      
-                    automation.CsvPublisher(self, Path(mount_path, 'atp_reports', ats_num, filename)).generate()   
+        captures.finish(fixture.dut_uid, bool(self.result), ats_num, datetime)
+
+        # Copies to USB drives run on the publisher thread so the result shows right away
+        entry = outbox.add(report_path, Path(ats_num, filename))
+        if len(slots) == 1:
+            publisher.publish(report_path, Path(ats_num, filename), entry)
+            if sync:
+                sync.wake()
+
+        if len(slots) > 1:
+            logger.info('Slot %s: %s', fixture.slot, passfail)
 
         if self.result:
             fixture.stm.set_rgb_str('#00FF00')
@@ -132,14 +172,47 @@ class Atp(automation.TestDefinition):
         else:
             fixture.stm.set_rgb_str("#D30000")
             fixture.stm.set_lcd_text('!! FAIL !!')
+
+        # Last, so the recording holds every command of the run
+        fixture.stm.flush_display()
+        if serials.mode == 'record':
+            serials.end_run(report_path.with_suffix('.serial.rec'), report=filename, result=passfail, slot=fixture.slot,
+                            rpi_serial=rpi_serial, stm_port=fixture.stm.port, dut_port=fixture.dut.port,
+                            stm_framed=fixture.framed, background_display=fixture.stm.background_display)
+        elif serials.mode == 'replay':
+            serials.end_run()
         
 
     def on_exit(self, data: Data):
         # Runs once just before the ATP unloads
-        pass
+        if len(slots) == 1:
+            publisher.flush()
        
 
+def run_slots():
+    """
+    Run one ATP process per station slot so the slots test concurrently.
+
+    The slots only add their reports to the outbox, this process copies them to the USB drives
+    and syncs them, so there is one USB watcher and one uploader per station.
+    """
+    publisher.start()
+    publisher.follow(on_new=sync.wake if sync else None)
+    if sync:
+        sync.start()
+    procs = {}
+    for name in slots:
+        procs[name] = subprocess.Popen([sys.executable, __file__], env=dict(os.environ, **{SLOT_ENV: name}))
+    for name, proc in procs.items():
+        logger.info('Slot %s exited with code %d', name, proc.wait())
+    publisher.publish_pending()
+    publisher.flush()
+
+
 # Entry point
 if __name__ == "__main__":
-    atp = Atp().start(autorun=True)
+    if slot_parent:
+        run_slots()
+    else:
+        atp = Atp().start(autorun=True)
     # print(atp)
@@ -0,0 +1,156 @@
+""" This module provides the raw high speed ADC capture archive, one memory-mappable capture file per DUT run """
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+DTYPE = '<u2'
+
+
+def parse_retention(policy):
+    """
+    Parse a capture_retention config value.
+
+    'off' disables the archive, 'all' keeps every run, 'failures' keeps failed runs and '1/N'
+    keeps failed runs plus every Nth passing run.
+
+    Returns
+    -------
+    tuple
+        (mode, N)
+    """
+    policy = (policy or 'off').strip().lower()
+    if policy in ('off', 'all', 'failures'):
+        return policy, 1
+    if policy.startswith('1/') and policy[2:].isdigit() and int(policy[2:]) > 0:
+        return 'sample', int(policy[2:])
+    raise Exception('Unknown capture_retention "%s", use off, all, failures or 1/N' % policy)
+
+
+class CaptureArchive:
+    """
+    Streams the raw uint16 ADC captures of a run to disk and keeps or drops them once the run result is known.
+
+    A run is stored as <root>/<station>/<UID>/<datetime>.u16, every capture's samples back to back
+    as read from the coprocessor, and a .json index next to it holding each capture's byte offset,
+    shape and metadata (step, tuning cfg, PWM period, ft).  Captures are written as they are
+    taken, so the capture buffer is never held in memory.
+    """
+    def __init__(self, root, retention='off'):
+        self.root = Path(root)
+        self.mode, self.sample_n = parse_retention(retention)
+        self.passed_runs = 0
+        self._file = None
+        self._index = None
+        self._pending = None
+
+    @property
+    def active(self):
+        return self._file is not None
+
+    def begin(self, **meta):
+        """Start a run, meta is stored in the index"""
+        if self.mode == 'off':
+            return
+        self.discard()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._pending = self.root / ('pending_%d' % os.getpid())
+        self._file = open(self._pending.with_suffix('.u16'), 'wb')
+        self._index = {'meta': dict(meta, started=time.time()), 'dtype': DTYPE, 'captures': []}
+
+    def add(self, capture, **meta):
+        """
+        Append a capture.
+
+        Parameters
+        ----------
+        capture : ndarray
+            (ADC_HS_CHANNELS, N) uint16 counts from measure_adc_hs(raw=True)
+        meta
+            JSON-serializable per capture metadata, e.g. cfg, per, ft
+        """
+        if self._file is None:
+            return
+        # The raw capture is a transposed view of the interleaved sample buffer, store the buffer layout
+        samples = np.ascontiguousarray(capture.T, dtype=DTYPE)
+        self._index['captures'].append(dict(meta, offset=self._file.tell(), shape=list(samples.shape)))
+        self._file.write(samples.data)
+
+    def keep(self, passed):
+        if self.mode == 'all' or not passed:
+            return True
+        if self.mode == 'sample':
+            self.passed_runs += 1
+            return self.passed_runs % self.sample_n == 1 % self.sample_n
+        return False
+
+    def finish(self, uid, passed, station='', stamp=None):
+        """
+        End the run, the captures are moved into the archive if the retention policy keeps them.
+
+        Returns
+        -------
+        Path or None
+            Stored .u16 file
+        """
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        if not self._index['captures'] or not self.keep(passed):
+            self.discard()
+            return None
+
+        self._index['meta'].update(uid=uid, passed=passed, station=station)
+        stem = (stamp or time.strftime('%y-%m-%d_%H-%M-%S')).replace(':', '-').replace(' ', '_')
+        dest = self.root / (station or '.') / str(uid) / (stem + '.u16')
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self._pending.with_suffix('.u16'), dest)
+        with open(dest.with_suffix('.json'), 'w') as f:
+            json.dump(self._index, f, indent=1)
+        self._pending = self._index = None
+        return dest
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._pending is not None:
+            self._pending.with_suffix('.u16').unlink(missing_ok=True)
+        self._pending = self._index = None
+
+
+class CaptureFile:
+    """
+    Read side of an archived run, captures are memory-mapped on access so only the pages used are read.
+
+    Examples
+    --------
+    >>> run = CaptureFile('~/ttatp_reports/captures/RCTF_TT_ATS000/0002.../26-01-03_23-42-25.u16')
+    >>> run.find(cfg=7)[0]  # first capture of relay cfg 7
+    >>> adc = run[12]       # (ADC_HS_CHANNELS, N) uint16 memmap view
+    """
+    def __init__(self, path):
+        self.path = Path(path).with_suffix('.u16')
+        with open(self.path.with_suffix('.json')) as f:
+            index = json.load(f)
+        self.meta = index['meta']
+        self.dtype = np.dtype(index['dtype'])
+        self.captures = index['captures']
+
+    def __len__(self):
+        return len(self.captures)
+
+    def __getitem__(self, i):
+        c = self.captures[i]
+        return np.memmap(self.path, self.dtype, 'r', offset=c['offset'], shape=tuple(c['shape'])).T
+
+    def find(self, **meta):
+        """Indexes of the captures whose metadata matches every given key"""
+        return [i for i, c in enumerate(self.captures) if all(c.get(k) == v for k, v in meta.items())]
@@ -0,0 +1,103 @@
+""" This module provides low overhead per-command latency histograms for the serial drivers """
+
+import json
+import math
+import threading
+import time
+
+HIST_MIN = 1e-5  # lower edge (s) of the first latency bin
+HIST_BINS = 24  # power of 2 bins, the last one reaches ~168 s
+
+
+class CommandHistogram:
+    """Latency histogram and counters of one command, bins double in width from HIST_MIN"""
+    __slots__ = ('count', 'total', 'min', 'max', 'bins', 'tx_bytes', 'rx_bytes', 'timeouts', 'retries')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.bins = [0] * HIST_BINS
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.timeouts = 0
+        self.retries = 0
+
+    def add(self, seconds, tx_bytes=0, rx_bytes=0, timeout=False, retries=0):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        i = int(math.log2(seconds / HIST_MIN)) + 1 if seconds >= HIST_MIN else 0
+        self.bins[min(i, HIST_BINS - 1)] += 1
+        self.tx_bytes += tx_bytes
+        self.rx_bytes += rx_bytes
+        self.timeouts += timeout
+        self.retries += retries
+
+    def percentile(self, p):
+        """Upper edge of the bin holding the p-th percentile latency, clipped to the observed max"""
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.bins):
+            seen += n
+            if n and seen >= target:
+                return min(HIST_MIN * 2 ** i, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else None,
+                'min': self.min if self.count else None, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'tx_bytes': self.tx_bytes, 'rx_bytes': self.rx_bytes, 'timeouts': self.timeouts,
+                'retries': self.retries, 'bins': self.bins}
+
+
+class CommandStats:
+    """
+    Per-command histograms shared by the drivers, filled by the command decorator when a driver's
+    stats attribute is set.  Records may come from the driver loop and the DSP pool threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.started = time.perf_counter()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.started = time.perf_counter()
+
+    def record(self, name, seconds, tx_bytes=0, rx_bytes=0, timeout=False, retries=0):
+        with self.lock:
+            hist = self.commands.get(name)
+            if hist is None:
+                hist = self.commands[name] = CommandHistogram()
+            hist.add(seconds, tx_bytes, rx_bytes, timeout, retries)
+
+    def summary(self):
+        """
+        Returns
+        -------
+        list of tuple
+            (name, count, total s, share of elapsed time, p50 s, p99 s, timeouts, retries), by total time
+        """
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            rows = [(name, h.count, h.total, h.total / elapsed, h.percentile(50), h.percentile(99), h.timeouts, h.retries)
+                    for name, h in self.commands.items()]
+        return sorted(rows, key=lambda row: -row[2])
+
+    def format_summary(self, top=6):
+        """One line summary of the commands with the most total time, for the report"""
+        return '; '.join('%s %dx %.3fs %.0f%% p99 %.1fms%s' % (
+            name, n, total, 100 * share, 1e3 * p99, ' %d timeouts %d retries' % (to, rt) if to or rt else '')
+            for name, n, total, share, p50, p99, to, rt in self.summary()[:top])
+
+    def dump(self, path, **meta):
+        with self.lock:
+            commands = {name: h.to_dict() for name, h in self.commands.items()}
+        with open(path, 'w') as f:
+            json.dump(dict(meta, elapsed=time.perf_counter() - self.started, hist_min=HIST_MIN,
+                           commands=commands), f, indent=1)
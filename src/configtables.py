@@ -0,0 +1,32 @@
+""" This module reads the config.csv tables that the test config schema does not cover, without the test framework """
+
+import csv
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent  # repo root, holds config.csv and the firmware images
+
+
+def read_config_table(title, path=ROOT / 'config.csv'):
+    """
+    Read the data rows of a config.csv table that the test config schema does not cover.
+
+    Returns
+    -------
+    list of list of str
+        Stripped cells of each row after the column title row, empty if there is no such table
+    """
+    rows = None
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            cells = [c.strip() for c in row]
+            if not any(cells):  # empty row ends the table
+                if rows is not None:
+                    break
+                continue
+            if cells[0].startswith('#'):
+                continue
+            if cells[:2] == [title, 'VParameterTable']:
+                rows = []
+            elif rows is not None:
+                rows.append(cells)
+    return (rows or [])[1:]  # first row holds the column titles
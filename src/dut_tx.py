@@ -1,104 +1,198 @@
-import serial
+import re
 import struct
-import time
+from array import array
 import numpy as np
-
-class DutTx:
-    def __init__(self, port, baud):
+from src.transport import EchoLink, FramedLink, LineReader, LoopThread, command
+from src.profiler import profiler
+from src.serialrec import serials
+
+class TuneLog:
+    """
+    Incremental parser for the auto tune log records, one 'Relay cfg: <n> ... <I>mA ... <Z>mOhm'
+    line per relay configuration tried.
+
+    Lines are parsed as bytes so corrupt characters only cost the fields they hit, an
+    unreadable current or |Z| is stored as NaN and a line without a readable cfg number is
+    counted in bad_records.
+    """
+    # Numbers must start after a delimiter so a corrupt digit can't leave a plausible tail
+    CFG_PATTERN = re.compile(rb'Relay cfg:\s*(\d+)')
+    MA_PATTERN = re.compile(rb'(?<![^\s,:=(])(\d+)mA')
+    MOHM_PATTERN = re.compile(rb'(?<![^\s,:=(])(\d+)mOhm')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cfgs = array('H')
+        self.currents = array('f')  # A RMS
+        self.ohms = array('f')  # |Z|
+        self.min_z = None
+        self.min_index = None
+        self.bad_records = 0
+
+    def __len__(self):
+        return len(self.cfgs)
+
+    def feed_line(self, raw):
+        if b'Relay' not in raw:
+            return
+        cfg = self.CFG_PATTERN.search(raw)
+        if cfg is None or int(cfg.group(1)) > 0xFFFF:
+            self.bad_records += 1
+            return
+        ma = self.MA_PATTERN.search(raw)
+        mohm = self.MOHM_PATTERN.search(raw)
+        self.cfgs.append(int(cfg.group(1)))
+        self.currents.append(int(ma.group(1)) / 1000 if ma else np.nan)
+        self.ohms.append(int(mohm.group(1)) / 1000 if mohm else np.nan)
+        if mohm and (self.min_z is None or self.ohms[-1] < self.min_z):
+            self.min_z = self.ohms[-1]
+            self.min_index = len(self.ohms) - 1
+
+    def since_min(self):
+        """Records parsed since the lowest |Z| so far, None before the first |Z|"""
+        return None if self.min_index is None else len(self) - 1 - self.min_index
+
+
+class AsyncDutTx:
+    def __init__(self, port, baud, framed=False):
         self.port = port
         self.baud = baud
+        self.framed = framed
         self.ser = None
-
-    def connect(self):
-        self.ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=1)
-        self.ser.read_all()
-
-    def disconnect(self):
+        self.link = None
+        self.stats = None  # CommandStats, set to record per-command latency
+        self.lines = None
+        self.tune = TuneLog()
+
+    async def connect(self):
+        self.ser = serials.open(port=self.port, baudrate=self.baud, timeout=0)
+        self.ser.reset_input_buffer()
+        self.link = FramedLink(self.ser) if self.framed else EchoLink(self.ser)
+        self.lines = self.link.lines = LineReader()
+        self.lines.listeners.append(self.tune.feed_line)
+
+    async def disconnect(self):
+        self.link.close()
         self.ser.flush()
         self.ser.close()
 
-    def flush_rx(self):
-        self.ser.read_all()
-
-    def _read_n_bytes(self, n, timeout=1):
-        data = bytearray()
-        start = time.monotonic()
-
-        while len(data) < n:
-            chunk = self.ser.read(n - len(data))
-            if chunk:
-                data.extend(chunk)
-            else:
-                # read() timed out
-                break
-
-            if time.monotonic() - start >= timeout:
-                break
-
-        if len(data) != n:
-            raise TimeoutError(f"Expected {n} bytes, received {len(data)}")
-        return bytes(data)
-    
-
-    def _write_u32(self, cmd:int, val:int):
-        tx_bytes = struct.pack('<II', cmd, val)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
+    async def flush_rx(self):
+        # On the loop, so the auto tune log is not reset under a line being parsed
+        self.link.flush_rx()
+        self.lines.partial.clear()
+        self.tune.reset()
 
-        rx = self._read_n_bytes(len(tx_bytes))
-        return struct.unpack('<II', rx)[1]
-    
+    async def wait_for_line(self, match, timeout=3, since=None):
+        """Wait for a DUT log line matching a regex or predicate, see LineReader.find()"""
+        return await self.lines.wait_for(match, timeout, since)
 
-    def _write_u16_list(self, cmd:int, vals:list[int]):
-        tx_bytes = struct.pack('<I2H', cmd, *vals)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
+    async def _read_n_bytes(self, n, timeout=1):
+        return await self.link.read_n_bytes(n, timeout)
 
-        rx = self._read_n_bytes(len(tx_bytes))
+    async def _write_u32(self, cmd:int, val:int):
+        rx = await self.link.transact(struct.pack('<II', cmd, val))
+        return struct.unpack('<II', rx)[1]
+
+    async def _write_u16_list(self, cmd:int, vals:list[int]):
+        rx = await self.link.transact(struct.pack('<I2H', cmd, *vals))
         return struct.unpack('<I2H', rx)[-2:]
-    
-    def _write_u8_list(self, cmd:int, vals:list[int]):
-        tx_bytes = struct.pack('<I4B', cmd, *vals)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
 
-        rx = self._read_n_bytes(len(tx_bytes))
+    async def _write_u8_list(self, cmd:int, vals:list[int]):
+        rx = await self.link.transact(struct.pack('<I4B', cmd, *vals))
         return struct.unpack('<I4B', rx)[-4:]
-    
-    def _write_f32(self, cmd:int, val:float):
-        tx_bytes = struct.pack('<If', cmd, val)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
 
-        rx = self._read_n_bytes(len(tx_bytes))
+    async def _write_f32(self, cmd:int, val:float):
+        rx = await self.link.transact(struct.pack('<If', cmd, val))
         return struct.unpack('<If', rx)[1]
-    
-    def set_pwm_state(self, state):
+
+    @command
+    async def set_pwm_state(self, state):
+        if state:
+            return await self._write_u32(2, 1)
+        else:
+            return await self._write_u32(2, 0)
+
+    @command
+    async def set_pwm_per_ccr(self, per, ccr):
+        return await self._write_u16_list(1, [per, ccr])
+
+    @command
+    async def set_tuning(self, tuning):
+        return await self._write_u32(3, tuning)
+
+    @command
+    async def get_isense(self):
+        return await self._write_f32(4, 0)
+
+    @command
+    async def set_auto_state(self, state):
+        return await self._write_u32(5, state)
+
+    @command
+    async def set_factory_test_state(self, state):
         if state:
-            return self._write_u32(2, 1)
+            return await self._write_u32(0x54455354, 0x50415353)
         else:
-            return self._write_u32(2, 0)
-        
+            return await self._write_u32(0x54455354, 0x4641494C)
+
+
+class DutTx:
+    """Blocking wrapper around AsyncDutTx, commands run on the shared driver event loop"""
+    def __init__(self, port, baud, framed=False):
+        self.aio = AsyncDutTx(port, baud, framed)
+        self.loop = LoopThread.shared()
+
+    @property
+    def port(self):
+        return self.aio.port
+
+    @property
+    def ser(self):
+        return self.aio.ser
+
+    @property
+    def link(self):
+        return self.aio.link
+
+    @property
+    def tune(self):
+        """TuneLog of the auto tune records, filled on the driver loop as lines arrive"""
+        return self.aio.tune
+
+    @property
+    def line_count(self):
+        """Number of the next DUT log line, pass as since to only wait on newer lines"""
+        return self.aio.lines.count
+
+    def connect(self):
+        self.loop.run(self.aio.connect())
+
+    def disconnect(self):
+        self.loop.run(self.aio.disconnect())
+
+    def flush_rx(self):
+        self.loop.run(self.aio.flush_rx())
+
+    def wait_for_line(self, match, timeout=3, since=None):
+        with profiler.timed('wait', 'wait_for_line'):
+            return self.loop.run(self.aio.wait_for_line(match, timeout, since))
+
+    def set_pwm_state(self, state):
+        return self.loop.run(self.aio.set_pwm_state(state))
+
     def set_pwm_per_ccr(self, per, ccr):
-        return self._write_u16_list(1, [per, ccr])
-    
+        return self.loop.run(self.aio.set_pwm_per_ccr(per, ccr))
+
     def set_tuning(self, tuning):
-        return self._write_u32(3, tuning)
-    
+        return self.loop.run(self.aio.set_tuning(tuning))
+
     def get_isense(self):
-        return self._write_f32(4, 0)
-    
-    def set_auto_state(self, state):
-        return self._write_u32(5, state)
-    
-    def set_factory_test_state(self, state):
-        if state:
-            return self._write_u32(0x54455354, 0x50415353)
-        else:
-            return self._write_u32(0x54455354, 0x4641494C)
+        return self.loop.run(self.aio.get_isense())
 
-    
+    def set_auto_state(self, state):
+        return self.loop.run(self.aio.set_auto_state(state))
 
-    
-    
-        
+    def set_factory_test_state(self, state):
+        return self.loop.run(self.aio.set_factory_test_state(state))
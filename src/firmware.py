@@ -0,0 +1,55 @@
+""" This module provides the firmware image registry used by the DUT flash steps """
+
+import hashlib
+import logging
+from pathlib import Path
+
+from src.stm32bootloader import FLASH_BASE, split_blocks, split_vector, page_manifest
+
+logger = logging.getLogger(__name__)
+
+
+class FirmwareImage:
+    """Flash image loaded once, with its vector split, hashes and write blocks precomputed"""
+    def __init__(self, name, path, address=FLASH_BASE, sha256=None, page_size=2048, write_align=8):
+        self.name = name
+        self.path = Path(path)
+        self.address = address
+        self.data = self.path.read_bytes()
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        if sha256 and sha256.lower() != self.sha256:
+            raise Exception('Firmware image %s (%s) has SHA-256 %s, expected %s' % (name, self.path, self.sha256, sha256))
+
+        (self.body,), self.vector = split_vector([(address, self.data)], write_align)
+        self.blocks = split_blocks(*self.body, write_align)
+        self.vector_blocks = split_blocks(FLASH_BASE, self.vector, write_align) if self.vector else []
+        self.pages = page_manifest([(address, self.data)], page_size)
+
+    def __repr__(self):
+        return 'FirmwareImage(%s, 0x%08X, %d bytes, sha256=%s)' % (self.name, self.address, len(self.data), self.sha256[:12])
+
+
+class FirmwareRegistry:
+    """Firmware images by name"""
+    def __init__(self):
+        self.images = {}
+
+    def load(self, name, path, address=FLASH_BASE, sha256=None):
+        self.images[name] = FirmwareImage(name, path, address, sha256)
+        logger.info('Loaded %s', self.images[name])
+        return self.images[name]
+
+    def load_table(self, rows, root):
+        """Load every (name, path, address, sha256) row of the config.csv Firmware table, paths relative to root"""
+        for cells in rows:
+            name, path, address, sha256 = cells[:4]
+            self.load(name, Path(root) / path, int(address, 0), sha256)
+        return self
+
+    def __getitem__(self, name):
+        if name not in self.images:
+            raise Exception('Unknown firmware image %s, expected one of: %s' % (name, ', '.join(self.images)))
+        return self.images[name]
+
+    def __contains__(self, name):
+        return name in self.images
@@ -6,6 +6,8 @@ import serial
 import time
 import sys
 import subprocess
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy import signal
 from scipy.fft import fft
@@ -14,8 +16,17 @@ from scipy.optimize import curve_fit
 from pathlib import Path
 import subinitial.automation as automation
 from subinitial.automation import Parameter
-from src.stm32coprocessor import Stm32CoProcessor
+from src.stm32coprocessor import Stm32CoProcessor, ADC_HS_SCALE
 from src.dut_tx import DutTx
+from src.stm32bootloader import Stm32Bootloader
+from src.firmware import FirmwareRegistry
+from src.configtables import ROOT, read_config_table
+from src.transport import LoopThread
+from src.captures import CaptureArchive
+from src.cmdstats import CommandStats
+from src.profiler import profiler
+from src.simulation import Simulation, SIM_ENV, SIM_SERIAL
+from src.serialrec import serials, REPLAY_ENV
 
 
 # Setup logging
@@ -26,6 +37,20 @@ logger = logging.getLogger(__name__)
 class Config(automation.ConfigStruct):
     dmm_ipv4 = Parameter.String("192.168.1.30")
     """DMM Hostname or ipv4"""
+    sync_remote = Parameter.String("")
+    """rclone remote that reports are synced to, empty to only queue them"""
+    capture_retention = Parameter.String("off")
+    """Raw ADC capture archive: off, all, failures or 1/N (failures and every Nth pass)"""
+    command_stats = Parameter.String("off")
+    """on to record per-command serial latency histograms, summarized in each report"""
+    step_profile = Parameter.String("off")
+    """on to profile step cycle time, trace to also write a Chrome trace per run"""
+    serial_record = Parameter.String("off")
+    """on to record every run's serial traffic next to its report, for replay with TTATP_REPLAY"""
+    stm_framed = Parameter.String("off")
+    """on for coprocessor firmware speaking the framed protocol, CRC checked frames with retransmit"""
+    background_display = Parameter.String("off")
+    """on to send LCD and RGB LED updates in the background while the coprocessor link is idle"""
 
 config = automation.get_testconfig(schema=Config)  # read config.csv
 args = automation.get_testargs()
@@ -34,63 +59,312 @@ state = automation.get_teststate()    # read state.json
 
 
 
+# DSP caches, capture lengths and sweep frequencies repeat every run so windows and
+# reference tones are computed once and reused
+@functools.lru_cache(maxsize=16)
+def flattop_window(length):
+    """Read-only flattop window and its sum for a capture length"""
+    window = signal.windows.flattop(length)
+    window.flags.writeable = False
+    return window, float(np.sum(window))
+
+
+@functools.lru_cache(maxsize=64)
+def reference_tones(length, samplerate, f_bins):
+    """Read-only (len(f_bins), length) windowed and scaled complex exponentials"""
+    window, window_sum = flattop_window(length)
+    phase = np.outer(f_bins, np.arange(length) * (-2j * np.pi / samplerate))
+    tones = np.exp(phase) * window * (np.sqrt(2) / window_sum)
+    tones.flags.writeable = False
+    return tones
+
+
+
+
 # Global equipment objects
 # dmm = MockVisaDMM()
 
 
 
 
+# Settle detection on (Vdut, Idut, DUT 3V3, DUT 5V), see Fixture.settle()
+RAIL_SETTLE_TOL = (0.05, 0.005, 0.05, 0.05)
+DUT_RESET_3V3 = 0.5  # DUT 3V3 below this holds the DUT MCU in reset
+
+
+# Station slots, each slot is one coprocessor and DUT UART pair running its own test tree
+SLOT_ENV = 'TTATP_SLOT'  # set by atp.py on each slot's ATP process
+
+
+def read_slot_table(path=ROOT / 'config.csv'):
+    """{slot name: (coprocessor port, DUT port)} from the Slots table, in table order"""
+    return {cells[0]: (cells[1], cells[2]) for cells in read_config_table('Slots', path)}
+
+
+def load_firmware_table(path=ROOT / 'config.csv'):
+    """Load and check every image in the Firmware table once, paths are relative to the repo root"""
+    return FirmwareRegistry().load_table(read_config_table('Firmware', path), ROOT)
+
+
+
+
 class Fixture:
     """Generic fixture object to wrap fixture function helpers into"""
-    def __init__(self):
-        self.stm = Stm32CoProcessor('/dev/ttyAMA2', 2000000)
-        self.dut = DutTx('/dev/ttyAMA3', 115200)
+    def __init__(self, stm_port='/dev/ttyAMA2', dut_port='/dev/ttyAMA3', slot=None, framed=False, background_display=False):
+        self.slot = slot
+        self.framed = framed  # coprocessor link, see src.transport.FramedLink
+        self.stm = Stm32CoProcessor(stm_port, 2000000, framed, background_display)
+        self.dut = DutTx(dut_port, 115200)
+        self.boot = Stm32Bootloader(dut_port, 1000000)  # DUT factory bootloader, shares the DUT UART
         self.dut_uid = None
         self.l_passes = None
-        pass
+        self.snapshot_max_age = 0.05  # reuse window (s) for snapshot(), 0 always reads
+        self.stats = None  # CommandStats shared by the drivers, see enable_stats()
+
+        # Capture analysis runs here so it overlaps with the next serial transaction
+        self.dsp_pool = ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1))
     
+    def enable_stats(self):
+        """Record per-command latency, bytes, timeouts and retries of both drivers, and DSP time, in self.stats"""
+        self.stats = self.stm.aio.stats = self.dut.aio.stats = CommandStats()
+        return self.stats
+
+    def gather(self, *coros):
+        """Run async driver commands (e.g. fixture.stm.aio.measure_vdut()) concurrently and return their results"""
+        return LoopThread.shared().gather(*coros)
+
+    @profiler.timed_fn('subprocess')
     def get_rpi_serial(self):
         output = os.popen('cat /proc/cpuinfo | grep Serial').read()
         return re.search(r':\s(.{16})', output).group(1)
     
+    @profiler.timed_fn('subprocess')
     def get_rpi_cpu_temp(self):
         output = os.popen('vcgencmd measure_temp').read()
         temp = re.search(r"temp=(\S*)'C", output).group(1)
         return float(temp)
     
+    def snapshot(self, max_age=None):
+        """
+        Vdut, Idut and the low speed ADC channels as an AdcSnapshot, from one coprocessor exchange.
+
+        A snapshot up to max_age (s) old is reused, snapshot_max_age by default.  Any coprocessor
+        write (e.g. set_vdut) forces a new one.
+        """
+        return self.stm.measure_snapshot(self.snapshot_max_age if max_age is None else max_age)
+
     def measure_tx_5v(self):
-        return self.stm.measure_adc_ls()[3] * 1.5
+        return self.snapshot().dut_5v
     
     def measure_tx_3v3(self):
-        return self.stm.measure_adc_ls()[2] * 1.5
+        return self.snapshot().dut_3v3
     
     def measure_tx_5v_3v3(self):
-        vals = self.stm.measure_adc_ls()
-        return vals[3] * 1.5, vals[2] * 1.5        
+        snap = self.snapshot()
+        return snap.dut_5v, snap.dut_3v3
     
+    def read_rails(self):
+        """(Vdut, Idut, DUT 3V3, DUT 5V) from a fresh snapshot"""
+        snap = self.snapshot(max_age=0)
+        return snap.vdut, snap.idut, snap.dut_3v3, snap.dut_5v
+
+    @profiler.timed_fn('wait')
+    def settle(self, read=None, tol=RAIL_SETTLE_TOL, dwell=0.05, timeout=1.0, until=None):
+        """
+        Poll readings until every channel stays within its tolerance band for the dwell time.
+
+        Parameters
+        ----------
+        read : callable or None
+            Returns a tuple of readings, read_rails() by default
+        tol : float or sequence of float
+            Allowed peak to peak change of each reading over the dwell time
+        dwell : float
+            Time (s) the readings must stay in band
+        timeout : float
+            Give up after this long (s) and return the last readings
+        until : callable or None
+            Extra condition on the readings, e.g. a rail below a threshold
+
+        Returns
+        -------
+        tuple
+            (last readings, settle time (s), settled), the settle time is when the readings
+            entered their final band, or the timeout if they never settled
+        """
+        read = read or self.read_rails
+        t_start = time.time()
+        stable_since = t_start
+        lo = hi = None
+        while True:
+            values = np.array(read(), dtype=float)
+            t = time.time()
+            if lo is None or np.any(np.maximum(hi, values) - np.minimum(lo, values) > tol) or (until and not until(values)):
+                stable_since, lo, hi = t, values, values
+            else:
+                lo, hi = np.minimum(lo, values), np.maximum(hi, values)
+
+            if t - stable_since >= dwell:
+                return tuple(values.tolist()), stable_since - t_start, True
+            if t - t_start >= timeout:
+                return tuple(values.tolist()), t - t_start, False
+
+    def power_down(self, timeout=1.0):
+        """Turn off Vdut and wait for the DUT 3V3 rail to discharge below its reset threshold"""
+        self.stm.set_vdut(0)
+        return self.settle(until=lambda rails: rails[2] < DUT_RESET_3V3, timeout=timeout)
+
+    @profiler.timed_fn('subprocess')
     def run_rpi(self, cmd):
         print(" ".join(cmd))
         res = subprocess.run(cmd)
         return res
     
-    def compute_adc_fft(self, ch_data, samplerate=625e3, f_target=100):
+    def _trim_to_cycles(self, ch_data, samplerate, f_target):
         samples_per_cycle = samplerate / f_target
         num_cycles = len(ch_data) / samples_per_cycle
 
         trimmed_length = int(np.floor(num_cycles) * samples_per_cycle)
-        trimmed_signal = ch_data[:int(trimmed_length)]
+        return ch_data[:trimmed_length], trimmed_length
+
+    def compute_adc_fft(self, ch_data, samplerate=625e3, f_target=100):
+        trimmed_signal, trimmed_length = self._trim_to_cycles(ch_data, samplerate, f_target)
     
         # Apply the flattop window
-        window  = signal.windows.flattop(trimmed_length)
+        window, window_sum = flattop_window(trimmed_length)
         windowed_signal = trimmed_signal * window
         
         # Calculate the DFT of the windowed signal
-        dft_result = fft(windowed_signal) / np.sum(window) * np.sqrt(2)
+        dft_result = fft(windowed_signal) / window_sum * np.sqrt(2)
         freqs = np.fft.fftfreq(trimmed_length, 1/samplerate)
 
         return freqs, dft_result
     
+    def compute_adc_tone(self, ch_data, samplerate=625e3, f_target=100, f_bins=None):
+        """
+        Flattop windowed DFT evaluated only at the requested frequencies.
+
+        Uses the same trimming, window and scaling as compute_adc_fft, but correlates the
+        signal against a complex exponential at exactly f_target instead of running a full
+        FFT and looking up the nearest bin.
+
+        Parameters
+        ----------
+        ch_data : ndarray
+            ADC channel data
+        samplerate : float
+            ADC sample rate (Hz)
+        f_target : float
+            Fundamental frequency (Hz), the signal is trimmed to a whole number of its cycles
+        f_bins : array_like or None
+            Frequencies (Hz) to evaluate, defaults to f_target only
+
+        Returns
+        -------
+        complex or ndarray
+            DFT value at f_target, or an array of values matching f_bins
+        """
+        trimmed_signal, trimmed_length = self._trim_to_cycles(ch_data, samplerate, f_target)
+
+        freqs = (float(f_target),) if f_bins is None else tuple(float(f) for f in f_bins)
+        tones = reference_tones(trimmed_length, float(samplerate), freqs)
+
+        dft_result = tones @ trimmed_signal
+        return dft_result[0] if f_bins is None else dft_result
+
+    def analyze_capture(self, adc_counts, f_target, samplerate=625e3):
+        """Iout tone amplitude and RMS, and Isense RMS, from raw (Iout, Isense) ADC counts"""
+        t0 = time.perf_counter()
+        iout = adc_counts[0] * ADC_HS_SCALE
+        dft = float(np.abs(self.compute_adc_tone(iout, samplerate, f_target)))
+        rms = float(np.std(iout))
+        isense = float(np.std(adc_counts[1]) * ADC_HS_SCALE)
+        if self.stats is not None:
+            self.stats.record('dsp analyze_capture', time.perf_counter() - t0)
+        return dft, rms, isense
+
+    def dsp_cache_info(self):
+        """Hit/miss counters of the window and reference tone caches"""
+        return {'window': flattop_window.cache_info(), 'tones': reference_tones.cache_info()}
+    
     
+    def search_peak(self, measure, f_center, f_span, f_step, f_min_step, f_tol, max_points, snap=None):
+        """
+        Adaptive peak search, a 3-point grid walked until it brackets the maximum, then refined
+        around the maximum by halving the spacing.
+
+        A 3-point parabolic fit is least biased when its vertex falls on the middle point, where the
+        peak's asymmetric skirts are sampled evenly, so the refinement stops once the vertex is within
+        f_tol of the measured maximum.
+
+        Parameters
+        ----------
+        measure : callable
+            Takes a list of frequencies (Hz) and returns their linear magnitudes, called
+            once per batch so the points of a batch can be pipelined
+        f_center : float
+            Center frequency (Hz), always part of the coarse grid
+        f_span : float
+            Search range is f_center +/- f_span (Hz)
+        f_step : float
+            Coarse grid spacing (Hz)
+        f_min_step : float
+            Smallest refined spacing (Hz), closer points resolve measurement noise rather than the peak
+        f_tol : float
+            Allowed distance (Hz) between the parabolic vertex and the measured maximum
+        max_points : int
+            Maximum number of measured points
+        snap : callable or None
+            Maps a frequency (Hz) to the nearest one the source can produce
+
+        Returns
+        -------
+        freq : ndarray
+            Measured frequencies (Hz), sorted
+        amp : ndarray
+            Linear magnitudes matching freq
+        """
+        snap = snap or (lambda f: f)
+        freq = [snap(f_center + d) for d in (-f_step, 0, f_step)]
+        amp = list(measure(freq))
+        step = f_step
+
+        # Walk the grid towards the maximum until it is bracketed, two points per batch so their
+        # analysis overlaps the next capture
+        while len(freq) < max_points:
+            order = np.argsort(freq)
+            k = int(np.nonzero(order == np.argmax(amp))[0][0])
+            if 0 < k < len(freq) - 1:
+                break
+            # Grid steps from the unsnapped center, snapping must not push the last one out of the span
+            edge, sign = (freq[order[0]], -1) if k == 0 else (freq[order[-1]], 1)
+            n_edge = round((edge - f_center) / step)
+            new_freq = [snap(f_center + (n_edge + sign * n) * step) for n in (1, 2) if abs(n_edge + sign * n) * step <= f_span]
+            new_freq = new_freq[:max_points - len(freq)]
+            if not new_freq:
+                break
+            amp.extend(measure(new_freq))
+            freq.extend(new_freq)
+
+        while step / 2 >= f_min_step:
+            order = np.argsort(freq)
+            f0, K, peak_idx = self.estimate_peak(np.take(freq, order), np.take(amp, order))
+            f_peak = freq[order[peak_idx]]
+            if abs(f0 - f_peak) <= f_tol:
+                break
+
+            # Halve the spacing and bracket the current maximum
+            step /= 2
+            new_freq = [snap(f) for f in (f_peak - step, f_peak + step) if abs(f - f_center) <= f_span]
+            new_freq = [f for f in new_freq if not np.any(np.isclose(freq, f, rtol=0, atol=step / 4))]
+            if not new_freq or len(freq) + len(new_freq) > max_points:
+                break
+            amp.extend(measure(new_freq))
+            freq.extend(new_freq)
+
+        order = np.argsort(freq)
+        return np.take(freq, order), np.take(amp, order)
+
     def estimate_peak(self, freq, amp):
         """
         Model-free estimation of resonance metrics from magnitude-only data.
@@ -151,4 +425,52 @@ class Fixture:
         
         
 
-fixture = Fixture()
\ No newline at end of file
+class SimFixture(Fixture):
+    """Fixture off the RPi, on a Simulation (TTATP_SIM) or a replayed serial session (TTATP_REPLAY)"""
+    def __init__(self, stm_port, dut_port, slot=None, rpi_serial=SIM_SERIAL, framed=False, background_display=False):
+        super().__init__(stm_port, dut_port, slot, framed, background_display)
+        self.rpi_serial = rpi_serial
+
+    def get_rpi_serial(self):
+        return self.rpi_serial
+
+    def get_rpi_cpu_temp(self):
+        try:
+            with open('/sys/class/thermal/thermal_zone0/temp') as f:
+                return int(f.read()) / 1000
+        except (OSError, ValueError):
+            return None
+
+
+firmware = load_firmware_table()
+slots = read_slot_table()
+slot = os.environ.get(SLOT_ENV) or next(iter(slots), None)
+if os.environ.get(SLOT_ENV) and slot not in slots:
+    raise Exception('%s=%s is not a slot, the config.csv Slots table has: %s' % (SLOT_ENV, slot, ', '.join(slots) or 'none'))
+# atp.py's run_slots() parent process only starts the slot processes, it drives no fixture
+slot_parent = len(slots) > 1 and not os.environ.get(SLOT_ENV)
+framed = config.stm_framed == 'on'
+background_display = config.background_display == 'on'
+sim = Simulation.from_env(framed=framed)
+replay = serials.replay_from_env()
+if sim and replay:
+    raise Exception('Set one of %s and %s' % (SIM_ENV, REPLAY_ENV))
+if slot_parent:
+    fixture = None
+elif sim:
+    sim.start()
+    fixture = SimFixture(sim.stm_port, sim.dut_port, slot=slot, framed=framed, background_display=background_display)
+elif replay:
+    # Same ports and station as the recorded run, so the drivers and report land where they did
+    fixture = SimFixture(replay.meta['stm_port'], replay.meta['dut_port'], replay.meta.get('slot'), replay.meta['rpi_serial'],
+                         replay.meta.get('stm_framed', False), replay.meta.get('background_display', False))
+else:
+    kw = dict(framed=framed, background_display=background_display)
+    fixture = Fixture(*slots[slot], slot=slot, **kw) if slot else Fixture(**kw)
+if config.step_profile in ('on', 'trace'):
+    profiler.enable(trace=config.step_profile == 'trace')
+if config.command_stats == 'on' and fixture:
+    fixture.enable_stats()
+if config.serial_record == 'on' and not replay:
+    serials.record()
+captures = CaptureArchive(Path("~/ttatp_reports", "captures"), config.capture_retention)
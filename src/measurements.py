@@ -0,0 +1,324 @@
+""" This module provides the SQLite measurement store fed from the CSV test reports, and a CLI for yield and SPC queries
+
+Usage:
+    python -m src.measurements import ~/ttatp_reports/RCTF_TT_ATS000
+    python -m src.measurements yield --by station
+    python -m src.measurements cpk "Measured Vdut" --step "DUT Power Up"
+    python -m src.measurements dist "CFG 3" --bins 20
+    python -m src.measurements export "Min |Z|" -o min_z.csv
+"""
+
+import argparse
+import csv
+import logging
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_DB = Path("~/ttatp_reports", "measurements.sqlite")  # next to the reports, same as atp.py
+REPORT_HEADER = 'TID:A#'
+NULL_UIDS = ('', 'None', '[AUTOMATIC]')
+
+
+def to_float(s):
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_report(path):
+    """
+    Read a CsvPublisher test report.
+
+    Returns
+    -------
+    tuple
+        (header dict of field name to value, list of (tid, step, name, criteria, min, measurement, max, units, result))
+    """
+    header = {}
+    rows = []
+    step = None
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        for cells in reader:
+            if cells and cells[0] == REPORT_HEADER:
+                break
+            if len(cells) >= 2 and cells[0]:
+                # Counts are written value first, e.g. '0,TESTS FAILED'
+                key, value = (cells[1], cells[0]) if cells[1].isupper() and cells[0].isdigit() else (cells[0], cells[1])
+                header[key] = value
+        for cells in reader:
+            cells += [''] * (8 - len(cells))
+            tid = cells[0]
+            if '::' not in tid:
+                step = cells[1]
+                continue
+            rows.append((tid, step, cells[1], cells[2], cells[3], cells[4], cells[5], cells[6], cells[7]))
+    return header, rows
+
+
+def report_verdict(path, header):
+    """ATP verdict of a report, from its <part>_<PASS|FAIL>_..._Report.csv filename or else its failure counts"""
+    for verdict in ('PASS', 'FAIL'):
+        if f'_{verdict}_' in Path(path).name:
+            return verdict
+    failed = int(header.get('TESTS FAILED', 0)) + int(header.get('ASSERTIONS FAILED', 0))
+    return 'FAIL' if failed else 'PASS'
+
+
+class MeasurementStore:
+    """
+    Indexed SQLite copy of every assertion in every test report.
+
+    One runs row per report keyed by UID, station and timestamp, and one measurements row per
+    assertion keyed by run, step and assertion name.
+    """
+    def __init__(self, db_path=DEFAULT_DB):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                report TEXT UNIQUE NOT NULL,
+                uid TEXT,
+                station TEXT,
+                slot TEXT,
+                timestamp TEXT,
+                part_number TEXT,
+                version TEXT,
+                result TEXT,
+                duration REAL);
+            CREATE TABLE IF NOT EXISTS measurements (
+                run_id INTEGER NOT NULL REFERENCES runs (id),
+                tid TEXT,
+                step TEXT,
+                name TEXT,
+                criteria TEXT,
+                min REAL,
+                value REAL,
+                max REAL,
+                text TEXT,
+                units TEXT,
+                result TEXT);
+            CREATE INDEX IF NOT EXISTS runs_uid ON runs (uid, timestamp);
+            CREATE INDEX IF NOT EXISTS runs_station ON runs (station, timestamp);
+            CREATE INDEX IF NOT EXISTS measurements_name ON measurements (name, step);
+            CREATE INDEX IF NOT EXISTS measurements_run ON measurements (run_id);
+        ''')
+
+    def add_report(self, path, station=None, slot=None, result=None):
+        """
+        Store a report, reports already in the store are skipped.
+
+        Parameters
+        ----------
+        path : str or Path
+            CSV report written by automation.CsvPublisher
+        station : str
+            ATS name, defaults to the report's parent folder
+        slot : str
+            Station slot for multi-DUT stations
+        result : str
+            'PASS' or 'FAIL' verdict of the run.  Defaults to the verdict in the report filename, else
+            to the report's failure counts, which miss failures outside assertions
+
+        Returns
+        -------
+        int or None
+            runs row id, None if the report was already stored
+        """
+        path = Path(path)
+        header, rows = parse_report(path)
+        uid = header.get('STM32 UID')
+        stamp = header.get('DateTime')
+        try:
+            stamp = datetime.strptime(stamp, '%y-%m-%d_%H-%M-%S').isoformat(' ')
+        except (TypeError, ValueError):
+            pass
+        if result is None:
+            result = report_verdict(path, header)
+        run = (str(path), None if uid in NULL_UIDS else uid, station or path.parent.name, slot, stamp,
+               header.get('PartNumber'), header.get('TestVersion'), result, to_float(header.get('Duration')))
+        with self.lock, self.db:
+            cur = self.db.execute('INSERT OR IGNORE INTO runs (report, uid, station, slot, timestamp, part_number, '
+                                  'version, result, duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', run)
+            if not cur.rowcount:
+                return None
+            run_id = cur.lastrowid
+            self.db.executemany('INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(run_id, tid, step, name, criteria, to_float(lo), to_float(value), to_float(hi),
+                                  value, units, result or None)
+                                 for tid, step, name, criteria, lo, value, hi, units, result in rows])
+        return run_id
+
+    def import_reports(self, paths):
+        """Store every *_Report.csv under the given files or folders, returns the number of new reports"""
+        added = 0
+        for path in map(Path, paths):
+            files = sorted(path.rglob('*_Report.csv')) if path.is_dir() else [path]
+            for f in files:
+                try:
+                    added += self.add_report(f) is not None
+                except Exception as ex:
+                    logger.warning('Skipped %s: %s', f, ex)
+        return added
+
+    def _filter(self, station=None, since=None, until=None, step=None):
+        where, args = [], []
+        for clause, arg in (('r.station = ?', station), ('r.timestamp >= ?', since),
+                            ('r.timestamp < ?', until), ('m.step LIKE ?', step and '%' + step + '%')):
+            if arg is not None:
+                where.append(clause)
+                args.append(arg)
+        return ''.join(' AND ' + w for w in where), args
+
+    def yield_summary(self, by=None, station=None, since=None, until=None):
+        """
+        Run yield and final yield, a UID counts towards final yield when its last run passed.
+
+        Returns
+        -------
+        list of tuple
+            (group, runs, passed, yield %, UIDs, UIDs passing on their last run, final yield %)
+        """
+        group = {'station': 'r.station', 'day': 'substr(r.timestamp, 1, 10)', 'slot': 'r.slot',
+                 'version': 'r.version', None: "'all'"}[by]
+        where, args = self._filter(station, since, until)
+        with self.lock:
+            rows = self.db.execute(f'''
+                WITH t AS (
+                    SELECT {group} AS grp, r.uid, r.result, ROW_NUMBER() OVER (
+                        PARTITION BY {group}, r.uid ORDER BY r.timestamp DESC, r.id DESC) AS age
+                    FROM runs r WHERE 1 {where})
+                SELECT grp, COUNT(*), SUM(result = 'PASS'), COUNT(DISTINCT uid),
+                    SUM(uid IS NOT NULL AND age = 1 AND result = 'PASS')
+                FROM t GROUP BY grp ORDER BY grp''', args).fetchall()
+        return [(g, n, p, 100.0 * p / n, u, up, 100.0 * up / u if u else None) for g, n, p, u, up in rows]
+
+    def values(self, name, step=None, station=None, since=None, until=None):
+        """
+        Numeric results of an assertion, oldest first.
+
+        Returns
+        -------
+        list of tuple
+            (uid, station, timestamp, step, min, value, max, units, result)
+        """
+        where, args = self._filter(station, since, until, step)
+        with self.lock:
+            return self.db.execute(f'''
+                SELECT r.uid, r.station, r.timestamp, m.step, m.min, m.value, m.max, m.units, m.result
+                FROM measurements m JOIN runs r ON r.id = m.run_id
+                WHERE m.name = ? AND m.value IS NOT NULL {where}
+                ORDER BY r.timestamp, r.id''', [name] + args).fetchall()
+
+    def cpk(self, name, **kw):
+        """
+        Process capability of an assertion against its most recent limits, one sided if it only has one.
+
+        Returns
+        -------
+        dict
+            n, mean, std, min and max limit, cp (None unless two sided) and cpk
+        """
+        rows = self.values(name, **kw)
+        if len(rows) < 2:
+            raise Exception('Need at least 2 numeric results for %s, found %d' % (name, len(rows)))
+        x = np.array([row[5] for row in rows])
+        lsl, usl = rows[-1][4], rows[-1][6]
+        mean, std = float(x.mean()), float(x.std(ddof=1))
+        sides = [(usl - mean) if usl is not None else None, (mean - lsl) if lsl is not None else None]
+        sides = [s for s in sides if s is not None]
+        if not sides:
+            raise Exception('%s has no limits' % name)
+        cpk = min(sides) / (3 * std) if std else float('inf')
+        cp = (usl - lsl) / (6 * std) if std and len(sides) == 2 else None
+        return {'n': len(x), 'mean': mean, 'std': std, 'min': lsl, 'max': usl, 'cp': cp, 'cpk': cpk}
+
+    def distribution(self, name, bins=10, **kw):
+        """
+        Histogram of an assertion's results across its most recent limits.
+
+        Returns
+        -------
+        tuple
+            (count below min, list of (bin low, bin high, count), count above max)
+        """
+        rows = self.values(name, **kw)
+        if not rows:
+            raise Exception('No numeric results for %s' % name)
+        x = np.array([row[5] for row in rows])
+        lo = rows[-1][4] if rows[-1][4] is not None else float(x.min())
+        hi = rows[-1][6] if rows[-1][6] is not None else float(x.max())
+        counts, edges = np.histogram(x[(x >= lo) & (x <= hi)], bins, (lo, hi))
+        return int((x < lo).sum()), list(zip(edges[:-1].tolist(), edges[1:].tolist(), counts.tolist())), int((x > hi).sum())
+
+    def close(self):
+        self.db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.measurements', description=__doc__.splitlines()[0].strip())
+    parser.add_argument('--db', default=DEFAULT_DB, help='measurement database, default %(default)s')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('import', help='add CSV reports, already stored reports are skipped')
+    p.add_argument('paths', nargs='+', help='report files or folders searched for *_Report.csv')
+    p = sub.add_parser('yield', help='run and final yield')
+    p.add_argument('--by', choices=['station', 'day', 'slot', 'version'])
+    for name in ('cpk', 'dist', 'export'):
+        p = sub.add_parser(name, help={'cpk': 'process capability against the limits',
+                                       'dist': 'distribution across the limits',
+                                       'export': 'numeric results as CSV'}[name])
+        p.add_argument('name', help='assertion name, e.g. "Measured Vdut"')
+        p.add_argument('--step', help='only steps whose title contains this')
+        if name == 'dist':
+            p.add_argument('--bins', type=int, default=10)
+        if name == 'export':
+            p.add_argument('-o', '--output', help='output file, default stdout')
+    for p in sub.choices.values():
+        p.add_argument('--station')
+        p.add_argument('--since', help='YYYY-MM-DD[ HH:MM:SS]')
+        p.add_argument('--until', help='YYYY-MM-DD[ HH:MM:SS]')
+    args = parser.parse_args(argv)
+
+    store = MeasurementStore(args.db)
+    span = dict(station=args.station, since=args.since, until=args.until)
+    if args.cmd == 'import':
+        print('%d reports added' % store.import_reports(args.paths))
+    elif args.cmd == 'yield':
+        print('%-20s %6s %6s %7s %6s %6s %7s' % (args.by or '', 'runs', 'pass', 'yield', 'UIDs', 'final', 'yield'))
+        for g, n, p, y, u, up, fy in store.yield_summary(args.by, **span):
+            print('%-20s %6d %6d %6.1f%% %6d %6d %s' % (g, n, p, y, u, up, '%6.1f%%' % fy if fy is not None else '     -'))
+    elif args.cmd == 'cpk':
+        r = store.cpk(args.name, step=args.step, **span)
+        print('n=%d mean=%.6g std=%.6g min=%s max=%s cp=%s cpk=%.3f' % (
+            r['n'], r['mean'], r['std'], r['min'], r['max'], '-' if r['cp'] is None else '%.3f' % r['cp'], r['cpk']))
+    elif args.cmd == 'dist':
+        below, bins, above = store.distribution(args.name, args.bins, step=args.step, **span)
+        peak = max([below, above] + [c for _, _, c in bins]) or 1
+        print('%-27s %6d %s' % ('< min', below, '#' * (40 * below // peak)))
+        for lo, hi, c in bins:
+            print('%12.6g - %12.6g %6d %s' % (lo, hi, c, '#' * (40 * c // peak)))
+        print('%-27s %6d %s' % ('> max', above, '#' * (40 * above // peak)))
+    elif args.cmd == 'export':
+        f = open(args.output, 'w', newline='') if args.output else sys.stdout
+        writer = csv.writer(f)
+        writer.writerow(['uid', 'station', 'timestamp', 'step', 'min', 'value', 'max', 'units', 'result'])
+        writer.writerows(store.values(args.name, step=args.step, **span))
+        if args.output:
+            f.close()
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
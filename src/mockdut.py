@@ -0,0 +1,245 @@
+""" This module provides a simulated Trail Tracer TX DUT: its series RLC output stage, application UART protocol and STM32 factory bootloader, served over a pseudo-terminal """
+
+import logging
+import random
+import struct
+import threading
+import time
+import numpy as np
+
+from src.mockstm32boot import MockStm32Bootloader
+from src.stm32coprocessor import ADC_HS_CHANNELS, ADC_HS_SCALE, ADC_LS_DIVIDER
+
+logger = logging.getLogger(__name__)
+
+
+PWM_CLOCK = 64e6  # DUT PWM timer clock (Hz)
+BOOT_PIN = 2  # coprocessor dout held low at power up to enter the bootloader
+POWER_ON = 4.0  # Vdut (V) above which the DUT MCU runs
+HARMONICS = 7  # highest PWM harmonic in the synthesized current
+
+
+class RlcModel:
+    """
+    Series RLC output stage driven by the 0..Vdut PWM half bridge.
+
+    Tuning cfg bit n set shorts tuning inductor n, L1 22uH (bit 0) to L4 220uH (bit 3), in series
+    with the fixed coil lfix and the resonant capacitor cres.
+    """
+    INDUCTORS = (22e-6, 47e-6, 100e-6, 220e-6)
+    ESR = (0.6, 0.8, 1.6, 3.3)  # series resistance of each tuning inductor (Ohm)
+
+    def __init__(self, lfix=103e-6, cres=46.6e-9, r_fix=6.2, inductors=INDUCTORS, esr=ESR):
+        self.lfix = lfix
+        self.cres = cres
+        self.r_fix = r_fix
+        self.inductors = list(inductors)
+        self.esr = list(esr)
+
+    @classmethod
+    def sample(cls, rng, tol_l=0.05, tol_c=0.03, tol_r=0.05):
+        """A DUT with component values spread normally, tol is the 3 sigma tolerance"""
+        n = lambda x, tol: x * rng.normal(1, tol / 3)
+        return cls(n(103e-6, tol_l), n(46.6e-9, tol_c), n(6.2, tol_r),
+                   [n(l, tol_l) for l in cls.INDUCTORS], [n(r, tol_r) for r in cls.ESR])
+
+    def inductance(self, cfg):
+        return self.lfix + sum(l for i, l in enumerate(self.inductors) if not cfg >> i & 1)
+
+    def resistance(self, cfg):
+        return self.r_fix + sum(r for i, r in enumerate(self.esr) if not cfg >> i & 1)
+
+    def impedance(self, cfg, f):
+        w = 2 * np.pi * np.asarray(f)
+        return self.resistance(cfg) + 1j * (w * self.inductance(cfg) - 1 / (w * self.cres))
+
+    def harmonics(self, cfg, f, duty, vdut):
+        """Peak current phasor of each PWM harmonic 1..HARMONICS"""
+        n = np.arange(1, HARMONICS + 1)
+        v = 2 * vdut / (n * np.pi) * np.sin(n * np.pi * duty)  # square wave Fourier series
+        return v / self.impedance(cfg, n * f)
+
+    def current_rms(self, cfg, f, duty, vdut):
+        """Fundamental current (A RMS), what the DFT of a capture measures"""
+        return abs(self.harmonics(cfg, f, duty, vdut)[0]) / np.sqrt(2)
+
+    def duty_for(self, current, cfg, f, vdut):
+        """PWM duty that drives current (A RMS) at f, at most 50%"""
+        x = current * abs(self.impedance(cfg, f)) * np.pi * np.sqrt(2) / (2 * vdut)
+        return float(np.arcsin(min(x, 1.0)) / np.pi)
+
+    def waveform(self, cfg, f, duty, vdut, t):
+        n = np.arange(1, HARMONICS + 1)[:, None]
+        return np.real(self.harmonics(cfg, f, duty, vdut)[:, None] * np.exp(2j * np.pi * n * f * t)).sum(axis=0)
+
+
+class MockDutTx(MockStm32Bootloader):
+    """
+    Simulated DUT on one UART, following the fixture's Vdut and boot pin.
+
+    Powered up with the boot pin low or blank flash it runs the factory bootloader, otherwise it
+    prints its UID and serves the DutTx application commands, with its output stage current
+    computed from an RlcModel.  capture() and rails() feed MockStm32CoProcessor so the fixture
+    measures what the DUT drives.
+    """
+    def __init__(self, model=None, uid=None, vdut=0.0, samplerate=625e3, samples=2048, noise=0.002,
+                 tune_target=0.22, tune_f=53.333e3, isense_error=0.0, boot_delay=0.05, record_interval=0.0,
+                 rng=None):
+        super().__init__()
+        self.model = model or RlcModel()
+        self.uid = uid or ''.join(random.choice('0123456789') for _ in range(30))
+        self.vdut = vdut
+        self.samplerate = samplerate
+        self.samples = samples
+        self.noise = noise  # ADC noise (V RMS)
+        self.tune_target = tune_target  # auto tune output current (A RMS)
+        self.tune_f = tune_f
+        self.isense_error = isense_error  # gain error of the DUT's own current sense
+        self.boot_delay = boot_delay  # power up to UID line (s)
+        self.record_interval = record_interval  # time between auto tune records (s)
+        self.rng = rng or np.random.default_rng()
+
+        self.mode = None  # None while unpowered, 'boot' or 'app'
+        self.boot_pin = 1
+        self.tuning = 0b1111
+        self.per = 1200
+        self.ccr = 600
+        self.pwm_on = False
+        self.factory_test = None  # 'PASS' or 'FAIL' once written
+        self._write_lock = threading.Lock()
+        self._boot_timer = None
+
+    @property
+    def programmed(self):
+        return self.flash[:8] != b'\xFF' * 8
+
+    def on_fixture_output(self, name, value):
+        """MockStm32CoProcessor on_output hook"""
+        if name == 'dout' and value[0] == BOOT_PIN:
+            self.boot_pin = value[1]
+        elif name == 'vdut':
+            self.vdut = value
+            if value >= POWER_ON and self.mode is None:
+                self._power_up()
+            elif value < POWER_ON and self.mode is not None:
+                self._power_down()
+
+    def _power_up(self):
+        if self.boot_pin == 0 or not self.programmed:
+            self.mode = 'boot'
+            return
+        self.mode = 'app'
+        self._boot_timer = threading.Timer(self.boot_delay, self._log, ['UID: %s' % self.uid])
+        self._boot_timer.start()
+
+    def _power_down(self):
+        if self._boot_timer is not None:
+            self._boot_timer.cancel()
+        self.mode = None
+        self.pwm_on = False
+        self.tuning = 0b1111
+        self.reset()
+
+    def _log(self, line):
+        if self.mode == 'app':
+            self._write((line + '\r\n').encode())
+
+    def _write(self, data):
+        with self._write_lock:
+            super()._write(data)
+
+    def _receive(self, b):
+        if self.mode == 'boot':
+            super()._receive(b)
+        elif self.mode == 'app':
+            cmd, val = struct.unpack('<II', bytes([b]) + self._read(7))
+            self._app_command(cmd, val)
+        # Unpowered, the byte is lost
+
+    def _app_command(self, cmd, val):
+        raw = struct.pack('<I', val)
+        if cmd == 1:
+            self.per, self.ccr = struct.unpack('<2H', raw)
+        elif cmd == 2:
+            self.pwm_on = bool(val)
+        elif cmd == 3:
+            self.tuning = val & 0xF
+        elif cmd == 4:
+            self._write(struct.pack('<If', cmd, self.isense()))
+            return
+        elif cmd == 0x54455354:
+            self.factory_test = raw[::-1].decode('ascii', errors='replace')
+        elif cmd != 5:
+            logger.warning('Unknown DUT command 0x%X', cmd)
+        self._write(struct.pack('<II', cmd, val))
+        if cmd == 5:
+            if val:
+                self._auto_tune()
+            else:
+                self.pwm_on = False
+
+    def _auto_tune(self):
+        """Try every relay cfg at 50% duty, keep the lowest |Z| one and regulate to tune_target"""
+        f = self.tune_f
+        best = None
+        for cfg in range(16):
+            z = abs(self.model.impedance(cfg, f))
+            i = self.model.current_rms(cfg, f, 0.5, self.vdut)
+            self._log('Relay cfg: %d, I: %dmA, |Z|: %dmOhm' % (cfg, round(i * 1e3), round(z * 1e3)))
+            if best is None or z < best[0]:
+                best = (z, cfg)
+            if self.record_interval:
+                time.sleep(self.record_interval)
+        self.tuning = best[1]
+        self.per = int(round(PWM_CLOCK / f))
+        self.ccr = int(round(self.per * self.model.duty_for(self.tune_target, self.tuning, f, self.vdut)))
+        self.pwm_on = True
+
+    @property
+    def driving(self):
+        return self.mode == 'app' and self.pwm_on and self.per > 0
+
+    def isense(self):
+        if not self.driving:
+            return 0.0
+        i = self.model.current_rms(self.tuning, PWM_CLOCK / self.per, self.ccr / self.per, self.vdut)
+        return float(i * (1 + self.isense_error))
+
+    def capture(self, per=None, ccr=None):
+        """MockStm32CoProcessor capture_model, Iout and Isense at 1 V/A around mid-scale"""
+        volts = 1.65 + self.rng.normal(0, self.noise, (ADC_HS_CHANNELS, self.samples))
+        if self.driving:
+            f = PWM_CLOCK / self.per
+            t = np.arange(self.samples) / self.samplerate + self.rng.uniform(0, 1 / f)
+            i = self.model.waveform(self.tuning, f, self.ccr / self.per, self.vdut, t)
+            volts[0] += i
+            volts[1] += i * (1 + self.isense_error)
+        return np.clip(np.round(volts / ADC_HS_SCALE), 0, 4095).astype('<u2')
+
+    def rails(self, vdut):
+        """MockStm32CoProcessor rails_model, the DUT 5V and 3V3 sense follow Vdut and Idut follows the load"""
+        dut_5v = max(0.0, 0.94 * vdut - 0.1)
+        dut_3v3 = min(3.256, max(0.0, dut_5v - 0.25))
+        idut = 0.0
+        if self.mode == 'boot':
+            idut = 0.006
+        elif self.mode == 'app':
+            idut = 0.012
+            if self.driving:
+                f = PWM_CLOCK / self.per
+                p = (np.abs(self.model.harmonics(self.tuning, f, self.ccr / self.per, vdut)) ** 2).sum() / 2
+                idut += p * self.model.resistance(self.tuning) / (0.9 * vdut)
+        jitter = lambda x: x + self.rng.normal(0, 0.0005) if x else x
+        return (jitter(vdut), jitter(idut),
+                (0.0, 0.0, jitter(dut_3v3) / ADC_LS_DIVIDER, jitter(dut_5v) / ADC_LS_DIVIDER))
+
+    def replace(self, model, uid=None):
+        """Swap in the next DUT, blank and unpowered"""
+        if self.mode is not None:
+            self._power_down()
+        self.model = model
+        self.uid = uid or ''.join(random.choice('0123456789') for _ in range(30))
+        self.flash[:] = b'\xFF' * len(self.flash)
+        self.writes.clear()
+        self.erases.clear()
+        self.factory_test = None
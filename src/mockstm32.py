@@ -0,0 +1,187 @@
+""" This module provides a Python reference implementation of the STM32 coprocessor firmware, served over a pseudo-terminal so Stm32CoProcessor can be exercised without hardware. """
+
+import logging
+import os
+import struct
+import threading
+import tty
+import numpy as np
+from scipy import signal
+
+from src.transport import FramedDeviceLink
+from src.stm32coprocessor import ADC_HS_CHANNELS, ADC_HS_SCALE, SWEEP_REDUCED
+
+logger = logging.getLogger(__name__)
+
+
+class MockStm32CoProcessor:
+    def __init__(self, samples=2048, samplerate=625e3, capture_model=None, framed=False, rails_model=None, on_output=None):
+        """ Initialize the firmware state, call start() to open the pseudo-terminal
+
+        rails_model(vdut) returns the (vdut, idut, adc_ls) readings, and on_output(name, value) is
+        called when Vdut ('vdut', volts) or a digital output ('dout', (num, state)) changes, so a
+        simulated DUT can follow the fixture """
+        self.framed = framed
+        self.samples = samples
+        self.samplerate = samplerate
+        self.capture_model = capture_model or self.default_capture
+        self.rails_model = rails_model or self.default_rails
+        self.on_output = on_output
+
+        self.vdut = 0.0
+        self.rgb = 0
+        self.fp_led = 0
+        self.lcd = [' ' * 16, ' ' * 16]
+        self.douts = {}
+        self.dins = {}
+        self.pwm = None  # (per, ccr) of the DUT PWM while a sweep is running
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._link = None
+        self._input = bytearray()
+
+    def start(self):
+        """ Open the pseudo-terminal and serve commands on a background thread, connect to self.port """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        if self.framed:
+            self._link = FramedDeviceLink(self._read_raw, self._write_raw)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Close the pseudo-terminal, the serving thread exits on the next read """
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def default_capture(self, per, ccr):
+        """ Noisy mid-scale channels, with a 0.3 A RMS tone on Iout/Isense while the PWM runs """
+        n = np.arange(self.samples)
+        volts = np.full((ADC_HS_CHANNELS, self.samples), 1.65) + np.random.normal(0, 0.002, (ADC_HS_CHANNELS, self.samples))
+        if per:
+            tone = 0.3 * np.sqrt(2) * np.sin(2 * np.pi * (64e6 / per) * n / self.samplerate)
+            volts[0] += tone
+            volts[1] += tone
+        return np.clip(np.round(volts / ADC_HS_SCALE), 0, 4095).astype('<u2')
+
+    def default_rails(self, vdut):
+        """ Vdut as set, a fixed 0.1 A load and the DUT rails up while Vdut is on """
+        rail = 1.0 if vdut > 1 else 0.0
+        return vdut, 0.1 if vdut > 1 else 0.0, (0.0, 0.0, rail * 3.3 / 1.5, rail * vdut / 1.5)
+
+    def _read_raw(self):
+        fd = self._master  # stop() clears it from another thread
+        if fd is None:
+            raise EOFError
+        data = os.read(fd, 4096)
+        if not data:
+            raise EOFError
+        return data
+
+    def _write_raw(self, data):
+        fd = self._master
+        if fd is None:
+            raise EOFError
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _read(self, n):
+        if self._link:
+            return self._link.read(n)
+        while len(self._input) < n:
+            self._input.extend(self._read_raw())
+        data = bytes(self._input[:n])
+        del self._input[:n]
+        return data
+
+    def _write(self, data):
+        if self._link:
+            self._link.write(data)
+        else:
+            self._write_raw(data)
+
+    def _serve(self):
+        try:
+            while True:
+                cmd, val = struct.unpack('<II', self._read(8))
+                self._handle(cmd & 0x7FFFFFFF, cmd, val)
+        except (OSError, EOFError):
+            pass
+        except Exception:
+            logger.exception('Mock coprocessor stopped serving')
+
+    def _handle(self, cmd_id, cmd, val):
+        raw = struct.pack('<I', val)
+        if cmd_id == 1:
+            self.vdut = struct.unpack('<f', raw)[0]
+            if self.on_output:
+                self.on_output('vdut', self.vdut)
+            self._write(struct.pack('<II', cmd, val))
+        elif cmd_id == 2:
+            self._write(struct.pack('<If', cmd, self.rails_model(self.vdut)[0]))
+        elif cmd_id == 3:
+            self._write(struct.pack('<If', cmd, self.rails_model(self.vdut)[1]))
+        elif cmd_id == 4:
+            self.rgb = val
+            self._write(struct.pack('<II', cmd, val))
+        elif cmd_id == 5:
+            self._write(struct.pack('<II', cmd, val))
+            payload = self._read(val)
+            col, row = payload[0], payload[1]
+            text = payload[2:].decode('utf-8', errors='replace')
+            self.lcd[row] = (self.lcd[row][:col] + text + self.lcd[row][col + len(text):])[:16]
+            self._write(struct.pack('<II', cmd, val))
+        elif cmd_id == 6:
+            self.fp_led = val
+            self._write(struct.pack('<II', cmd, val))
+        elif cmd_id == 7:
+            self.douts[raw[0]] = raw[1]
+            if self.on_output:
+                self.on_output('dout', (raw[0], raw[1]))
+            self._write(struct.pack('<II', cmd, val))
+        elif cmd_id == 8:
+            self._write(struct.pack('<II', cmd, self.dins.get(val, 0)))
+        elif cmd_id == 9:
+            values = struct.pack('<4f', *self.rails_model(self.vdut)[2])
+            self._write(struct.pack('<II', cmd, len(values)) + values)
+        elif cmd_id == 10:
+            capture = self.capture_model(*(self.pwm or (None, None)))
+            payload = capture.T.tobytes()
+            self._write(struct.pack('<II', cmd, len(payload)) + payload)
+        elif cmd_id == 11:
+            self._write(struct.pack('<II', cmd, val))
+            self._sweep(self._read(val))
+        else:
+            logger.warning('Unknown coprocessor command %d', cmd_id)
+            self._write(struct.pack('<II', cmd, val))
+
+    def _sweep(self, plan):
+        num_points, kind = struct.unpack_from('<HH', plan)
+        for i in range(num_points):
+            per, ccr, ft = struct.unpack_from('<HHf', plan, 4 + 8 * i)
+            self.pwm = (per, ccr)
+            capture = self.capture_model(per, ccr)
+            if kind == SWEEP_REDUCED:
+                payload = struct.pack('<fff', *self._reduce(capture, ft))
+            else:
+                payload = capture.T.tobytes()
+            self._write(struct.pack('<HHI', i, kind, len(payload)) + payload)
+        self.pwm = None
+
+    def _reduce(self, capture, ft):
+        """ Flattop windowed tone amplitude and RMS in volts, matching Fixture.analyze_capture """
+        iout = capture[0] * ADC_HS_SCALE
+        samples_per_cycle = self.samplerate / ft
+        trimmed_length = int(np.floor(len(iout) / samples_per_cycle) * samples_per_cycle)
+        window = signal.windows.flattop(trimmed_length)
+        tone = np.exp(np.arange(trimmed_length) * (-2j * np.pi * ft / self.samplerate)) * window
+        dft = abs(tone @ iout[:trimmed_length]) / np.sum(window) * np.sqrt(2)
+        return dft, np.std(iout), np.std(capture[1] * ADC_HS_SCALE)
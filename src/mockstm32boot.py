@@ -0,0 +1,167 @@
+""" This module provides a simulated STM32 factory UART bootloader, served over a pseudo-terminal so Stm32Bootloader can be exercised without hardware. """
+
+import logging
+import os
+import struct
+import termios
+import threading
+import tty
+
+from src.stm32bootloader import (ACK, NACK, SYNC, CMD_GET, CMD_GET_ID, CMD_READ_MEMORY, CMD_GO,
+                                 CMD_WRITE_MEMORY, CMD_EXTENDED_ERASE, FLASH_BASE, MASS_ERASE, checksum)
+
+logger = logging.getLogger(__name__)
+
+
+class MockStm32Bootloader:
+    def __init__(self, flash_size=64 * 1024, page_size=2048, pid=0x466, write_align=8):
+        """ Initialize a blank STM32G030C8 flash, call start() to open the pseudo-terminal """
+        self.flash = bytearray(b'\xFF' * flash_size)
+        self.page_size = page_size
+        self.pid = pid
+        self.write_align = write_align
+        self.synced = False
+        self.go_addr = None  # set when a go command jumps to the application
+        self.writes = []  # (address, length) of each write memory command
+        self.erases = []  # page list of each erase, or MASS_ERASE
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._termios = None
+        self._input = bytearray()
+
+    def start(self):
+        """ Open the pseudo-terminal and serve commands on a background thread, connect to self.port """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self._termios = termios.tcgetattr(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Close the pseudo-terminal, the serving thread exits on the next read """
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def reset(self):
+        """ Power cycle, the next session has to sync again """
+        self.synced = False
+        self.go_addr = None
+        # A pty keeps the parity setting of the last client and rejects reopening with it,
+        # restore the original line settings so the next session can open the port
+        termios.tcsetattr(self._slave, termios.TCSANOW, self._termios)
+
+    def _read(self, n):
+        while len(self._input) < n:
+            data = os.read(self._master, 4096)
+            if not data:
+                raise EOFError
+            self._input.extend(data)
+        data = bytes(self._input[:n])
+        del self._input[:n]
+        return data
+
+    def _write(self, data):
+        view = memoryview(bytes(data))
+        while view:
+            view = view[os.write(self._master, view):]
+
+    def _serve(self):
+        try:
+            while True:
+                self._receive(self._read(1)[0])
+        except (OSError, EOFError):
+            pass
+
+    def _receive(self, b):
+        if b == SYNC:
+            self._write([NACK if self.synced else ACK])
+            self.synced = True
+            return
+        if not self.synced:
+            return  # noise before autobaud
+        if self._read(1)[0] != b ^ 0xFF:
+            self._write([NACK])
+            return
+        self._handle(b)
+
+    def _read_address(self):
+        rx = self._read(5)
+        if checksum(rx[:4]) != rx[4]:
+            self._write([NACK])
+            return None
+        addr = struct.unpack('>I', rx[:4])[0]
+        if not FLASH_BASE <= addr < FLASH_BASE + len(self.flash):
+            self._write([NACK])
+            return None
+        self._write([ACK])
+        return addr - FLASH_BASE
+
+    def _handle(self, cmd):
+        if cmd == CMD_GET:
+            commands = [CMD_GET, 0x01, CMD_GET_ID, CMD_READ_MEMORY, CMD_GO, CMD_WRITE_MEMORY, CMD_EXTENDED_ERASE]
+            self._write([ACK, len(commands), 0x31] + commands + [ACK])
+        elif cmd == CMD_GET_ID:
+            self._write([ACK, 1] + list(struct.pack('>H', self.pid)) + [ACK])
+        elif cmd == CMD_READ_MEMORY:
+            self._write([ACK])
+            offset = self._read_address()
+            if offset is None:
+                return
+            n, n_check = self._read(2)
+            if n ^ 0xFF != n_check:
+                self._write([NACK])
+                return
+            self._write([ACK])
+            self._write(self.flash[offset:offset + n + 1])
+        elif cmd == CMD_GO:
+            self._write([ACK])
+            offset = self._read_address()
+            if offset is not None:
+                self.go_addr = FLASH_BASE + offset
+                self.synced = False
+        elif cmd == CMD_WRITE_MEMORY:
+            self._write([ACK])
+            offset = self._read_address()
+            if offset is None:
+                return
+            n = self._read(1)[0] + 1
+            data = self._read(n)
+            if checksum(bytes([n - 1]) + data) != self._read(1)[0]:
+                self._write([NACK])
+                return
+            # Flash can only be programmed a whole erased double word at a time
+            target = self.flash[offset:offset + n]
+            if offset % self.write_align or n % self.write_align or target != b'\xFF' * n:
+                self._write([NACK])
+                return
+            self.flash[offset:offset + n] = data
+            self.writes.append((FLASH_BASE + offset, n))
+            self._write([ACK])
+        elif cmd == CMD_EXTENDED_ERASE:
+            self._write([ACK])
+            count = struct.unpack('>H', self._read(2))[0]
+            if count == MASS_ERASE:
+                self._read(1)
+                self.flash[:] = b'\xFF' * len(self.flash)
+                self.erases.append(MASS_ERASE)
+                self._write([ACK])
+                return
+            rx = self._read(2 * (count + 1))
+            if checksum(struct.pack('>H', count) + rx) != self._read(1)[0]:
+                self._write([NACK])
+                return
+            pages = struct.unpack('>%dH' % (count + 1), rx)
+            for page in pages:
+                self.flash[page * self.page_size:(page + 1) * self.page_size] = b'\xFF' * self.page_size
+            self.erases.append(list(pages))
+            self._write([ACK])
+        else:
+            logger.warning('Unsupported bootloader command 0x%02X', cmd)
+            self._write([NACK])
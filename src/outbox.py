@@ -0,0 +1,193 @@
+""" This module provides the durable report outbox and the worker that syncs it to cloud storage in batches """
+
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class ReportOutbox:
+    """
+    Append-only SQLite record of every report produced, and whether it has been uploaded and
+    copied to the USB drives.
+
+    Entries survive restarts, so a report is uploaded exactly once however long the station
+    was offline, and a sync only looks at pending entries.  Every slot process of a station adds
+    to the same outbox, the process running the SyncWorker and ReportPublisher drains it.
+    """
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            rel_path TEXT NOT NULL,
+            created REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_try REAL NOT NULL DEFAULT 0,
+            done REAL,
+            error TEXT,
+            published REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (next_try) WHERE done IS NULL')
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_unpublished ON outbox (id) WHERE published IS NULL')
+
+    def add(self, path, rel_path):
+        """Record a local report, rel_path is where it goes under the upload target"""
+        with self.lock:
+            cur = self.db.execute('INSERT INTO outbox (path, rel_path, created) VALUES (?, ?, ?)',
+                                  (str(path), str(rel_path), time.time()))
+        return cur.lastrowid
+
+    def pending(self, limit=50, now=None):
+        """Up to limit (id, path, rel_path, attempts) entries due for upload, oldest first"""
+        with self.lock:
+            return self.db.execute('SELECT id, path, rel_path, attempts FROM outbox WHERE done IS NULL AND next_try <= ? '
+                                   'ORDER BY id LIMIT ?', (time.time() if now is None else now, limit)).fetchall()
+
+    def count_pending(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM outbox WHERE done IS NULL').fetchone()[0]
+
+    def mark_done(self, ids):
+        with self.lock:
+            self.db.executemany('UPDATE outbox SET done = ?, error = NULL WHERE id = ?', [(time.time(), i) for i in ids])
+
+    def mark_failed(self, ids, error, retry_at):
+        with self.lock:
+            self.db.executemany('UPDATE outbox SET attempts = attempts + 1, next_try = ?, error = ? WHERE id = ?',
+                                [(retry_at, str(error), i) for i in ids])
+
+    def unpublished(self, limit=50):
+        """Up to limit (id, path, rel_path) entries not yet copied to the USB drives, oldest first"""
+        with self.lock:
+            return self.db.execute('SELECT id, path, rel_path FROM outbox WHERE published IS NULL ORDER BY id LIMIT ?',
+                                   (limit,)).fetchall()
+
+    def mark_published(self, ids):
+        with self.lock:
+            self.db.executemany('UPDATE outbox SET published = ? WHERE id = ?', [(time.time(), i) for i in ids])
+
+    def close(self):
+        self.db.close()
+
+
+class DirectoryTarget:
+    """Upload target that copies reports into a local directory, e.g. a mounted share or for bench checks"""
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def upload(self, batch):
+        for path, rel_path in batch:
+            dest = self.root / rel_path
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(path, dest)
+
+
+class RcloneTarget:
+    """
+    Upload target for an rclone remote, see README RCLONE setup.
+
+    Each batch is one rclone copy of just the listed files, so the remote and the local report
+    folder are never listed in full.
+    """
+    def __init__(self, remote, local_root, timeout=300):
+        self.remote = remote
+        self.local_root = Path(local_root)
+        self.timeout = timeout
+
+    def upload(self, batch):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(str(rel_path) for path, rel_path in batch) + '\n')
+        try:
+            res = subprocess.run(['rclone', 'copy', str(self.local_root), self.remote, '--files-from-raw', f.name,
+                                  '--no-traverse', '--ignore-existing'], capture_output=True, text=True, timeout=self.timeout)
+        finally:
+            os.unlink(f.name)
+        if res.returncode != 0:
+            raise Exception('rclone copy failed (%d): %s' % (res.returncode, res.stderr.strip()[-500:]))
+
+
+class SyncWorker:
+    """Uploads pending outbox entries in batches on a background thread, failed batches back off exponentially"""
+    def __init__(self, outbox, target, batch_size=50, interval=60.0, backoff=5.0, max_backoff=1800.0):
+        self.outbox = outbox
+        self.target = target
+        self.batch_size = batch_size
+        self.interval = interval  # idle rescan period (s), wake() starts a sync right away
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='report-sync', daemon=True)
+        self._thread.start()
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def sync_once(self, now=None):
+        """
+        Upload every due entry, one batch at a time.
+
+        Returns
+        -------
+        tuple
+            (entries uploaded, entries that failed and were rescheduled)
+        """
+        uploaded = failed = 0
+        while True:
+            batch = self.outbox.pending(self.batch_size, now)
+            if not batch:
+                break
+            t = time.time() if now is None else now
+            # A missing or unreadable report only fails its own entry, the rest of the batch still goes
+            readable = []
+            for row in batch:
+                if os.access(row[1], os.R_OK):
+                    readable.append(row)
+                    continue
+                delay = self.retry_delay(row[3])
+                logger.warning('Report %s missing or unreadable, retrying in %.0fs', row[1], delay)
+                self.outbox.mark_failed([row[0]], 'missing or unreadable', t + delay)
+                failed += 1
+            batch = readable
+            if not batch:
+                continue
+            ids = [row[0] for row in batch]
+            try:
+                self.target.upload([(path, rel_path) for _, path, rel_path, _ in batch])
+            except Exception as ex:
+                # A batch shares its fate, back off on the entry with the fewest attempts
+                delay = self.retry_delay(min(row[3] for row in batch))
+                logger.warning('Report sync of %d entries failed, retrying in %.0fs: %s', len(batch), delay, ex)
+                self.outbox.mark_failed(ids, ex, t + delay)
+                failed += len(batch)
+                break
+            self.outbox.mark_done(ids)
+            uploaded += len(batch)
+        return uploaded, failed
+
+    def retry_delay(self, attempts):
+        """Backoff (s) before the next try of an entry that failed attempts times already"""
+        return min(self.max_backoff, self.backoff * 2 ** attempts)
+
+    def _run(self):
+        while True:
+            try:
+                self.sync_once()
+            except Exception as ex:
+                logger.warning('Report sync error: %s', ex)
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,251 @@
+""" This module provides the step-level cycle time profiler, its per-run breakdown and the station-wide history
+
+Usage:
+    python -m src.profiler ~/ttatp_reports/profile_history.jsonl --last 200
+"""
+
+import argparse
+import contextlib
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+PHASES = ('procedure', 'criteria', 'teardown')
+CATEGORIES = ('serial', 'wait', 'subprocess')  # time in a phase outside these is Python/DSP/framework
+_off = contextlib.nullcontext()
+
+
+class StepProfiler:
+    """
+    Wall time of each step phase, split into serial I/O, waits and subprocesses.
+
+    Only the thread that called begin_run() is profiled, the one running the test tree.  Timed
+    spans do not nest, time inside a span is charged to the outermost category so e.g. the serial
+    reads of a rail settle wait count as wait.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.trace = False  # also keep every phase and span as a timeline event
+        self._thread = None
+        self._stack = []  # open phase records, innermost last
+        self._in_span = False
+        self._t0 = 0.0
+        self.phases = []
+        self.events = []
+
+    def enable(self, trace=False):
+        self.enabled = True
+        self.trace = trace
+        return self
+
+    def begin_run(self):
+        self._thread = threading.get_ident()
+        self._stack = []
+        self._in_span = False
+        self._t0 = time.perf_counter()
+        self.phases = []
+        self.events = []
+
+    def _active(self):
+        return self.enabled and threading.get_ident() == self._thread
+
+    @contextlib.contextmanager
+    def _phase(self, step, phase):
+        record = {'step': step, 'phase': phase, 'start': time.perf_counter() - self._t0, 'wall': 0.0}
+        record.update(dict.fromkeys(CATEGORIES, 0.0))
+        self._stack.append(record)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            record['wall'] = time.perf_counter() - self._t0 - record['start']
+            self.phases.append(record)
+            if self.trace:
+                self.events.append(('%s %s' % (step, phase), 'step', record['start'], record['wall']))
+
+    def phase(self, step, phase):
+        return self._phase(step, phase) if self._active() else _off
+
+    @contextlib.contextmanager
+    def _span(self, category, name):
+        self._in_span = True
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t
+            self._in_span = False
+            if self._stack:
+                self._stack[-1][category] += dt
+            if self.trace:
+                self.events.append((name or category, category, t - self._t0, dt))
+
+    def timed(self, category, name=None):
+        """Context manager charging its wall time to category in the current step phase"""
+        if self._in_span or not self._active():
+            return _off
+        return self._span(category, name)
+
+    def timed_fn(self, category):
+        """Decorator version of timed(), spans are named after the function"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timed(category, fn.__name__):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def end_run(self):
+        """
+        Per step breakdown of the run, steps in first run order.
+
+        Returns
+        -------
+        dict
+            {'wall': run wall time, 'steps': {title: {'procedure', 'criteria', 'teardown', *CATEGORIES, 'other'}}}
+        """
+        steps = {}
+        for p in sorted(self.phases, key=lambda p: p['start']):
+            s = steps.setdefault(p['step'], dict.fromkeys(PHASES + CATEGORIES + ('other',), 0.0))
+            s[p['phase']] += p['wall']
+            for c in CATEGORIES:
+                s[c] += p[c]
+            s['other'] += p['wall'] - sum(p[c] for c in CATEGORIES)
+        self._thread = None
+        return {'wall': time.perf_counter() - self._t0, 'steps': steps}
+
+    def dump_trace(self, path):
+        """Write the run timeline in Chrome trace event format, open in chrome://tracing or Perfetto"""
+        events = [{'name': name, 'cat': cat, 'ph': 'X', 'ts': 1e6 * start, 'dur': 1e6 * dur, 'pid': 0,
+                   'tid': 0 if cat == 'step' else 1} for name, cat, start, dur in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def format_breakdown(run):
+    lines = ['%-32s' % 'step' + ''.join(' %10s' % k for k in PHASES + CATEGORIES + ('other',))]
+    for step, s in run['steps'].items():
+        lines.append('%-32s' % step[:32] + ''.join(' %10.3f' % s[k] for k in PHASES + CATEGORIES + ('other',)))
+    lines.append('%-32s %10.3f' % ('run wall', run['wall']))
+    return '\n'.join(lines)
+
+
+def format_top(run, top=5):
+    """One line summary of the steps with the most procedure+criteria+teardown time, for the report"""
+    totals = sorted(((sum(s[p] for p in PHASES), step, s) for step, s in run['steps'].items()), key=lambda t: -t[0])
+    return '; '.join('%s %.3fs (serial %.0f%% wait %.0f%%)' % (step, t, 100 * s['serial'] / t if t else 0,
+                                                              100 * s['wait'] / t if t else 0)
+                     for t, step, s in totals[:top])
+
+
+class ProfileHistory:
+    """
+    Append-only JSON lines file of run breakdowns, shared by every run of the station.
+
+    Once the file holds about maxlen runs it is rotated to <name>.1, so it never holds more than
+    maxlen runs and load() reads at most two of them.
+    """
+    def __init__(self, path, maxlen=500):
+        self.path = Path(path)
+        self.rotated = self.path.with_name(self.path.name + '.1')
+        self.maxlen = maxlen
+
+    def append(self, run, **meta):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps(dict(meta, **run)) + '\n'
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # slot processes append to the same file
+            f.write(line)
+            f.flush()
+            # Runs of a station log near identical lines, so the size tells the run count
+            if f.tell() >= len(line) * self.maxlen:
+                try:
+                    # Another process may have rotated the file while this one waited for the lock
+                    if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                        os.replace(self.path, self.rotated)
+                except FileNotFoundError:
+                    pass
+
+    def load(self, last=None):
+        last = last or self.maxlen
+        lines = deque(maxlen=last)
+        for path in (self.rotated, self.path):
+            if path.exists():
+                with open(path) as f:
+                    lines.extend(deque(f, last))
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def percentiles(self, last=None, q=(50, 90, 99)):
+        """
+        Rolling percentiles over the last runs.
+
+        Returns
+        -------
+        list of tuple
+            (step, key, n, *percentiles) per step and timing key, plus ('run', 'wall', ...)
+        """
+        runs = self.load(last)
+        rows = []
+        if not runs:
+            return rows
+        rows.append(('run', 'wall', len(runs), *np.percentile([r['wall'] for r in runs], q)))
+        steps = {}
+        for r in runs:
+            for step, s in r['steps'].items():
+                for key, value in s.items():
+                    steps.setdefault(step, {}).setdefault(key, []).append(value)
+        for step, keys in steps.items():
+            for key in ('procedure',) + CATEGORIES + ('other',):
+                if key in keys and any(keys[key]):
+                    rows.append((step, key, len(keys[key]), *np.percentile(keys[key], q)))
+        return rows
+
+
+def format_percentiles(rows, q=(50, 90, 99)):
+    lines = ['%-32s %-10s %5s' % ('step', 'time', 'runs') + ''.join(' %8s' % ('p%d' % p) for p in q)]
+    for step, key, n, *values in rows:
+        lines.append('%-32s %-10s %5d' % (step[:32], key, n) + ''.join(' %8.3f' % v for v in values))
+    return '\n'.join(lines)
+
+
+profiler = StepProfiler()
+
+
+def profile_step(cls):
+    """Class decorator timing an automation.Step's procedure, criteria and teardown with the profiler"""
+    for phase in PHASES:
+        fn = cls.__dict__.get(phase)
+        if fn is None:
+            continue
+
+        def wrap(fn, phase):
+            @functools.wraps(fn)
+            def wrapper(self, *args, **kwargs):
+                with profiler.phase(self.title, phase):
+                    return fn(self, *args, **kwargs)
+            return wrapper
+        setattr(cls, phase, wrap(fn, phase))
+    return cls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.profiler', description='Rolling step time percentiles')
+    parser.add_argument('history', nargs='?', default=Path("~/ttatp_reports", "profile_history.jsonl"))
+    parser.add_argument('--last', type=int, default=200, help='number of most recent runs, default %(default)s')
+    args = parser.parse_args(argv)
+    print(format_percentiles(ProfileHistory(args.history).percentiles(args.last)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+""" This module provides the background report publisher, copying finished reports to USB drives without holding up the test cycle """
+
+import logging
+import os
+import queue
+import re
+import shutil
+import socket
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+NETLINK_KOBJECT_UEVENT = 15
+REPORT_FOLDER = 'atp_reports'  # USB drives without this folder at their root are ignored
+
+
+def scan_usb_targets(media_dir='../media'):
+    """Mount any unmounted USB partitions and return the mount paths that have a report folder"""
+    targets = []
+    lsblk = os.popen('lsblk | grep sd | grep part').read().strip()  # find all USB drives
+    lsblk = lsblk.split('\n')
+    for i in lsblk:
+        if '/' in i:  # drive mounted
+            mount_path = re.search(r'.*part (\/.*)', i).group(1)
+
+        elif i != '':  # drive not mounted
+            sd_name = re.search(r'(sd\S{2,5})', i).group(1)
+            blkid = os.popen('sudo blkid | grep %s' % sd_name).read().strip()
+            uuid = re.search(r'UUID="(\S*)" BLOCK', blkid).group(1)
+            mount_path = os.path.join(media_dir, uuid)
+            os.makedirs(mount_path, exist_ok=True)
+            if not os.path.ismount(mount_path):  # another process may have mounted it since lsblk
+                os.popen('sudo mount /dev/%s %s' % (sd_name, mount_path)).read()
+
+        else:
+            continue
+
+        if REPORT_FOLDER in os.listdir(mount_path):  # find target folder, otherwise ignore
+            targets.append(mount_path)
+    return targets
+
+
+class UsbWatcher:
+    """
+    Cached list of USB report targets.
+
+    The list is rescanned when the kernel reports a block partition being added or removed, so
+    publishing never has to scan.  Without netlink uevents it falls back to scanning on every
+    get_targets() call.
+    """
+    def __init__(self, media_dir='../media', settle=1.0):
+        self.media_dir = media_dir
+        self.settle = settle  # wait (s) after a hot-plug event before mounting
+        self.targets = []
+        self.on_change = None  # called with the new target list when it changes
+        self.lock = threading.Lock()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        self.refresh()
+        try:
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self._sock.bind((0, 1))  # kernel uevent multicast group
+        except (AttributeError, OSError) as ex:
+            logger.warning('USB hot-plug events unavailable (%s), scanning before each publish', ex)
+            self._sock = None
+            return self
+        self._thread = threading.Thread(target=self._watch, name='usb-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def refresh(self):
+        try:
+            targets = scan_usb_targets(self.media_dir)
+        except Exception as ex:
+            logger.warning('USB scan failed: %s', ex)
+            targets = []
+        with self.lock:
+            changed, self.targets = targets != self.targets, targets
+        logger.info('USB report targets: %s', targets)
+        if changed and self.on_change:
+            self.on_change(targets)
+
+    def get_targets(self):
+        if self._sock is None:
+            self.refresh()
+        with self.lock:
+            return list(self.targets)
+
+    def _watch(self):
+        while True:
+            try:
+                fields = self._sock.recv(8192).split(b'\0')
+            except OSError as ex:
+                logger.warning('USB hot-plug watcher stopped: %s', ex)
+                self._sock = None
+                return
+            if b'SUBSYSTEM=block' in fields and b'DEVTYPE=partition' in fields \
+                    and (b'ACTION=add' in fields or b'ACTION=remove' in fields):
+                time.sleep(self.settle)
+                self.refresh()
+
+
+class ReportPublisher:
+    """
+    Copies finished local reports to every USB report target on a background thread.
+
+    With an outbox, an entry is marked published once it reached at least one drive.  Entries
+    that reached none are retried when the drives change, and with follow() the publisher also
+    picks up the entries of every slot process.
+    """
+    def __init__(self, watcher=None, outbox=None):
+        self.watcher = watcher or UsbWatcher()
+        self.queue = queue.Queue()
+        self.outbox = outbox  # marks published entries, see src.outbox.ReportOutbox
+        self.queued = set()  # outbox entry ids queued but not yet copied
+        self.failed = set()  # outbox entry ids that reached no drive, retried when the drives change
+        self.lock = threading.Lock()
+        self._thread = None
+        self.watcher.on_change = self._targets_changed
+
+    def start(self):
+        self.watcher.start()
+        self._thread = threading.Thread(target=self._run, name='report-publisher', daemon=True)
+        self._thread.start()
+        return self
+
+    def publish(self, report_path, rel_path, entry=None):
+        """Queue a local report to be copied to <target>/atp_reports/<rel_path>, entry is its outbox id"""
+        if entry is not None:
+            with self.lock:
+                if entry in self.queued:
+                    return
+                self.queued.add(entry)
+        self.queue.put((Path(report_path), Path(rel_path), entry))
+
+    def follow(self, interval=2.0, on_new=None):
+        """Poll the outbox for unpublished entries every interval (s), on_new() is called when some are found"""
+        def poll():
+            while True:
+                try:
+                    if self.publish_pending() and on_new:
+                        on_new()
+                except Exception as ex:
+                    logger.warning('Outbox poll failed: %s', ex)
+                time.sleep(interval)
+        threading.Thread(target=poll, name='outbox-follower', daemon=True).start()
+        return self
+
+    def publish_pending(self):
+        """Queue every unpublished outbox entry, returns how many were queued"""
+        n = 0
+        while True:
+            with self.lock:
+                skip = self.queued | self.failed
+                rows = [row for row in self.outbox.unpublished(limit=len(skip) + 50) if row[0] not in skip]
+            if not rows:
+                return n
+            for entry, path, rel_path in rows:
+                self.publish(path, rel_path, entry)
+            n += len(rows)
+
+    def flush(self):
+        """Block until every queued report has been copied"""
+        self.queue.join()
+
+    def _targets_changed(self, targets):
+        with self.lock:
+            self.failed.clear()
+        if self.outbox is not None and targets:
+            self.publish_pending()
+
+    def _run(self):
+        while True:
+            report_path, rel_path, entry = self.queue.get()
+            copied = 0
+            try:
+                for target in self.watcher.get_targets():
+                    dest = Path(target, REPORT_FOLDER, rel_path)
+                    try:
+                        dest.parent.mkdir(parents=True, exist_ok=True)
+                        shutil.copyfile(report_path, dest)
+                        copied += 1
+                    except Exception as ex:
+                        logger.warning('Publishing %s to %s failed: %s', report_path, target, ex)
+                if copied and entry is not None and self.outbox is not None:
+                    self.outbox.mark_published([entry])
+            except Exception as ex:
+                logger.warning('Publishing %s failed: %s', report_path, ex)
+            finally:
+                if entry is not None:
+                    # Left unpublished, the entry is retried once the drives change
+                    with self.lock:
+                        self.queued.discard(entry)
+                        if not copied:
+                            self.failed.add(entry)
+                self.queue.task_done()
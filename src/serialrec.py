@@ -0,0 +1,513 @@
+""" This module provides record and replay of the drivers' serial sessions, so a run from the line can be profiled repeatably on a workstation
+
+Usage:
+    python -m src.serialrec ~/ttatp_reports/RCTF_TT_ATS000/<report>.serial.rec [--dump]
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import select
+import struct
+import termios
+import threading
+import time
+import serial
+
+logger = logging.getLogger(__name__)
+
+
+REPLAY_ENV = 'TTATP_REPLAY'  # set to run the ATP against a recorded session, see SerialSessions.replay_from_env()
+MAGIC = b'TTSERIAL1\n'
+RECORD = struct.Struct('<IBBI')  # time since the start of the run (us), kind, port index, data length
+OPEN, CLOSE, FLUSH, TX, RX = b'OCFTR'  # event kinds, everything but RX is done by the host
+PENDING, DONE, SKIPPED = range(3)  # replay status of a host event
+
+
+class SerialLog:
+    """
+    Every byte written and read on the driver serial ports during one run, with timestamps, plus
+    the opens, closes and input flushes.
+
+    File layout: MAGIC, a uint32 length and a JSON header (run metadata and port names), then one
+    RECORD and its data per event.
+    """
+    def __init__(self, ports=None, events=None, meta=None):
+        self.ports = ports or []
+        self.events = events or []  # (seconds, kind, port index, data)
+        self.meta = meta or {}
+
+    def port_index(self, port):
+        if port not in self.ports:
+            self.ports.append(port)
+        return self.ports.index(port)
+
+    def save(self, path):
+        header = json.dumps(dict(self.meta, ports=self.ports)).encode()
+        with open(path, 'wb') as f:
+            f.write(MAGIC + struct.pack('<I', len(header)) + header)
+            for t, kind, port, data in self.events:
+                f.write(RECORD.pack(round(t * 1e6), kind, port, len(data)))
+                f.write(data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if not raw.startswith(MAGIC):
+            raise Exception('%s is not a serial session log' % path)
+        pos = len(MAGIC) + 4
+        end = pos + struct.unpack_from('<I', raw, len(MAGIC))[0]
+        meta = json.loads(raw[pos:end])
+        ports = meta.pop('ports')
+        events = []
+        pos = end
+        while pos < len(raw):
+            us, kind, port, length = RECORD.unpack_from(raw, pos)
+            pos += RECORD.size
+            events.append((us / 1e6, kind, port, raw[pos:pos + length]))
+            pos += length
+        return cls(ports, events, meta)
+
+    @property
+    def duration(self):
+        return self.events[-1][0] if self.events else 0.0
+
+    def summary(self):
+        """
+        Returns
+        -------
+        list of tuple
+            (port, kind, events, bytes) per port and event kind
+        """
+        counts = {}
+        for t, kind, port, data in self.events:
+            n = counts.setdefault((port, kind), [0, 0])
+            n[0] += 1
+            n[1] += len(data)
+        return [(self.ports[port], chr(kind), n, size) for (port, kind), (n, size) in sorted(counts.items())]
+
+
+class RecordingSerial:
+    """serial.Serial proxy logging every read, write, input flush and close to its SerialSessions"""
+    def __init__(self, ser, sessions):
+        self._ser = ser
+        self._sessions = sessions
+
+    def __getattr__(self, name):
+        return getattr(self._ser, name)
+
+    def write(self, data):
+        n = self._ser.write(data)
+        self._sessions.log_event(self._ser.port, TX, data)
+        return n
+
+    def read(self, size=1):
+        data = self._ser.read(size)
+        if data:
+            self._sessions.log_event(self._ser.port, RX, data)
+        return data
+
+    def reset_input_buffer(self):
+        self._ser.reset_input_buffer()
+        self._sessions.log_event(self._ser.port, FLUSH)
+
+    def close(self):
+        self._ser.close()
+        self._sessions.log_event(self._ser.port, CLOSE)
+
+
+class ReplaySerial:
+    """
+    serial.Serial stand-in served by a ReplaySession.
+
+    Replayed bytes come through a pipe, so the drivers can watch fileno() with add_reader and
+    poll in_waiting as they do a UART.
+    """
+    def __init__(self, session, port, timeout=None):
+        self.session = session
+        self.port = port
+        self.timeout = timeout
+        self.is_open = True
+        self.lock = threading.Lock()
+        self._r, self._w = os.pipe()
+        os.set_blocking(self._r, False)
+        os.set_blocking(self._w, False)
+
+    def fileno(self):
+        return self._r
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('i', fcntl.ioctl(self._r, termios.FIONREAD, b'\0' * 4))[0]
+
+    def read(self, size=1):
+        """Read up to size bytes, waiting at most timeout like pyserial (None waits for all of them)"""
+        data = bytearray()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(data) < size:
+            try:
+                data += os.read(self._r, size - len(data))
+                continue
+            except BlockingIOError:
+                pass
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                break
+            select.select([self._r], [], [], wait)
+        return bytes(data)
+
+    def write(self, data):
+        self.session.host_event(self, TX, bytes(data))
+        return len(data)
+
+    def reset_input_buffer(self):
+        # Every recorded byte was read by the drivers, so nothing is dropped, the flush only orders the replay
+        self.session.host_event(self, FLUSH)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            if not self.is_open:
+                return
+            self.is_open = False
+            os.close(self._r)
+            os.close(self._w)
+        self.session.host_event(self, CLOSE)
+
+    def feed(self, data):
+        """Write replayed bytes into the pipe, False if the port was closed"""
+        view = memoryview(data)
+        while view:
+            with self.lock:
+                if not self.is_open:
+                    return False
+                try:
+                    view = view[os.write(self._w, view):]
+                except BlockingIOError:
+                    pass
+            if view:
+                time.sleep(0.001)  # pipe full, the driver is behind
+        return True
+
+
+class ReplaySession:
+    """
+    Serves a SerialLog back to the drivers through ReplaySerials.
+
+    A replay thread walks the log in order.  Each host event (open, write, input flush, close)
+    waits until the drivers have done it, and each RX chunk is then fed to its port, at the
+    recorded delay after the preceding event divided by speed, or right away with speed 0.
+
+    Time based polling (settle loops) does not repeat exactly, so a write that is not the expected
+    one is matched to an identical write in the port's recording.  One of the last repeat_window
+    writes is a repeated poll and gets that write's recorded reply again, one found past recorded
+    polls skips them and their replies.  A write with no match counts in mismatches and
+    stands in for the expected one, so the replay carries on.
+    """
+    def __init__(self, log, speed=0.0, stall_timeout=30, window=1024, repeat_window=16):
+        self.log = log
+        self.speed = speed  # 1 for the recorded timing, 0 as fast as possible
+        self.stall_timeout = stall_timeout  # s to wait on the drivers before giving up on the replay
+        self.window = window  # most recorded polls skipped at once
+        self.repeat_window = repeat_window  # recent host events searched for a repeated write
+        self.cv = threading.Condition()
+        self.ports = {}  # port name: most recently opened ReplaySerial
+        self.host_events = [[] for _ in log.ports]  # event indexes of each port's host events
+        self.owner = {}  # RX event index: the port's preceding host event index
+        self.replies = {}  # TX event index: the RX data that followed it on its port, served again for a repeat
+        self.polls = set()  # TX event indexes repeating one of the port's recent writes, the only ones a replay may skip
+        last = [None] * len(log.ports)
+        for i, (t, kind, port, data) in enumerate(log.events):
+            if kind == RX:
+                self.owner[i] = last[port]
+                if last[port] in self.replies:
+                    self.replies[last[port]].append(data)
+            else:
+                hosts = self.host_events[port]
+                if kind == TX and any(self._matches(j, kind, data) for j in hosts[-repeat_window:]):
+                    self.polls.add(i)
+                hosts.append(i)
+                last[port] = i
+                if kind == TX:
+                    self.replies[i] = []
+        self.armed = False
+        self._thread = None
+        self._stop = False
+        self._reset()
+
+    @property
+    def meta(self):
+        return self.log.meta
+
+    def _reset(self):
+        self.status = [PENDING] * len(self.log.events)
+        self.pos = [0] * len(self.log.ports)  # next expected host event of each port
+        self.extra = []  # (port, data) replies to repeated writes, for the replay thread to feed
+        self.cursor = 0
+        self.mismatches = 0
+        self.repeats = 0
+        self.skipped = 0
+        self.dropped = 0  # RX bytes for a port the drivers had closed
+        self.stalled = None  # event index the replay gave up at
+        self.started = time.perf_counter()
+
+    def open(self, port, timeout=None, **kwargs):
+        ser = ReplaySerial(self, port, timeout)
+        with self.cv:
+            self.ports[port] = ser
+        self.host_event(ser, OPEN)
+        return ser
+
+    def _matches(self, i, kind, data):
+        return self.log.events[i][1] == kind and self.log.events[i][3] == data
+
+    def host_event(self, ser, kind, data=b''):
+        with self.cv:
+            if not self.armed or ser.port not in self.log.ports:
+                return
+            port = self.log.ports.index(ser.port)
+            hosts, pos = self.host_events[port], self.pos[port]
+            if pos < len(hosts) and self._matches(hosts[pos], kind, data):
+                k = pos
+            else:
+                # A recent write again is a repeated poll, otherwise look past recorded polls this run skipped
+                behind = next((j for j in range(pos - 1, max(pos - self.repeat_window, -1), -1)
+                               if self._matches(hosts[j], kind, data)), None) if kind == TX else None
+                if behind is not None:
+                    self.extra.extend((port, reply) for reply in self.replies[hosts[behind]])
+                    self.repeats += 1
+                    self.cv.notify_all()
+                    return
+                k = pos
+                while k < len(hosts) and hosts[k] in self.polls and k < pos + self.window:
+                    k += 1
+                    if k < len(hosts) and self._matches(hosts[k], kind, data):
+                        break
+                else:
+                    k = None
+                if k is None:
+                    if not self.mismatches:
+                        expected = self.log.events[hosts[pos]] if pos < len(hosts) else (0, 32, 0, b'')
+                        logger.warning('Replay diverged on %s: sent %s %s, recorded %s %s', ser.port, chr(kind),
+                                       data[:16].hex(), chr(expected[1]), expected[3][:16].hex())
+                    self.mismatches += 1
+                    if pos == len(hosts):
+                        return
+                    k = pos
+            for j in hosts[pos:k]:
+                self.status[j] = SKIPPED
+            self.skipped += k - pos
+            self.status[hosts[k]] = DONE
+            self.pos[port] = k + 1
+            self.cv.notify_all()
+
+    def _feed(self, port, data):
+        ser = self.ports.get(self.log.ports[port])
+        if not (ser and ser.feed(data)):
+            self.dropped += len(data)
+
+    def _wait(self, ready, deadline=None):
+        """
+        Wait for ready() until deadline (perf_counter s), feeding repeated replies meanwhile.
+
+        Returns True once ready, False at the deadline, None when stopped.
+        """
+        while True:
+            with self.cv:
+                while not (self._stop or self.extra or ready()):
+                    remaining = None if deadline is None else deadline - time.perf_counter()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.cv.wait(remaining)
+                if self._stop:
+                    return None
+                extra, self.extra = self.extra, []
+                done = ready()
+            for port, data in extra:
+                self._feed(port, data)
+            if done:
+                return True
+
+    def _run(self):
+        anchor_wall, anchor_t = time.perf_counter(), 0.0
+        for i, (t, kind, port, data) in enumerate(self.log.events):
+            self.cursor = i
+            if kind == RX:
+                if self.owner[i] is not None and self.status[self.owner[i]] == SKIPPED:
+                    continue
+                # Sleep to the recorded time, still feeding repeated replies
+                deadline = anchor_wall + (t - anchor_t) / self.speed if self.speed else 0
+                if self._wait(lambda: False, deadline) is None:
+                    return
+                self._feed(port, data)
+            else:
+                done = self._wait(lambda: self.status[i] != PENDING, time.perf_counter() + self.stall_timeout)
+                if done is None:
+                    return
+                if not done:
+                    self.stalled = i
+                    logger.warning('Replay stalled at event %d of %d, the drivers never sent %s %s on %s',
+                                   i, len(self.log.events), chr(kind), data[:16].hex(), self.log.ports[port])
+                    return
+            anchor_wall, anchor_t = time.perf_counter(), t
+        self.cursor = len(self.log.events)
+        # Keep answering repeated writes until the run ends
+        self._wait(lambda: False)
+
+    def begin_run(self):
+        """Replay the log from the start, ports the drivers already have open count as its initial opens"""
+        self.stop()
+        with self.cv:
+            self._reset()
+            for name, ser in self.ports.items():
+                if ser.is_open and name in self.log.ports:
+                    port = self.log.ports.index(name)
+                    hosts = self.host_events[port]
+                    if hosts and self.log.events[hosts[0]][1] == OPEN:
+                        self.status[hosts[0]] = DONE
+                        self.pos[port] = 1
+            self.armed = True
+            self._stop = False
+        self._thread = threading.Thread(target=self._run, name='serial replay', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self.cv:
+            self.armed = False
+            self._stop = True
+            self.cv.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def end_run(self):
+        """
+        Returns
+        -------
+        dict
+            events, replayed, mismatches, repeats, skipped, dropped, stalled and wall time of the replayed run
+        """
+        self.stop()
+        result = {'events': len(self.log.events), 'replayed': self.cursor, 'mismatches': self.mismatches,
+                  'repeats': self.repeats, 'skipped': self.skipped, 'dropped': self.dropped,
+                  'stalled': self.stalled, 'wall': time.perf_counter() - self.started}
+        logger.info('Replayed %(replayed)d of %(events)d serial events in %(wall).3fs, %(mismatches)d mismatched, '
+                    '%(repeats)d repeated and %(skipped)d skipped writes, %(dropped)d bytes dropped', result)
+        return result
+
+
+class SerialSessions:
+    """
+    Opens the drivers' serial ports, plain, recorded or replayed.
+
+    Drivers open their ports with serials.open() in place of serial.Serial().  After record(),
+    everything done on the ports between begin_run() and end_run() is logged and end_run() saves
+    it; after replay(), the ports are ReplaySerials served from a recorded log.
+    """
+    def __init__(self):
+        self.mode = None  # None, 'record' or 'replay'
+        self.session = None  # ReplaySession
+        self.log = None  # SerialLog of the run being recorded
+        self._lock = threading.Lock()
+        self._t0 = 0.0
+        self._open = {}  # port name: most recently opened RecordingSerial
+
+    def record(self):
+        self.mode = 'record'
+        return self
+
+    def replay(self, path, speed=0.0):
+        self.session = ReplaySession(SerialLog.load(path), speed)
+        self.mode = 'replay'
+        return self.session
+
+    def replay_from_env(self):
+        """
+        ReplaySession configured by TTATP_REPLAY, None when it is not set.
+
+        TTATP_REPLAY is a session log path, optionally followed by ',speed=S', S 1 for the recorded
+        timing and 0 (default) as fast as possible
+        """
+        value = os.environ.get(REPLAY_ENV)
+        if not value:
+            return None
+        path, _, options = value.partition(',')
+        speed = 0.0
+        for item in filter(None, options.split(',')):
+            key, _, arg = (x.strip() for x in item.partition('='))
+            if key != 'speed':
+                raise Exception('Unknown %s setting "%s", use speed' % (REPLAY_ENV, key))
+            speed = float(arg)
+        return self.replay(os.path.expanduser(path), speed)
+
+    def open(self, **kwargs):
+        """serial.Serial(**kwargs), or its recording or replay stand-in"""
+        if self.mode == 'replay':
+            return self.session.open(**kwargs)
+        ser = serial.Serial(**kwargs)
+        if self.mode == 'record':
+            ser = self._open[ser.port] = RecordingSerial(ser, self)
+            self.log_event(ser.port, OPEN)
+        return ser
+
+    def log_event(self, port, kind, data=b''):
+        with self._lock:
+            if self.log is not None:
+                self.log.events.append((time.perf_counter() - self._t0, kind, self.log.port_index(port), bytes(data)))
+
+    def begin_run(self):
+        if self.mode == 'record':
+            with self._lock:
+                self.log = SerialLog()
+                self._t0 = time.perf_counter()
+            # Ports opened before the run start it, so a replay knows they are open
+            for port, ser in self._open.items():
+                if ser.is_open:
+                    self.log_event(port, OPEN)
+        elif self.mode == 'replay':
+            self.session.begin_run()
+
+    def end_run(self, path=None, **meta):
+        """
+        Stop recording and save the run's SerialLog to path with meta in its header, or end the replayed run.
+
+        Returns
+        -------
+        SerialLog or dict
+            The recorded log, or the ReplaySession.end_run() result
+        """
+        if self.mode == 'replay':
+            return self.session.end_run()
+        with self._lock:
+            log, self.log = self.log, None
+        if log is not None and path is not None:
+            log.meta.update(meta)
+            log.save(path)
+        return log
+
+
+serials = SerialSessions()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src.serialrec', description='Summarize a recorded serial session')
+    parser.add_argument('log')
+    parser.add_argument('--dump', action='store_true', help='print every event')
+    args = parser.parse_args(argv)
+    log = SerialLog.load(os.path.expanduser(args.log))
+    print(json.dumps(log.meta))
+    print('%d events over %.3fs' % (len(log.events), log.duration))
+    for port, kind, n, size in log.summary():
+        print('%-16s %s %6d events %9d bytes' % (port, kind, n, size))
+    if args.dump:
+        for t, kind, port, data in log.events:
+            print('%10.6f %-16s %s %s' % (t, log.ports[port], chr(kind), data[:32].hex(' ') + (' ...' if len(data) > 32 else '')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" This module provides the hardware-free simulation backend, a simulated coprocessor and DUT for the Fixture to connect to """
+
+import logging
+import os
+import numpy as np
+
+from src.mockstm32 import MockStm32CoProcessor
+from src.mockdut import MockDutTx, RlcModel
+
+logger = logging.getLogger(__name__)
+
+
+SIM_ENV = 'TTATP_SIM'  # set to run the ATP against the simulation, see Simulation.from_env()
+SIM_SERIAL = 'simulation'  # RPi serial reported in simulation, maps to the simulated ATS name in config.csv
+
+
+class Simulation:
+    """
+    Simulated coprocessor and DUT on pseudo-terminals, wired so the coprocessor's Vdut and boot pin
+    drive the DUT and its captures and rail readings come from the DUT's RLC output stage.
+
+    Every next_dut() swaps in a new blank DUT with component values spread over their tolerance,
+    fail_rate of them with one tuning inductor at half value.
+    """
+    def __init__(self, seed=None, fail_rate=0.0, framed=False, **dut_kw):
+        self.rng = np.random.default_rng(seed)
+        self.fail_rate = fail_rate
+        self.dut = MockDutTx(self.sample_model(), uid=self.sample_uid(), rng=self.rng, **dut_kw)
+        self.stm = MockStm32CoProcessor(capture_model=self.dut.capture, framed=framed, rails_model=self.dut.rails,
+                                        on_output=self.dut.on_fixture_output)
+        self.duts = 0
+
+    @classmethod
+    def from_env(cls, **kw):
+        """
+        Simulation configured by TTATP_SIM, None when it is not set.
+
+        TTATP_SIM is '1', or comma separated key=value settings, e.g. 'seed=1,fail_rate=0.1'.
+        kw are further settings from the station config, e.g. framed.
+        """
+        value = os.environ.get(SIM_ENV)
+        if not value or value == '0':
+            return None
+        for item in value.split(','):
+            if '=' in item:
+                key, arg = (x.strip() for x in item.split('=', 1))
+                if key not in ('seed', 'fail_rate'):
+                    raise Exception('Unknown %s setting "%s", use seed and fail_rate' % (SIM_ENV, key))
+                kw[key] = int(arg) if key == 'seed' else float(arg)
+        return cls(**kw)
+
+    @property
+    def stm_port(self):
+        return self.stm.port
+
+    @property
+    def dut_port(self):
+        return self.dut.port
+
+    def start(self):
+        self.stm.start()
+        self.dut.start()
+        logger.info('Simulated coprocessor on %s, DUT on %s', self.stm_port, self.dut_port)
+        return self
+
+    def stop(self):
+        self.stm.stop()
+        self.dut.stop()
+
+    def sample_uid(self):
+        return ''.join(str(d) for d in self.rng.integers(0, 10, 30))
+
+    def sample_model(self):
+        model = RlcModel.sample(self.rng)
+        if self.rng.random() < self.fail_rate:
+            i = self.rng.integers(len(model.inductors))
+            model.inductors[i] *= 0.5
+            logger.info('Simulated DUT has L%d at half value', i + 1)
+        return model
+
+    def next_dut(self):
+        """Put the next blank DUT in the fixture"""
+        self.duts += 1
+        self.dut.replace(self.sample_model(), self.sample_uid())
+        return self.dut.uid
@@ -0,0 +1,302 @@
+""" This module provides a client for the STM32 factory ROM UART bootloader (ST AN3155) """
+
+import logging
+import struct
+import time
+import zlib
+import serial
+from src.serialrec import serials
+
+logger = logging.getLogger(__name__)
+
+
+ACK = 0x79
+NACK = 0x1F
+SYNC = 0x7F
+
+CMD_GET = 0x00
+CMD_GET_ID = 0x02
+CMD_READ_MEMORY = 0x11
+CMD_GO = 0x21
+CMD_WRITE_MEMORY = 0x31
+CMD_EXTENDED_ERASE = 0x44
+
+FLASH_BASE = 0x08000000
+BLOCK_SIZE = 256  # largest read/write memory transfer
+MASS_ERASE = 0xFFFF
+
+
+def checksum(data):
+    """XOR of all bytes, as appended to addresses and payloads"""
+    x = 0
+    for b in data:
+        x ^= b
+    return x
+
+
+def split_blocks(addr, data, write_align=8):
+    """(address, block) write memory transfers for data, padded with 0xFF to the flash write granularity"""
+    data = bytes(data)
+    if len(data) % write_align:
+        data += b'\xFF' * (write_align - len(data) % write_align)
+    return [(addr + i, data[i:i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+
+
+def split_vector(images, write_align=8):
+    """
+    Hold back the first flash word from the image that starts at FLASH_BASE.
+
+    Returns
+    -------
+    tuple
+        (images without the first flash word, vector bytes or None)
+    """
+    vector = None
+    body = []
+    for addr, data in images:
+        if addr == FLASH_BASE:
+            vector, data = data[:write_align], data[write_align:]
+            addr += write_align
+        body.append((addr, data))
+    return body, vector
+
+
+def page_manifest(images, page_size=2048):
+    """
+    Split images into the flash pages they cover.
+
+    Returns
+    -------
+    dict
+        {page number: (page data padded with 0xFF, CRC-32 of the page data)}
+    """
+    pages = {}
+    for addr, data in images:
+        offset = addr - FLASH_BASE
+        for i in range(offset // page_size, (offset + len(data) - 1) // page_size + 1):
+            page = pages.setdefault(i, bytearray(b'\xFF' * page_size))
+            start = max(offset, i * page_size)
+            end = min(offset + len(data), (i + 1) * page_size)
+            page[start - i * page_size:end - i * page_size] = data[start - offset:end - offset]
+    return {i: (bytes(page), zlib.crc32(page)) for i, page in sorted(pages.items())}
+
+
+class Stm32Bootloader:
+    """
+    STM32 UART bootloader session.
+
+    The bootloader autobauds on the first sync byte after reset and keeps that baud until the
+    next reset, so a whole erase/write/verify runs in one session at the connect baud.
+    """
+    def __init__(self, port, baud=115200, timeout=1, write_align=8, page_size=2048, sync_timeout=1.0):
+        self.port = port
+        self.baud = baud
+        self.timeout = timeout
+        self.sync_timeout = sync_timeout  # covers the DUT boot sequence before the bootloader runs
+        self.write_align = write_align  # flash programming granularity, a double word on STM32G0
+        self.page_size = page_size  # flash erase granularity
+        self.ser = None
+        self.version = None
+        self.commands = None
+
+    def connect(self):
+        self.ser = serials.open(port=self.port, baudrate=self.baud, parity=serial.PARITY_EVEN,
+                                stopbits=serial.STOPBITS_ONE, timeout=self.timeout)
+        self.ser.reset_input_buffer()
+        self.sync(self.sync_timeout)
+        self.version, self.commands = self.get()
+
+    def disconnect(self):
+        self.ser.flush()
+        self.ser.close()
+
+    def sync(self, timeout=1.0, interval=0.02):
+        """Send sync bytes until the bootloader answers, it only listens once the DUT has booted into it"""
+        deadline = time.time() + timeout
+        while True:
+            self.ser.write(bytes([SYNC]))
+            t_retry = time.time() + interval
+            while not self.ser.in_waiting and time.time() < t_retry:
+                time.sleep(0.001)
+            rx = self.ser.read(self.ser.in_waiting)
+            # NACK means the bootloader already locked its baud in an earlier session
+            if rx and rx[-1] in (ACK, NACK):
+                return
+            if time.time() >= deadline:
+                raise TimeoutError('No response from bootloader on %s at %d baud' % (self.port, self.baud))
+
+    def _wait_ack(self, what, timeout=None):
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        rx = self.ser.read(1)
+        while not rx and time.time() < deadline:
+            rx = self.ser.read(1)
+        if not rx:
+            raise TimeoutError('Bootloader did not acknowledge %s' % what)
+        if rx[0] == NACK:
+            raise Exception('Bootloader rejected %s' % what)
+        if rx[0] != ACK:
+            raise Exception('Bootloader sent 0x%02X instead of ACK for %s' % (rx[0], what))
+
+    def _read_exact(self, n):
+        rx = self.ser.read(n)
+        if len(rx) != n:
+            raise TimeoutError(f"Expected {n} bytes, received {len(rx)}")
+        return rx
+
+    def _command(self, cmd):
+        self.ser.write(bytes([cmd, cmd ^ 0xFF]))
+        self._wait_ack('command 0x%02X' % cmd)
+
+    def _send_address(self, addr):
+        tx = struct.pack('>I', addr)
+        self.ser.write(tx + bytes([checksum(tx)]))
+        self._wait_ack('address 0x%08X' % addr)
+
+    def get(self):
+        """Return the bootloader version and its supported command codes"""
+        self._command(CMD_GET)
+        n = self._read_exact(1)[0]
+        rx = self._read_exact(n + 1)
+        self._wait_ack('get')
+        return rx[0], list(rx[1:])
+
+    def get_id(self):
+        """Return the product ID, e.g. 0x466 for STM32G03x/G04x"""
+        self._command(CMD_GET_ID)
+        n = self._read_exact(1)[0]
+        rx = self._read_exact(n + 1)
+        self._wait_ack('get ID')
+        return int.from_bytes(rx, 'big')
+
+    def read_memory(self, addr, length):
+        data = bytearray()
+        while len(data) < length:
+            n = min(BLOCK_SIZE, length - len(data))
+            self._command(CMD_READ_MEMORY)
+            self._send_address(addr + len(data))
+            self.ser.write(bytes([n - 1, (n - 1) ^ 0xFF]))
+            self._wait_ack('read length %d' % n)
+            data.extend(self._read_exact(n))
+        return bytes(data)
+
+    def write_memory(self, addr, data):
+        """Write data in BLOCK_SIZE blocks, padded with 0xFF to the flash write granularity"""
+        self.write_blocks(split_blocks(addr, data, self.write_align))
+
+    def write_blocks(self, blocks):
+        """Write (address, block) transfers as made by split_blocks()"""
+        for addr, block in blocks:
+            self._command(CMD_WRITE_MEMORY)
+            self._send_address(addr)
+            tx = bytes([len(block) - 1]) + block
+            self.ser.write(tx + bytes([checksum(tx)]))
+            self._wait_ack('write at 0x%08X' % addr)
+
+    def verify(self, addr, data):
+        return self.read_memory(addr, len(data)) == bytes(data)
+
+    def mass_erase(self, timeout=10):
+        self._command(CMD_EXTENDED_ERASE)
+        tx = struct.pack('>H', MASS_ERASE)
+        self.ser.write(tx + bytes([checksum(tx)]))
+        self._wait_ack('mass erase', timeout)
+
+    def erase_pages(self, pages, timeout=10):
+        self._command(CMD_EXTENDED_ERASE)
+        tx = struct.pack('>H%dH' % len(pages), len(pages) - 1, *pages)
+        self.ser.write(tx + bytes([checksum(tx)]))
+        self._wait_ack('erase of %d pages' % len(pages), timeout)
+
+    def go(self, addr=FLASH_BASE):
+        self._command(CMD_GO)
+        self._send_address(addr)
+
+    def program(self, images, verify=True):
+        """
+        Write and verify images on erased flash, with the first flash word written last.
+
+        The bootloader stays reachable while the word at FLASH_BASE is blank, so an interrupted
+        session leaves the DUT recoverable without the bootchecker trigger.
+
+        Parameters
+        ----------
+        images : list of (int, bytes)
+            (start address, image data) pairs
+        verify : bool
+            Read back each image after writing it and raise if it differs
+        """
+        body, vector = split_vector(images, self.write_align)
+        for addr, data in body:
+            self.write_memory(addr, data)
+            if verify and not self.verify(addr, data):
+                raise Exception('Verify failed for image at 0x%08X' % addr)
+
+        if vector is not None:
+            self.write_memory(FLASH_BASE, vector)
+            if verify and not self.verify(FLASH_BASE, vector):
+                raise Exception('Verify failed for vector word at 0x%08X' % FLASH_BASE)
+
+    def page_manifest(self, images):
+        return page_manifest(images, self.page_size)
+
+    def program_diff(self, images, verify=True, manifest=None):
+        """
+        Erase and rewrite only the flash pages that differ from the images.
+
+        Each page the images cover is read back and its CRC-32 compared with the manifest,
+        matching pages are left alone.  Rewritten pages go through program() so the first
+        flash word is still written last.
+
+        Returns
+        -------
+        list of int
+            Page numbers that were rewritten
+        """
+        manifest = manifest or self.page_manifest(images)
+        stale = []
+        for i, (data, crc) in manifest.items():
+            if zlib.crc32(self.read_memory(FLASH_BASE + i * self.page_size, self.page_size)) != crc:
+                stale.append(i)
+        if not stale:
+            return stale
+
+        self.erase_pages(stale)
+        # Erased flash already reads 0xFF, only write up to the last programmed byte
+        self.program([(FLASH_BASE + i * self.page_size, manifest[i][0].rstrip(b'\xFF')) for i in stale], verify)
+        return stale
+
+    def program_firmware(self, firmware, verify=True, diff=False):
+        """
+        Flash FirmwareImage objects from their precomputed write blocks and page manifests.
+
+        Parameters
+        ----------
+        firmware : list of FirmwareImage
+            Images to write, the first flash word goes last
+        verify : bool
+            Read back each image after writing it and raise if it differs
+        diff : bool
+            Only rewrite pages that differ, see program_diff(), otherwise the flash must be erased
+
+        Returns
+        -------
+        list of int or None
+            Page numbers that were rewritten when diff is True
+        """
+        if diff:
+            manifest = {}
+            for fw in firmware:
+                if manifest.keys() & fw.pages.keys():
+                    raise Exception('Firmware image %s shares flash pages with another image' % fw.name)
+                manifest.update(fw.pages)
+            return self.program_diff([(fw.address, fw.data) for fw in firmware], verify, manifest)
+
+        for fw in firmware:
+            self.write_blocks(fw.blocks)
+            if verify and not self.verify(*fw.body):
+                raise Exception('Verify failed for firmware image %s' % fw.name)
+        for fw in firmware:
+            if fw.vector:
+                self.write_blocks(fw.vector_blocks)
+                if verify and not self.verify(FLASH_BASE, fw.vector):
+                    raise Exception('Verify failed for firmware image %s vector word' % fw.name)
@@ -1,148 +1,436 @@
-import serial
+import asyncio
+import logging
 import struct
 import time
+from typing import NamedTuple
 import numpy as np
+from src.transport import EchoLink, FramedLink, LoopThread, command
+from src.serialrec import serials
 
-class Stm32CoProcessor:
-    def __init__(self, port, baud):
+logger = logging.getLogger(__name__)
+
+LCD_COLS = 16
+ADC_HS_CHANNELS = 4
+ADC_HS_SCALE = 3.3 / 4095
+
+# measure_sweep per-point result kinds
+SWEEP_RAW = 0
+SWEEP_REDUCED = 1
+
+ADC_LS_DIVIDER = 1.5  # DUT rail sense divider on the low speed ADC channels
+
+
+class AdcSnapshot(NamedTuple):
+    """Vdut, Idut and the low speed ADC channels read together"""
+    t: float  # time.time() when the readings were taken
+    vdut: float
+    idut: float
+    adc_ls: tuple
+
+    @property
+    def dut_3v3(self):
+        return self.adc_ls[2] * ADC_LS_DIVIDER
+
+    @property
+    def dut_5v(self):
+        return self.adc_ls[3] * ADC_LS_DIVIDER
+
+
+class AsyncStm32CoProcessor:
+    def __init__(self, port, baud, framed=False):
         self.port = port
         self.baud = baud
+        self.framed = framed
         self.ser = None
+        self.link = None
+        self.stats = None  # CommandStats, set to record per-command latency
 
-    def connect(self):
-        self.ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=1)
-        self.ser.read_all()
+        # Reusable high speed ADC capture buffers, resized only when the capture length changes
+        self._adc_hs_buf = bytearray()
+        self._adc_hs_volts = np.empty(0)
 
-    def disconnect(self):
-        self.ser.flush()
-        self.ser.close()
+        self._snapshot = None  # last AdcSnapshot, dropped by any write command
 
-    def flush_rx(self):
-        self.ser.read_all()
+        # Shadow of the front panel, None where the display content is unknown
+        self.lcd = [None, None]
+        self.rgb = None
+        self._display_pending = {}
+        self._display_task = None
 
-    def _read_n_bytes(self, n, timeout=1):
-        data = bytearray()
-        start = time.monotonic()
+    async def connect(self):
+        self.ser = serials.open(port=self.port, baudrate=self.baud, timeout=0)
+        self.ser.reset_input_buffer()
+        self.link = FramedLink(self.ser) if self.framed else EchoLink(self.ser)
+        self.invalidate_display()
 
-        while len(data) < n:
-            chunk = self.ser.read(n - len(data))
-            if chunk:
-                data.extend(chunk)
-            else:
-                # read() timed out
-                break
+    async def disconnect(self):
+        await self.flush_display()
+        self.link.close()
+        self.ser.flush()
+        self.ser.close()
 
-            if time.monotonic() - start >= timeout:
-                break
+    async def flush_rx(self):
+        self.link.flush_rx()
 
-        if len(data) != n:
-            raise TimeoutError(f"Expected {n} bytes, received {len(data)}")
-        return bytes(data)
-    
+    async def _read_n_bytes(self, n, timeout=1):
+        return await self.link.read_n_bytes(n, timeout)
 
-    def _write_u32(self, cmd:int, val:int):
-        cmd = cmd | 0x80000000
-        tx_bytes = struct.pack('<II', cmd, val)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
+    async def _read_n_bytes_into(self, buf, timeout=1):
+        return await self.link.read_n_bytes_into(buf, timeout)
 
-        rx = self._read_n_bytes(len(tx_bytes))
-        return struct.unpack('<II', rx)[1]
-    
-    def _write_u8_list(self, cmd:int, vals:list[int]):
+    async def _write_u32(self, cmd:int, val:int):
+        self._snapshot = None
         cmd = cmd | 0x80000000
-        tx_bytes = struct.pack('<I4B', cmd, *vals)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
+        rx = await self.link.transact(struct.pack('<II', cmd, val))
+        return struct.unpack('<II', rx)[1]
 
-        rx = self._read_n_bytes(len(tx_bytes))
+    async def _write_u8_list(self, cmd:int, vals:list[int]):
+        self._snapshot = None
+        cmd = cmd | 0x80000000
+        rx = await self.link.transact(struct.pack('<I4B', cmd, *vals))
         return struct.unpack('<I4B', rx)[-4:]
-    
-    def _read_u32(self, cmd:int):
-        tx_bytes = struct.pack('<II', cmd, 0)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
 
-        rx = self._read_n_bytes(len(tx_bytes))
+    async def _read_u32(self, cmd:int):
+        rx = await self.link.transact(struct.pack('<II', cmd, 0))
         return struct.unpack('<II', rx)[1]
-    
-    def _write_f32(self, cmd:int, val:float):
-        cmd = cmd | 0x80000000
-        tx_bytes = struct.pack('<If', cmd, val)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
 
-        rx = self._read_n_bytes(len(tx_bytes))
+    async def _write_f32(self, cmd:int, val:float):
+        self._snapshot = None
+        cmd = cmd | 0x80000000
+        rx = await self.link.transact(struct.pack('<If', cmd, val))
         return struct.unpack('<If', rx)[1]
-    
-    def _read_f32(self, cmd:int):
-        tx_bytes = struct.pack('<If', cmd, 0)
-        self.ser.write(tx_bytes)
-        self.ser.flush()
 
-        rx = self._read_n_bytes(len(tx_bytes))
+    async def _read_f32(self, cmd:int):
+        rx = await self.link.transact(struct.pack('<If', cmd, 0))
         return struct.unpack('<If', rx)[1]
-    
-    def set_vdut(self, voltage:float):
-        return self._write_f32(1, voltage)
-    
-    def measure_vdut(self):
-        return self._read_f32(2)
-    
-    def measure_idut(self):
-        return self._read_f32(3)
-    
-    def set_rgb_str(self, rgb:str):
+
+    @command
+    async def set_vdut(self, voltage:float):
+        return await self._write_f32(1, voltage)
+
+    @command
+    async def measure_vdut(self):
+        return await self._read_f32(2)
+
+    @command
+    async def measure_idut(self):
+        return await self._read_f32(3)
+
+    def invalidate_display(self):
+        """Forget the front panel shadow, e.g. after a coprocessor reset, so the next writes are sent"""
+        self.lcd = [None, None]
+        self.rgb = None
+
+    @command
+    async def set_rgb_str(self, rgb:str):
         rgb = int(rgb[1:], 16)
-        return self._write_u32(4, rgb)
-    
-    def set_lcd_text(self, text:str, row=0, col=0, full_line=True):
-        if len(text)+col > 16:
+        if rgb == self.rgb:
+            return rgb
+        self.rgb = None
+        self.rgb = await self._write_u32(4, rgb)
+        return self.rgb
+
+    @staticmethod
+    def check_lcd_text(text:str, row=0, col=0, full_line=True):
+        """Validate an LCD write and return the text as sent"""
+        if len(text)+col > LCD_COLS:
             raise Exception('String too long to fit on LCD at given position: %s at column %d' % (text, col))
-        
+
         if row > 1 or row < 0:
             raise Exception('Row number must be 0 or 1: received %d' % row)
-        
+
         if full_line:
-            text = text[:16].ljust(16)
+            text = text[:LCD_COLS].ljust(LCD_COLS)
+        return text
 
+    @command
+    async def set_lcd_text(self, text:str, row=0, col=0, full_line=True):
+        """Write text to an LCD row, only the characters that differ from the shadow are sent"""
+        text = self.check_lcd_text(text, row, col, full_line)
+        old = self.lcd[row]
+        if old is not None:
+            new = (old[:col] + text + old[col + len(text):])[:LCD_COLS]
+        elif col == 0 and len(text) >= LCD_COLS:
+            new = text[:LCD_COLS]
+        else:
+            new = None
+
+        if old is not None:
+            changed = [i for i in range(LCD_COLS) if old[i] != new[i]]
+            if not changed:
+                return
+            col, text = changed[0], new[changed[0]:changed[-1] + 1]
+
+        self.lcd[row] = None  # unknown until the write is acknowledged
         tx_bytes = struct.pack('<BB', col, row)
         tx_bytes = tx_bytes + text.encode('utf-8')
 
-        self._write_u32(5, len(tx_bytes))
-        self.ser.write(tx_bytes)
-        self._read_n_bytes(8)
+        await self._write_u32(5, len(tx_bytes))
+        self.link.write(tx_bytes)
+        await self._read_n_bytes(8)
+        self.lcd[row] = new
 
-    def set_fp_led_state(self, state=True):
+    def post_display(self, key, coro_fn, *args):
+        """
+        Queue a front panel update to run when the link is idle, replacing any pending update
+        with the same key.  Call on the driver loop.
+        """
+        self._display_pending.pop(key, None)
+        self._display_pending[key] = (coro_fn, args)
+        if self._display_task is None:
+            self._display_task = asyncio.get_running_loop().create_task(self._display_worker())
+
+    async def _display_worker(self):
+        try:
+            while self._display_pending:
+                # Yield to measurement commands, display updates only take an idle link
+                while self.link.lock.locked():
+                    await asyncio.sleep(0.002)
+                key = next(iter(self._display_pending))
+                coro_fn, args = self._display_pending.pop(key)
+                try:
+                    await coro_fn(*args)
+                except Exception as ex:
+                    logger.warning('Display update %s failed: %s', key, ex)
+        finally:
+            self._display_task = None
+
+    async def flush_display(self):
+        """Wait for queued front panel updates to be sent"""
+        while self._display_task is not None:
+            await asyncio.shield(self._display_task)
+
+    @command
+    async def set_fp_led_state(self, state=True):
         if state:
-            return self._write_u32(6, 1)
+            return await self._write_u32(6, 1)
         else:
-            return self._write_u32(6, 0)
-        
-    def set_dout_state(self, dout_num, state):
+            return await self._write_u32(6, 0)
+
+    @command
+    async def set_dout_state(self, dout_num, state):
         if state:
-            return self._write_u8_list(7, [dout_num, 1, 0, 0])
+            return await self._write_u8_list(7, [dout_num, 1, 0, 0])
         else:
-            return self._write_u8_list(7, [dout_num, 0, 0, 0])
-        
-    def get_din_state(self, dout_num):
-        return self._write_u32(8, dout_num)
-    
-    def measure_adc_ls(self):
-        rx_len = self._read_u32(9)
-        rx = self._read_n_bytes(rx_len)
+            return await self._write_u8_list(7, [dout_num, 0, 0, 0])
+
+    @command
+    async def get_din_state(self, dout_num):
+        return await self._write_u32(8, dout_num)
+
+    @command
+    async def measure_adc_ls(self):
+        return await self._measure_adc_ls()
+
+    async def _measure_adc_ls(self):
+        rx_len = await self._read_u32(9)
+        rx = await self._read_n_bytes(rx_len)
         count = rx_len // 4
         values = struct.unpack('<' + 'f' * count, rx)
         return values
-    
-    def measure_adc_hs(self):
-        rx_len = self._read_u32(10)
-        rx = self._read_n_bytes(rx_len)
-        count = rx_len // 2
-        values = struct.unpack('<' + 'H' * count, rx)
-        adc_data: np.ndarray = np.array(values, dtype=np.uint16) * (3.3 / 4095)
-        num_channels = 4
-        adc_reshaped = adc_data.reshape(-1, num_channels).T
-        return adc_reshaped
-
-        
+
+    @command
+    async def measure_snapshot(self, max_age=0):
+        """
+        Read Vdut, Idut and the low speed ADC channels in one exchange on the link.
+
+        Parameters
+        ----------
+        max_age : float
+            Return the previous snapshot if it is at most this old (s), a write command
+            since then always forces a new one
+
+        Returns
+        -------
+        AdcSnapshot
+        """
+        if self._snapshot is not None and time.time() - self._snapshot.t <= max_age:
+            return self._snapshot
+        t = time.time()
+        # One round trip on a framed link, the three requests are in flight together
+        rx_vdut, rx_idut, rx_len = await self.link.transact_many(
+            [(struct.pack('<If', 2, 0), None), (struct.pack('<If', 3, 0), None), (struct.pack('<II', 9, 0), None)])
+        vdut = struct.unpack('<If', rx_vdut)[1]
+        idut = struct.unpack('<If', rx_idut)[1]
+        rx_len = struct.unpack('<II', rx_len)[1]
+        adc_ls = struct.unpack('<%df' % (rx_len // 4), await self._read_n_bytes(rx_len))
+        self._snapshot = AdcSnapshot(t, vdut, idut, adc_ls)
+        return self._snapshot
+
+    @command
+    async def measure_adc_hs(self, raw=False, channel=None):
+        """
+        Capture the high speed ADC channels.
+
+        The capture is read straight into a reusable buffer and returned as views of it,
+        so the returned arrays are overwritten by the next call.  Copy them if they need to
+        outlive the next capture.
+
+        Parameters
+        ----------
+        raw : bool
+            Return uint16 ADC counts instead of volts, skipping the float conversion
+        channel : int or None
+            Return only this channel as a 1D array instead of all channels
+
+        Returns
+        -------
+        ndarray
+            (ADC_HS_CHANNELS, N) array, or (N,) array if channel is given
+        """
+        rx_len = await self._read_u32(10)
+        if len(self._adc_hs_buf) != rx_len:
+            self._adc_hs_buf = bytearray(rx_len)
+            self._adc_hs_volts = np.empty(rx_len // 2, dtype=np.float64)
+        await self._read_n_bytes_into(self._adc_hs_buf)
+
+        counts = np.frombuffer(self._adc_hs_buf, dtype='<u2')
+        channels = counts.reshape(-1, ADC_HS_CHANNELS).T
+        if raw:
+            return channels if channel is None else channels[channel]
+
+        if channel is None:
+            np.multiply(counts, ADC_HS_SCALE, out=self._adc_hs_volts)
+            return self._adc_hs_volts.reshape(-1, ADC_HS_CHANNELS).T
+
+        volts = self._adc_hs_volts[:channels.shape[1]]
+        np.multiply(channels[channel], ADC_HS_SCALE, out=volts)
+        return volts
+
+    async def measure_sweep(self, pers, ccrs, f_targets, reduce=False):
+        """
+        Run a whole DUT PWM sweep plan on the coprocessor in one command.
+
+        The plan is sent when iteration starts and the coprocessor streams back one framed
+        result per point, so the caller can process each point as it arrives.  The link is
+        held for the whole sweep.
+
+        Only MockStm32CoProcessor implements command 11 so far.  The deployed firmware lacks it
+        and cannot step the DUT PWM, which DutTx sets over the DUT UART, so MeasureResonance.sweep
+        still steps the points itself.
+
+        Parameters
+        ----------
+        pers, ccrs : sequence of int
+            PWM period and compare values for each point, in 64 MHz timer counts
+        f_targets : sequence of float
+            Tone frequency (Hz) for each point, used when reduce is True
+        reduce : bool
+            Have the coprocessor reduce each capture to (dft, iout rms, isense rms) volts
+            instead of returning the raw ADC counts
+
+        Returns
+        -------
+        async generator
+            Yields a (ADC_HS_CHANNELS, N) uint16 array, or a (dft, rms, isense) tuple, per point
+        """
+        plan = struct.pack('<HH', len(pers), SWEEP_REDUCED if reduce else SWEEP_RAW)
+        for per, ccr, ft in zip(pers, ccrs, f_targets):
+            plan += struct.pack('<HHf', int(per), int(ccr), float(ft))
+
+        async with self.link.lock:
+            await self._write_u32(11, len(plan))
+            self.link.write(plan)
+
+            received = 0
+            try:
+                for i in range(len(pers)):
+                    index, kind, rx = await self._read_sweep_frame()
+                    received += 1
+                    if index != i:
+                        self.link.flush_rx()
+                        raise Exception('Sweep frame out of order: expected point %d, received %d' % (i, index))
+
+                    if kind == SWEEP_REDUCED:
+                        yield struct.unpack('<fff', rx)
+                    else:
+                        yield np.frombuffer(rx, dtype='<u2').reshape(-1, ADC_HS_CHANNELS).T
+            except GeneratorExit:
+                # Sweep abandoned early, drain the remaining points so the link stays in sync
+                for i in range(received, len(pers)):
+                    await self._read_sweep_frame()
+                raise
+
+    async def _read_sweep_frame(self):
+        index, kind, rx_len = struct.unpack('<HHI', await self._read_n_bytes(8))
+        return index, kind, await self._read_n_bytes(rx_len)
+
+
+class Stm32CoProcessor:
+    """
+    Blocking wrapper around AsyncStm32CoProcessor, commands run on the shared driver event loop.
+
+    With background_display set, set_lcd_text and set_rgb_str return immediately and the
+    update is sent once the link is idle, flush_display() waits for them.
+    """
+    def __init__(self, port, baud, framed=False, background_display=False):
+        self.aio = AsyncStm32CoProcessor(port, baud, framed)
+        self.loop = LoopThread.shared()
+        self.background_display = background_display
+
+    @property
+    def port(self):
+        return self.aio.port
+
+    @property
+    def ser(self):
+        return self.aio.ser
+
+    @property
+    def link(self):
+        return self.aio.link
+
+    def connect(self):
+        self.loop.run(self.aio.connect())
+
+    def disconnect(self):
+        self.loop.run(self.aio.disconnect())
+
+    def flush_rx(self):
+        self.loop.run(self.aio.flush_rx())
+
+    def set_vdut(self, voltage:float):
+        return self.loop.run(self.aio.set_vdut(voltage))
+
+    def measure_vdut(self):
+        return self.loop.run(self.aio.measure_vdut())
+
+    def measure_idut(self):
+        return self.loop.run(self.aio.measure_idut())
+
+    def set_rgb_str(self, rgb:str):
+        if self.background_display:
+            int(rgb[1:], 16)  # raise on a bad color before queueing
+            return self.loop.post(self.aio.post_display, 'rgb', self.aio.set_rgb_str, rgb)
+        return self.loop.run(self.aio.set_rgb_str(rgb))
+
+    def set_lcd_text(self, text:str, row=0, col=0, full_line=True):
+        if self.background_display:
+            self.aio.check_lcd_text(text, row, col, full_line)
+            key = ('lcd', row, col, full_line)
+            return self.loop.post(self.aio.post_display, key, self.aio.set_lcd_text, text, row, col, full_line)
+        return self.loop.run(self.aio.set_lcd_text(text, row, col, full_line))
+
+    def flush_display(self):
+        self.loop.run(self.aio.flush_display())
+
+    def set_fp_led_state(self, state=True):
+        return self.loop.run(self.aio.set_fp_led_state(state))
+
+    def set_dout_state(self, dout_num, state):
+        return self.loop.run(self.aio.set_dout_state(dout_num, state))
+
+    def get_din_state(self, dout_num):
+        return self.loop.run(self.aio.get_din_state(dout_num))
+
+    def measure_adc_ls(self):
+        return self.loop.run(self.aio.measure_adc_ls())
+
+    def measure_snapshot(self, max_age=0):
+        return self.loop.run(self.aio.measure_snapshot(max_age))
+
+    def measure_adc_hs(self, raw=False, channel=None):
+        return self.loop.run(self.aio.measure_adc_hs(raw, channel))
+
+    def measure_sweep(self, pers, ccrs, f_targets, reduce=False):
+        return self.loop.iterate(self.aio.measure_sweep(pers, ccrs, f_targets, reduce))
@@ -2,6 +2,7 @@
 import logging
 import subinitial.automation as automation
 from src.fixture import *
+from src.profiler import profiler, profile_step
 
 from pathlib import Path
 import re
@@ -40,29 +41,37 @@ logger = logging.getLogger(__name__)
 #         # Safely return to normal state after procedure (runs even if procedure exits early due to an error)
 #         pass
 
+@profile_step
 class DutDetect(automation.Step):
     class Data:
         def __init__(data):
             # Config Fields
             data.vdut = 0.5
             data.min_threshold = 0.25
+            data.settle_timeout = 0.5
 
             # Measurements
             data.measurement: float = None
+            data.settle_time: float = None
     
     def criteria(self, data: Data):
+        self.assert_record('Settle Time', data.settle_time, units='s')
         self.assert_greaterthan('DUT 5V Sense', measurement=data.measurement, min=data.min_threshold, units='V')
 
     def procedure(self, data: Data):
         fixture.stm.set_lcd_text('Detecting DUT', 1)
         fixture.stm.set_vdut(data.vdut)
-        time.sleep(0.1)
-        data.measurement = fixture.measure_tx_5v()
+        # A flat reading still below the threshold may be the rail before it starts rising
+        (data.measurement,), data.settle_time, settled = fixture.settle(lambda: (fixture.snapshot(max_age=0).dut_5v,), tol=0.02, timeout=data.settle_timeout,
+                                                                         until=lambda r: r[0] > data.min_threshold)
+        if not settled:
+            self.report_info('DUT 5V sense did not settle within %.2fs' % data.settle_timeout)
     
     def teardown(self, data: Data):
         fixture.stm.set_vdut(0)
 
 
+@profile_step
 class PowerUp(automation.Step):
     class Data:
         def __init__(data, imax=0.5, boot=False, lcd='Power Up'):
@@ -84,13 +93,18 @@ class PowerUp(automation.Step):
             data.boot = boot
             data.lcd = lcd
 
+            data.settle_dwell = 0.05
+            data.settle_timeout = 1.0
+
             # Measurements
             data.dut_5v: float = None
             data.dut_3v3: float = None
             data.idut: float = None
             data.vdut: float = None
+            data.settle_time: float = None
     
     def criteria(self, data: Data):
+        self.assert_record('Settle Time', data.settle_time, units='s')
         self.assert_inrange('Measured Vdut', data.vdut, data.vdut_min, data.vdut_max, units='V')
         self.assert_inrange('Measured Idut', data.idut, data.idut_min, data.idut_max, units='A')
         self.assert_inrange('DUT 5V', data.dut_5v, data.dut_5v_min, data.dut_5v_max, units='V')
@@ -103,117 +117,100 @@ class PowerUp(automation.Step):
         else:
             fixture.stm.set_dout_state(2, 1)
         fixture.stm.set_vdut(data.vdut_set)
-        time.sleep(0.1)
-        if data.boot:
-            time.sleep(0.3)
-        data.idut = fixture.stm.measure_idut()
-        data.vdut = fixture.stm.measure_vdut()
-        data.dut_5v = fixture.measure_tx_5v()
-        data.dut_3v3 = fixture.measure_tx_3v3()
+        # In boot mode the flash step's bootloader sync waits out the bootchecker
+        # Flat is not enough, the rails also read flat before the supply starts ramping
+        rails, data.settle_time, settled = fixture.settle(dwell=data.settle_dwell, timeout=data.settle_timeout,
+                                                          until=lambda r: data.vdut_min <= r[0] <= data.vdut_max and r[2] >= data.dut_3v3_min)
+        if not settled:
+            self.report_info('DUT rails did not settle within %.2fs' % data.settle_timeout)
+        data.vdut, data.idut, data.dut_3v3, data.dut_5v = rails
     
     def teardown(self, data: Data):
-        fixture.stm.set_vdut(0)
-        time.sleep(0.3)
+        fixture.power_down()
 
 
 
-class EraseAll(automation.Step):
-    class Data:
-        def __init__(data):
-            # Measurements
-            data.erase_result: bool = None
-            data.retry_attemped: bool = False
-    
-    def criteria(self, data: Data):
-        self.assert_record('Retry Attemped', data.retry_attemped)
-        self.assert_true('Erase Success', data.erase_result)
-
-    def procedure(self, data: Data):
-        fixture.stm.set_lcd_text('Erase Flash', 1)
-        PORT = "/dev/ttyAMA3"
-        res = fixture.run_rpi(["stm32flash", "-o", PORT])
-        if res.returncode == 0:
-            data.erase_result = True
-        else:
-            data.erase_result = False
-
-        if data.erase_result is False:
-            self.report_info('Retrying...')
-            data.retry_attemped = True
-            fixture.stm.set_vdut(0)
-            fixture.stm.set_lcd_text('Flash Erase 2', 1)
-            time.sleep(0.5)
-            fixture.stm.set_vdut(5.0)
-            res = fixture.run_rpi(["stm32flash", "-o", PORT])
-            if res.returncode == 0:
-                data.erase_result = True
-            else:
-                data.erase_result = False
-
-
-class FlashMain(automation.Step):
+@profile_step
+class FlashDut(automation.Step):
     class Data:
         def __init__(data):
             # Config Fields
-            data.bin_path = "tx/stm32/RCTF_WFTX_REVA_STM32G030C8T6.bin"
+            data.boot_image = 'bootchecker'  # config.csv Firmware table names
+            data.main_image = 'main'
+            data.baud = 1000000
+            data.retry_baud = 230400
+            data.pid = 0x466  # STM32G03x/G04x
+            data.sync_timeout = 1.0  # DUT boot sequence before the bootloader answers
+            data.diff = False  # only rewrite pages that differ, for rework lots already carrying firmware
 
             # Measurements
+            data.dut_pid = None
+            data.pages_written = None
             data.flash_result: bool = None
             data.retry_attemped: bool = False
-    
+            data.flash_time = None
+
     def criteria(self, data: Data):
         self.assert_record('Retry Attemped', data.retry_attemped)
-        self.assert_true('Flash Main', data.flash_result)
+        self.assert_record('Flash Time', data.flash_time, units='s')
+        if data.diff:
+            self.assert_record('Pages Written', data.pages_written)
+        self.assert_record('Device ID', None if data.dut_pid is None else '0x%03X' % data.dut_pid)
+        for name in (data.boot_image, data.main_image):
+            self.assert_record('%s SHA-256' % name, firmware[name].sha256 if name in firmware else None)
+        self.assert_true('Flash DUT', data.flash_result)
 
     def procedure(self, data: Data):
-        fixture.stm.set_lcd_text('Flash Main', 1)
-        PORT = "/dev/ttyAMA3"
+        fixture.stm.set_lcd_text('Flash DUT', 1)
+        images = [firmware[data.boot_image], firmware[data.main_image]]
 
-        res = fixture.run_rpi(["stm32flash", "-b", "1000000", "-w", data.bin_path, "-v", "-S", "0x08000800", PORT])
-        if res.returncode == 0:
-            data.flash_result = True
-        else:
-            data.flash_result = False
+        t_start = time.time()
+        data.flash_result = self.flash(data, data.baud, images)
 
         if data.flash_result is False:
             self.report_info('Retrying...')
             data.retry_attemped = True
-            fixture.stm.set_vdut(0)
-            fixture.stm.set_lcd_text('Flash Main Retry', 1)
-            time.sleep(0.5)
+            fixture.stm.set_lcd_text('Flash DUT Retry', 1)
+            fixture.power_down()
             fixture.stm.set_vdut(5.0)
-            res = fixture.run_rpi(["stm32flash", "-b", "230400", "-w", data.bin_path, "-v", "-S", "0x08000800", PORT])
-            if res.returncode == 0:
-                data.flash_result = True
-            else:
-                data.flash_result = False
-
-
-
-class FlashBootchecker(automation.Step):
-    class Data:
-        def __init__(data):
-            # Config Fields
-            data.bin_path = "tx/stm32/STM32G030C8T6_RCTF_TTTX_REVA_BOOTCHECKER.bin"
-
-            # Measurements
-            data.flash_result: bool = None
-    
-    def criteria(self, data: Data):
-        self.assert_true('Flash Bootchecker', data.flash_result)
-
-    def procedure(self, data: Data):
-        fixture.stm.set_lcd_text('Flash Bootcheck', 1)
-        PORT = "/dev/ttyAMA3"
+            data.flash_result = self.flash(data, data.retry_baud, images)
+        data.flash_time = time.time() - t_start
 
-        res = fixture.run_rpi(["stm32flash", "-b", "115200", "-w", data.bin_path, "-v", "-S", "0x08000000", PORT])
-        if res.returncode == 0:
-            data.flash_result = True
-        else:
-            data.flash_result = False
+        if data.flash_result is False:
             fixture.stm.set_lcd_text('Manual Erase Req', 1)
 
+    def flash(self, data: Data, baud, images):
+        """Erase, write and verify the images in one bootloader session, the vector word goes last"""
+        fixture.boot.baud = baud
+        fixture.boot.sync_timeout = data.sync_timeout
+        with profiler.timed('serial', 'bootloader'):
+            return self.flash_session(data, images)
+
+    def flash_session(self, data: Data, images):
+        try:
+            fixture.boot.connect()
+        except Exception as ex:
+            self.report_error(ex)
+            return False
+
+        try:
+            data.dut_pid = fixture.boot.get_id()
+            if data.dut_pid != data.pid:
+                raise Exception('Unexpected device ID 0x%03X' % data.dut_pid)
+            if data.diff:
+                data.pages_written = len(fixture.boot.program_firmware(images, diff=True))
+            else:
+                fixture.boot.mass_erase()
+                fixture.boot.program_firmware(images)
+            return True
+        except Exception as ex:
+            self.report_error(ex)
+            return False
+        finally:
+            fixture.boot.disconnect()
+
 
+@profile_step
 class ConnectDutUart(automation.Step):
     class Data:
         def __init__(data):
@@ -230,9 +227,11 @@ class ConnectDutUart(automation.Step):
         fixture.dut.disconnect()
 
 
+@profile_step
 class GetUid(automation.Step):
     class Data:
         def __init__(data):
+            data.timeout = 3.0
             data.uid = None
     
     def criteria(self, data: Data):
@@ -241,27 +240,18 @@ class GetUid(automation.Step):
 
     def procedure(self, data: Data):
         fixture.stm.set_lcd_text('Get UID', 1)
-        t_start = time.time()
-
-        while time.time() - t_start < 3:
-            if fixture.dut.ser.in_waiting > 3:
-                break
-        time.sleep(0.15)
+        uid_pattern = re.compile(r'UID: (\d{30})')
+        found = fixture.dut.wait_for_line(uid_pattern, data.timeout)
 
-        rx = fixture.dut.ser.read_all()
-        # print(rx)
-        rx_str = rx.decode('utf-8')
-        # print(rx_str)
-        match = re.search(r'UID: (\d{30})', rx_str)
-    
-        if match:
-            data.uid = match.group(1)  # Return the UID value
+        if found:
+            data.uid = uid_pattern.search(found[1]).group(1)  # Return the UID value
             fixture.dut_uid = data.uid            
 
     def teardown(self, data: Data):
         pass
 
 
+@profile_step
 class MeasureResonance(automation.Step):
     class Data:
         def __init__(data):
@@ -283,6 +273,14 @@ class MeasureResonance(automation.Step):
 
             data.lfix = 103e-6
 
+            # Adaptive peak search instead of the fixed f_deltas sweep
+            data.adaptive = False
+            data.f_span = 4e3
+            data.f_step = 1e3  # coarse grid, same spacing as f_deltas
+            data.f_min_step = 500.0
+            data.f0_tol = 100.0
+            data.max_points = 9
+
             data.vdut_min = 4.5
             data.vdut_max = 5.5
 
@@ -322,30 +320,12 @@ class MeasureResonance(automation.Step):
         #     print(assr.title, assr.procedural, assr.result)
 
     def procedure(self, data: Data):
+        cache_start = fixture.dsp_cache_info()
+
         # Start with all short to test resonant capacitance
         fixture.stm.set_lcd_text('C_RES', 1)
         fixture.dut.set_tuning(0b1111)  
-        fs = data.cres_ftest + data.f_deltas
-        pers = np.round(64e6 / fs).astype(int)
-        fixture.dut.set_pwm_per_ccr(pers[0], pers[0] // 2)
-        fixture.dut.set_pwm_state(1)
-        ipts = []
-        for i in range(len(fs)):
-            fixture.dut.set_pwm_per_ccr(pers[i], pers[i] // 2)
-            ft = float(fs[i])
-            adc = fixture.stm.measure_adc_hs()
-            iout = adc[0,:]
-            dut_isense = fixture.dut.get_isense()
-            isense = float(np.std(adc[1,:]))
-            rms = float(np.std(iout))
-            freqs, iout_fft = fixture.compute_adc_fft(iout, f_target=ft)
-            dft = float(np.abs(iout_fft[int(ft/freqs[1])]) )
-            ipts.append(dft)
-            self.assert_record('ALL SHORT Data Point', '%d %.1f %.6f %.6f %.6f %.6f' % (0b1111, ft, dft, rms, isense, dut_isense))
-            # print('xxxx', i, pers[i], pers[i]//2, ft, dft, rms)
-
-        fixture.dut.set_pwm_state(0)
-        f0, K, pk_idx = fixture.estimate_peak(fs, ipts)
+        f0, K = self.find_peak(data, 0b1111, 'ALL SHORT', data.cres_ftest)
         data.cres = float((2 * np.pi * f0)**(-2) / data.lfix)
         self.assert_record('ALL SHORT F0', f0, units='Hz')
         self.assert_record('ALL SHORT Ipeak', K, units='A RMS')
@@ -357,35 +337,8 @@ class MeasureResonance(automation.Step):
                 cfg_title = data.lval_titles[i]
                 fixture.stm.set_lcd_text(cfg_title, 1)
                 fixture.dut.set_tuning(data.l_configs[i])  
-                fs = data.f_centers[i] + data.f_deltas
-                pers = np.round(64e6 / fs).astype(int)
-                fixture.dut.set_pwm_per_ccr(pers[0], pers[0] // 2)
-                fixture.dut.set_pwm_state(1)
-                ipts = []
-                for j in range(len(fs)):
-                    fixture.dut.set_pwm_per_ccr(pers[j], pers[j] // 2)
-                    ft = float(fs[j])
-                    adc = fixture.stm.measure_adc_hs()
-                    if ft == data.f_centers[i]:
-                        v5v, v3v3 = fixture.measure_tx_5v_3v3()
-                        data.v5vs[i] = float(v5v)
-                        data.v3v3s[i] = float(v3v3)
-                        data.vduts[i] = float(fixture.stm.measure_vdut())
-                        data.iduts[i] = float(fixture.stm.measure_idut())
-
-                    iout = adc[0,:]
-                    dut_isense = fixture.dut.get_isense()
-                    isense = float(np.std(adc[1,:]))
-                    rms = float(np.std(iout))
-                    freqs, iout_fft = fixture.compute_adc_fft(iout, f_target=ft)
-                    dft = float(np.abs(iout_fft[int(ft/freqs[1])]) )
-                    ipts.append(dft)
-
-                    self.assert_record(cfg_title+' Data Point', '%d %.1f %.6f %.6f %.6f %.6f' % (data.l_configs[i], ft, dft, rms, isense, dut_isense))
-                    # print('xxxx', i, pers[j], pers[j]//2, ft, dft, rms)
-
-                fixture.dut.set_pwm_state(0)
-                f0, K, pk_idx = fixture.estimate_peak(fs, ipts)
+                f0, K = self.find_peak(data, data.l_configs[i], cfg_title, data.f_centers[i],
+                                       on_center=lambda: self.measure_rails(data, i))
                 data.ltunes[i] = float((2 * np.pi * f0)**(-2) / data.cres - data.lfix)
                 data.ktunes[i] = float(K)
                 self.assert_record(cfg_title+' F0', f0, units='Hz')
@@ -408,11 +361,69 @@ class MeasureResonance(automation.Step):
             elif anypass is False:
                 fixture.stm.set_lcd_text('All Ls or Other', 1)
 
+        cache_end = fixture.dsp_cache_info()
+        for name in cache_end:
+            self.report_info('DSP %s cache: %d hits, %d misses' % (name,
+                             cache_end[name].hits - cache_start[name].hits,
+                             cache_end[name].misses - cache_start[name].misses))
+
+    def find_peak(self, data: Data, cfg, cfg_title, f_center, on_center=None):
+        if data.adaptive:
+            # Search the frequencies the PWM period can produce, so the fit sees where each point really is
+            snap = lambda f: 64e6 / np.round(64e6 / f)
+            measure = lambda freqs: self.sweep(cfg, cfg_title, np.asarray(freqs), snap(f_center), on_center)
+            fs, ipts = fixture.search_peak(measure, f_center, data.f_span, data.f_step, data.f_min_step, data.f0_tol,
+                                           data.max_points, snap)
+            self.assert_record(cfg_title+' Sweep Points', len(fs))
+        else:
+            fs = f_center + data.f_deltas
+            ipts = self.sweep(cfg, cfg_title, fs, f_center, on_center)
+        f0, K, pk_idx = fixture.estimate_peak(fs, ipts)
+        return f0, K
+
+    def sweep(self, cfg, cfg_title, fs, f_center=None, on_center=None):
+        """
+        Step the DUT PWM through fs and return the Iout tone amplitude at each point.
+
+        Each capture is analyzed on fixture.dsp_pool while the next point is set up and
+        captured, results are gathered back in sweep order for recording.
+        """
+        pers = np.round(64e6 / fs).astype(int)
+        fixture.dut.set_pwm_per_ccr(pers[0], pers[0] // 2)
+        fixture.dut.set_pwm_state(1)
+        points = []
+        for j in range(len(fs)):
+            fixture.dut.set_pwm_per_ccr(pers[j], pers[j] // 2)
+            ft = float(fs[j])
+            # The capture and the DUT's own current reading are on separate UARTs, run them together
+            capture, dut_isense = fixture.gather(fixture.stm.aio.measure_adc_hs(raw=True), fixture.dut.aio.get_isense())
+            captures.add(capture, step=self.title, cfg=int(cfg), per=int(pers[j]), ft=ft)
+            adc = np.array(capture[:2])  # copy, the capture buffer is reused
+            if on_center is not None and ft == f_center:
+                on_center()
+            points.append((ft, dut_isense, fixture.dsp_pool.submit(fixture.analyze_capture, adc, ft)))
+        fixture.dut.set_pwm_state(0)
+
+        ipts = []
+        for ft, dut_isense, analysis in points:
+            dft, rms, isense = analysis.result()
+            ipts.append(dft)
+            self.assert_record(cfg_title+' Data Point', '%d %.1f %.6f %.6f %.6f %.6f' % (cfg, ft, dft, rms, isense, dut_isense))
+        return ipts
+
+    def measure_rails(self, data: Data, i):
+        snap = fixture.snapshot(max_age=0)  # DUT PWM changes do not invalidate snapshots
+        data.v5vs[i] = snap.dut_5v
+        data.v3v3s[i] = snap.dut_3v3
+        data.vduts[i] = snap.vdut
+        data.iduts[i] = snap.idut
+
     def teardown(self, data):
         if self.result is False:
             fixture.dut.set_factory_test_state(False)
 
 
+@profile_step
 class AutoTune(automation.Step):
     class Data:
         def __init__(data):
@@ -422,8 +433,16 @@ class AutoTune(automation.Step):
             data.dft_max = 0.235
             data.dut_isense_min = 0.21
             data.dut_isense_max = 0.23
+            data.tune_timeout = 3.0
+            data.tune_idle = 0.5  # tuning is done once no relay cfg line arrives for this long
+            data.tune_count = None  # or stop at this many relay cfg lines
+            data.tune_patience = None  # or stop once min |Z| passes and has not improved for this many records
+            data.settle_tol = 0.002  # DUT isense (A RMS) must stay within this band for settle_dwell before capturing
+            data.settle_dwell = 0.2
+            data.settle_timeout = 3.0
 
             # Measurements
+            data.settle_time: float = None
             data.dft: float = None
             data.rms: float = None
             data.isense: float = None
@@ -441,6 +460,7 @@ class AutoTune(automation.Step):
     
     def criteria(self, data: Data):
         self.assert_record('Number Tuning Steps', data.tune_steps)
+        self.assert_record('Settle Time', data.settle_time, units='s')
         for i in range(data.tune_steps):
             self.assert_record('Relay cfg %d Current' % (data.tune_cfgs[i]), data.tune_rms[i], units='A RMS')
             self.assert_record('Relay cfg %d |Z|' % (data.tune_cfgs[i]), data.tune_ohms[i], units='|Ω|')
@@ -451,55 +471,65 @@ class AutoTune(automation.Step):
 
     def procedure(self, data: Data):
         fixture.stm.set_lcd_text('Auto Tune', 1)
-        fixture.dut.flush_rx()
+        fixture.dut.flush_rx()  # also resets the auto tune log
+        tune = fixture.dut.tune
+        since = fixture.dut.line_count
         fixture.dut.set_auto_state(1)
-        time.sleep(3.0)
-
-        rx = fixture.dut.ser.read_all()
-        rx_str = rx.decode('utf-8')
-        # print(rx_str)
-        cfg_pattern = re.compile(r"Relay cfg:\s*(\d+)")
-        ma_pattern = re.compile(r"(\d+)mA")
-        moh_pattern = re.compile(r"(\d+)mOhm")
-        lines = rx_str.split('\n\r')
-        for line in lines:
-            if 'Relay cfg:' in line:
-                # print(line)
-                data.tune_steps += 1
-                cfg = cfg_pattern.search(line)
-                ma = ma_pattern.search(line)
-                moh = moh_pattern.search(line)
-                data.tune_cfgs.append(int(cfg.group(1)) if cfg else None)
-                data.tune_rms.append(float(ma.group(1)) / 1000 if ma else None)
-                data.tune_ohms.append(float(moh.group(1)) / 1000 if moh else None)
-
-
-        z_vals = [z for z in data.tune_ohms if z is not None]
-        data.tune_minz = min(z_vals) if z_vals else None
+
+        # The records are parsed on the driver loop as they arrive, this only waits for them
+        t_end = time.time() + data.tune_timeout
+        while len(tune) != data.tune_count and not self.converged(data, tune):
+            timeout = t_end - time.time()
+            if len(tune):
+                timeout = min(timeout, data.tune_idle)
+            found = fixture.dut.wait_for_line('Relay', max(0, timeout), since)
+            if found is None:
+                break
+            since = found[0] + 1
+
+        if tune.bad_records:
+            self.report_info('%d unreadable relay cfg records' % tune.bad_records)
+        data.tune_steps = len(tune)
+        data.tune_cfgs = tune.cfgs.tolist()
+        data.tune_rms = tune.currents.tolist()
+        data.tune_ohms = tune.ohms.tolist()
+        data.tune_minz = tune.min_z
 
         # print(data.tune_steps)
         # print(data.tune_cfgs)
         # print(data.tune_rms)
         # print(data.tune_ohms)
         
+        # Tuning stops on tune_idle, wait for the output current to settle on the final relay cfg
+        _, data.settle_time, settled = fixture.settle(read=lambda: (fixture.dut.get_isense(),), tol=data.settle_tol,
+                                                      dwell=data.settle_dwell, timeout=data.settle_timeout)
+        if not settled:
+            self.report_info('DUT isense did not settle within %.2fs' % data.settle_timeout)
 
-        adc = fixture.stm.measure_adc_hs()
+        capture = fixture.stm.measure_adc_hs(raw=True)
         ft = data.f_target
+        captures.add(capture, step=self.title, ft=ft)
+        adc = capture * ADC_HS_SCALE
         iout = adc[0,:]
         data.dut_isense = fixture.dut.get_isense()
         data.isense = np.std(adc[1,:])
         data.rms = np.std(iout)
-        freqs, iout_fft = fixture.compute_adc_fft(iout, f_target=ft)
-        data.dft = np.abs(iout_fft[int(ft/freqs[1])])
+        data.dft = np.abs(fixture.compute_adc_tone(iout, f_target=ft))
 
         fixture.dut.set_auto_state(0)
 
+    def converged(self, data: Data, tune):
+        if data.tune_patience is None or tune.min_z is None:
+            return False
+        return tune.min_z < data.z_max and tune.since_min() >= data.tune_patience
+
     def teardown(self, data):
         if self.result is False:
             fixture.dut.set_factory_test_state(False)
 
 
 
+@profile_step
 class WritePass(automation.Step):
     class Data:
         def __init__(data, any_fail='not_assigned'):
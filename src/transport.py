@@ -0,0 +1,529 @@
+""" This module provides the asyncio serial link layers shared by the Stm32CoProcessor and DutTx drivers """
+
+import asyncio
+import binascii
+import functools
+import logging
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from src.profiler import profiler
+
+logger = logging.getLogger(__name__)
+
+
+FRAME_SOF = 0xA5
+FRAME_MORE = 0x01  # more frames follow for this sequence number
+FRAME_HEADER = struct.Struct('<BBBHH')  # sof, flags, seq, part, length
+FRAME_CRC = struct.Struct('<H')
+
+
+def frame_crc(data):
+    """CRC-16/CCITT-FALSE over a frame's header (less the start byte) and payload"""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def encode_frame(seq, part, payload, flags=0):
+    header = FRAME_HEADER.pack(FRAME_SOF, flags, seq, part, len(payload))
+    return header + payload + FRAME_CRC.pack(frame_crc(header[1:] + payload))
+
+
+class FrameDecoder:
+    """Incremental frame decoder, resynchronizes on the next start byte after corruption"""
+    def __init__(self, max_payload=4096, max_unframed=65536):
+        self.max_payload = max_payload
+        self.max_unframed = max_unframed
+        self.buf = bytearray()
+        self.unframed = bytearray()  # bytes seen outside of frames, e.g. DUT log text
+        self.crc_errors = 0
+
+    def reset(self):
+        self.buf.clear()
+        self.unframed.clear()
+
+    def resync(self):
+        """Drop a stalled partial frame, e.g. one with a corrupt length that never completes"""
+        if self.buf:
+            self.crc_errors += 1
+            del self.buf[:1]
+        return self.feed(b'')
+
+    def feed(self, data):
+        """Add received bytes and return the complete frames as (flags, seq, part, payload) tuples"""
+        self.buf.extend(data)
+        frames = []
+        while True:
+            start = self.buf.find(FRAME_SOF)
+            if start < 0:
+                start = len(self.buf)
+            if start:
+                self.unframed.extend(self.buf[:start])
+                del self.buf[:start]
+                del self.unframed[:-self.max_unframed]
+
+            if len(self.buf) < FRAME_HEADER.size:
+                break
+
+            _, flags, seq, part, length = FRAME_HEADER.unpack_from(self.buf)
+            end = FRAME_HEADER.size + length + FRAME_CRC.size
+            if length > self.max_payload:
+                # Corrupt length, drop the start byte and rescan
+                self.crc_errors += 1
+                del self.buf[:1]
+                continue
+            if len(self.buf) < end:
+                break
+
+            crc = FRAME_CRC.unpack_from(self.buf, end - FRAME_CRC.size)[0]
+            if crc != frame_crc(self.buf[1:end - FRAME_CRC.size]):
+                self.crc_errors += 1
+                del self.buf[:1]
+                continue
+
+            frames.append((flags, seq, part, bytes(self.buf[FRAME_HEADER.size:end - FRAME_CRC.size])))
+            del self.buf[:end]
+        return frames
+
+
+def command(method):
+    """
+    Run an async driver command as one exchange, holding the driver link's lock.
+
+    Commands on a link run one at a time, a command that needs several requests can keep them in
+    flight together with the link's transact_many().  When the driver's stats is set, the
+    command's latency once it holds the link, bytes on the wire, timeouts and retransmits are
+    recorded under the method name.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        link = self.link
+        async with link.lock:
+            if self.stats is None:
+                result = await method(self, *args, **kwargs)
+            else:
+                t0 = time.perf_counter()
+                tx, rx, retries = link.tx_bytes, link.rx_bytes, link.retransmits
+                timeout = False
+                try:
+                    result = await method(self, *args, **kwargs)
+                except TimeoutError:
+                    timeout = True
+                    raise
+                finally:
+                    self.stats.record(name, time.perf_counter() - t0, link.tx_bytes - tx, link.rx_bytes - rx,
+                                      timeout, link.retransmits - retries)
+        link.capture_lines()
+        return result
+    return wrapper
+
+
+class LineReader:
+    """
+    Splits text received outside of command responses into lines kept in a bounded ring buffer,
+    so steps can wait on DUT log output instead of polling the port.
+
+    Lines are numbered from 0 in arrival order, count is the number of the next line.
+    """
+    def __init__(self, maxlen=256, max_line=1024):
+        self.lines = deque(maxlen=maxlen)
+        self.max_line = max_line
+        self.count = 0
+        self.partial = bytearray()
+        self.listeners = []  # called on the driver loop with each raw line as it completes
+        self._received = asyncio.Event()
+
+    def feed(self, data):
+        self.partial.extend(data)
+        *complete, rest = self.partial.split(b'\n')
+        for raw in complete:
+            self._append(raw)
+        self.partial = bytearray(rest)
+        if len(self.partial) > self.max_line:
+            self._append(self.partial)
+            self.partial = bytearray()
+
+    def _append(self, raw):
+        raw = bytes(raw).strip()
+        for listener in self.listeners:
+            listener(raw)
+        self.lines.append(raw.decode('utf-8', errors='replace'))
+        self.count += 1
+        self._received.set()
+
+    def find(self, match, since=None):
+        """
+        First buffered line from number since on that matches.
+
+        Parameters
+        ----------
+        match : str, re.Pattern or callable
+            Regex searched in each line, or a predicate called with each line
+        since : int or None
+            Line number to start from, the oldest buffered line by default
+
+        Returns
+        -------
+        tuple or None
+            (line number, line)
+        """
+        if not callable(match):
+            match = re.compile(match).search
+        first = self.count - len(self.lines)
+        start = first if since is None else max(since, first)
+        for i in range(start - first, len(self.lines)):
+            if match(self.lines[i]):
+                return first + i, self.lines[i]
+        return None
+
+    async def wait_for(self, match, timeout=3, since=None):
+        """Wait for a matching line as find(), returns None on timeout"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        since = self.count - len(self.lines) if since is None else since
+        while True:
+            found = self.find(match, since)
+            if found is not None:
+                return found
+            since = self.count
+            self._received.clear()
+            try:
+                await asyncio.wait_for(self._received.wait(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                return self.find(match, since)
+
+
+class LoopThread:
+    """Event loop on a daemon thread, the blocking driver wrappers run their commands on it"""
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='driver-loop', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def run(self, coro):
+        """Run a coroutine on the loop and block until it completes"""
+        with profiler.timed('serial', getattr(coro, '__name__', None)):
+            return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def post(self, fn, *args):
+        """Call fn(*args) on the loop without waiting for it"""
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def gather(self, *coros):
+        """Run coroutines concurrently on the loop and block until all complete"""
+        async def gather():
+            return await asyncio.gather(*coros)
+        return self.run(gather())
+
+    def iterate(self, agen):
+        """Blocking generator over an async generator"""
+        try:
+            while True:
+                try:
+                    yield self.run(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(agen.aclose())
+
+
+class EchoLink:
+    """
+    Raw byte link for the stop-and-wait echo protocol, each command is echoed back in full.
+
+    Created on a running event loop, a reader callback on the loop buffers everything
+    received from the port so reads only wait on the buffer.
+    """
+    def __init__(self, ser):
+        self.ser = ser
+        self.rx = bytearray()
+        self.lock = asyncio.Lock()
+        self.error = None
+        self.lines = None  # LineReader for text received outside of command responses
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.retransmits = 0
+        self._received = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(ser.fileno(), self._on_readable)
+
+    def close(self):
+        self._loop.remove_reader(self.ser.fileno())
+
+    def write(self, data):
+        self._send(data)
+
+    def _send(self, data):
+        self.tx_bytes += len(data)
+        self.ser.write(data)
+
+    def flush_rx(self):
+        self.ser.reset_input_buffer()
+        self.rx.clear()
+
+    def read_all(self):
+        """Return and clear everything received but not yet read"""
+        data = bytes(self.rx)
+        self.rx.clear()
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def capture_lines(self):
+        # Only text received while no command is waiting on a response is log output
+        if self.lines is not None and not self.lock.locked():
+            self.lines.feed(self.read_all())
+
+    async def transact(self, tx_bytes, rx_len=None):
+        """Write a command and read its response, an echo of the same length by default"""
+        self.write(tx_bytes)
+        return await self.read_n_bytes(len(tx_bytes) if rx_len is None else rx_len)
+
+    async def transact_many(self, requests):
+        """
+        Run several commands and return their responses in order, requests are (tx_bytes, rx_len)
+        pairs as for transact().  Stop-and-wait, each command is written once the previous one answered.
+        """
+        return [await self.transact(tx_bytes, rx_len) for tx_bytes, rx_len in requests]
+
+    async def read_n_bytes(self, n, timeout=1):
+        await self._wait_for(n, timeout)
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    async def read_n_bytes_into(self, buf, timeout=1):
+        view = memoryview(buf)
+        n = len(view)
+        await self._wait_for(n, timeout)
+        view[:] = self.rx[:n]
+        del self.rx[:n]
+        return buf
+
+    def _on_readable(self):
+        try:
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+        except OSError as ex:
+            # Port went away, stop watching it and fail the pending read
+            self.close()
+            self.error = ex
+            self._received.set()
+            return
+        if chunk:
+            self.rx_bytes += len(chunk)
+            self._feed(chunk)
+            self.capture_lines()
+            self._received.set()
+
+    def _feed(self, chunk):
+        self.rx.extend(chunk)
+
+    def _timed_out(self, n, attempt):
+        raise TimeoutError(f"Expected {n} bytes, received {len(self.rx)}")
+
+    async def _wait_for(self, n, timeout):
+        # The timeout restarts whenever more of the response arrives
+        attempt = 0
+        deadline = self._loop.time() + timeout
+        while len(self.rx) < n:
+            if self.error is not None:
+                raise self.error
+            received = len(self.rx)
+            self._received.clear()
+            try:
+                await asyncio.wait_for(self._received.wait(), max(0, deadline - self._loop.time()))
+            except asyncio.TimeoutError:
+                self._timed_out(n, attempt)
+                attempt += 1
+                deadline = self._loop.time() + timeout
+            if len(self.rx) > received:
+                deadline = self._loop.time() + timeout
+
+
+class _Request:
+    def __init__(self, frame):
+        self.frame = frame
+        self.next_part = 0
+        self.data = bytearray()
+        self.done = False
+
+
+class FramedLink(EchoLink):
+    """
+    Length-prefixed, CRC checked frames with sequence numbers, carrying the same byte stream
+    as EchoLink.
+
+    Each write is sent as a frame and the device answers it with frames carrying the same
+    sequence number and an incrementing part number, the last one without FRAME_MORE.
+    Up to window writes may be in flight at once and their responses are delivered in write
+    order.  Commands still hold the link one at a time (see command), transact_many() is how a
+    command pipelines its requests.  Corrupt frames are dropped and decoding resumes at the next start byte.  A request whose
+    response stalls or has a gap is retransmitted, the device replays its cached response
+    and parts already received are skipped.
+    """
+    def __init__(self, ser, retries=2, max_payload=4096, window=8):
+        super().__init__(ser)
+        self.retries = retries
+        self.max_payload = max_payload
+        self.window = window  # most requests in flight, a request stays in flight until its last part
+        self.decoder = FrameDecoder(max_payload)
+        self.seq = 0
+        self.in_flight: OrderedDict[int, _Request] = OrderedDict()
+
+    def write(self, data):
+        for i in range(0, max(len(data), 1), self.max_payload):
+            if len(self.in_flight) >= self.window:
+                raise Exception('%d requests already in flight on %s' % (self.window, self.ser.port))
+            frame = encode_frame(self.seq, 0, data[i:i + self.max_payload])
+            self.in_flight[self.seq] = _Request(frame)
+            self.seq = (self.seq + 1) & 0xFF
+            self._send(frame)
+
+    def flush_rx(self):
+        super().flush_rx()
+        self.decoder.reset()
+        self.in_flight.clear()
+
+    async def transact_many(self, requests):
+        """As EchoLink.transact_many(), with later requests written while earlier responses are pending"""
+        responses = []
+        sent = 0
+        for tx_bytes, rx_len in requests:
+            # A request leaves in_flight on its last part, which the device sends once it reads the next request
+            while sent < len(requests) and (sent == len(responses) or len(self.in_flight) < self.window):
+                self.write(requests[sent][0])
+                sent += 1
+            responses.append(await self.read_n_bytes(len(tx_bytes) if rx_len is None else rx_len))
+        return responses
+
+    def read_all(self):
+        """Return and clear bytes received outside of frames"""
+        data = bytes(self.decoder.unframed)
+        self.decoder.unframed.clear()
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.decoder.unframed)
+
+    def _feed(self, chunk):
+        self._receive(self.decoder.feed(chunk))
+
+    def _timed_out(self, n, attempt):
+        if not self.in_flight or attempt >= self.retries:
+            # Give up on the pending requests, late parts for them are ignored
+            self.in_flight.clear()
+            super()._timed_out(n, attempt)
+        self._receive(self.decoder.resync())
+        self._retransmit()
+
+    def _receive(self, frames):
+        gap = False
+        for flags, seq, part, payload in frames:
+            request = self.in_flight.get(seq)
+            if request is None or request.done or part < request.next_part:
+                continue  # replayed part already received
+            if part > request.next_part:
+                gap = True
+                continue
+
+            request.next_part += 1
+            request.data.extend(payload)
+            request.done = not (flags & FRAME_MORE)
+        self._deliver()
+
+        if gap:
+            self._retransmit()
+
+    def _deliver(self):
+        # Only the oldest request streams into rx so responses stay in write order
+        while self.in_flight:
+            seq, request = next(iter(self.in_flight.items()))
+            self.rx.extend(request.data)
+            request.data.clear()
+            if not request.done:
+                break
+            del self.in_flight[seq]
+
+    def _retransmit(self):
+        for seq, request in self.in_flight.items():
+            if not request.done:
+                logger.debug('Retransmitting frame seq %d from part %d', seq, request.next_part)
+                self.retransmits += 1
+                self._send(request.frame)
+
+
+class FramedDeviceLink:
+    """
+    Device side of FramedLink, used by the reference firmware implementations.
+
+    Wraps raw read/write callables, read_raw() returns whatever bytes are available and
+    blocks until there are some.  read() feeds the command parser from received frame
+    payloads, write() sends output as FRAME_MORE parts of the current request and the
+    request is closed with an empty final part once the parser waits for more input.
+    Requests seen again are answered by replaying their cached response.
+    """
+    def __init__(self, read_raw, write_raw, max_payload=4096, cache_size=32):
+        self.read_raw = read_raw
+        self.write_raw = write_raw
+        self.max_payload = max_payload
+        self.cache_size = cache_size
+        self.decoder = FrameDecoder(max_payload)
+        self.frames = []
+        self.input = bytearray()
+        self.seq = None
+        self.responses: OrderedDict[int, list[bytes]] = OrderedDict()
+
+    def read(self, n):
+        while len(self.input) < n:
+            self._finish()
+            flags, seq, part, payload = self._next_frame()
+            if seq in self.responses:
+                for frame in self.responses[seq]:
+                    self.write_raw(frame)
+                continue
+
+            self.seq = seq
+            self.responses[seq] = []
+            while len(self.responses) > self.cache_size:
+                self.responses.popitem(last=False)
+            self.input.extend(payload)
+
+        data = bytes(self.input[:n])
+        del self.input[:n]
+        return data
+
+    def write(self, data):
+        for i in range(0, len(data), self.max_payload):
+            self._send(data[i:i + self.max_payload], FRAME_MORE)
+
+    def _send(self, payload, flags):
+        frames = self.responses[self.seq]
+        frame = encode_frame(self.seq, len(frames), payload, flags)
+        frames.append(frame)
+        self.write_raw(frame)
+
+    def _finish(self):
+        if self.seq is not None:
+            self._send(b'', 0)
+            self.seq = None
+
+    def _next_frame(self):
+        while not self.frames:
+            self.frames.extend(self.decoder.feed(self.read_raw()))
+        return self.frames.pop(0)
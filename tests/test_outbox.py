@@ -0,0 +1,84 @@
+""" SyncWorker.sync_once against a DirectoryTarget and a failing target """
+
+import pytest
+
+from src.outbox import ReportOutbox, DirectoryTarget, SyncWorker
+
+
+class FailingTarget:
+    """Upload target that is down until up is set, like a station offline"""
+    def __init__(self, target):
+        self.target = target
+        self.up = False
+        self.batches = []
+
+    def upload(self, batch):
+        self.batches.append(batch)
+        if not self.up:
+            raise Exception('remote unreachable')
+        self.target.upload(batch)
+
+
+def entries(outbox):
+    return outbox.db.execute('SELECT attempts, next_try, done IS NOT NULL, error FROM outbox ORDER BY id').fetchall()
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = ReportOutbox(tmp_path / 'outbox.sqlite')
+    yield outbox
+    outbox.close()
+
+
+def add_reports(outbox, root, names):
+    paths = []
+    for name in names:
+        path = root / 'reports' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+        outbox.add(path, 'ATS000/' + name)
+        paths.append(path)
+    return paths
+
+
+def test_directory_target(outbox, tmp_path):
+    add_reports(outbox, tmp_path, ['a.csv', 'b.csv', 'c.csv'])
+    worker = SyncWorker(outbox, DirectoryTarget(tmp_path / 'remote'), batch_size=2)
+    assert worker.sync_once() == (3, 0)
+    for name in ['a.csv', 'b.csv', 'c.csv']:
+        assert (tmp_path / 'remote' / 'ATS000' / name).read_text() == name
+    assert outbox.count_pending() == 0
+    assert worker.sync_once() == (0, 0)
+
+
+def test_failing_target_backs_off(outbox, tmp_path):
+    add_reports(outbox, tmp_path, ['a.csv', 'b.csv'])
+    target = FailingTarget(DirectoryTarget(tmp_path / 'remote'))
+    worker = SyncWorker(outbox, target, backoff=5.0, max_backoff=12.0)
+    assert worker.sync_once(now=100) == (0, 2)
+    assert entries(outbox) == [(1, 105.0, 0, 'remote unreachable')] * 2
+    # Nothing is due until the backoff has passed
+    assert worker.sync_once(now=104) == (0, 0)
+    assert len(target.batches) == 1
+    assert worker.sync_once(now=105) == (0, 2)
+    assert entries(outbox) == [(2, 115.0, 0, 'remote unreachable')] * 2
+    assert worker.sync_once(now=115) == (0, 2)
+    assert entries(outbox)[0][:2] == (3, 127.0)  # capped at max_backoff
+    target.up = True
+    assert worker.sync_once(now=127) == (2, 0)
+    assert [row[2] for row in entries(outbox)] == [1, 1]
+
+
+def test_missing_report_fails_alone(outbox, tmp_path):
+    paths = add_reports(outbox, tmp_path, ['a.csv', 'b.csv', 'c.csv'])
+    paths[0].unlink()
+    worker = SyncWorker(outbox, DirectoryTarget(tmp_path / 'remote'), backoff=5.0)
+    assert worker.sync_once(now=100) == (2, 1)
+    assert entries(outbox)[0] == (1, 105.0, 0, 'missing or unreadable')
+    assert [row[2] for row in entries(outbox)[1:]] == [1, 1]
+    # Newer reports still go while the missing one backs off
+    add_reports(outbox, tmp_path, ['d.csv'])
+    assert worker.sync_once(now=101) == (1, 0)
+    assert (tmp_path / 'remote' / 'ATS000' / 'd.csv').exists()
+    assert worker.sync_once(now=105) == (0, 1)
+    assert entries(outbox)[0][:2] == (2, 115.0)
@@ -0,0 +1,49 @@
+""" Fixture.search_peak against the fixed MeasureResonance sweep on a synthetic series RLC resonance """
+
+import numpy as np
+import pytest
+
+pytest.importorskip('subinitial.automation')  # src.fixture needs the test framework
+from src.fixture import Fixture
+
+F_CENTER = 60.666e3
+F_DELTAS = np.linspace(-4e3, 4e3, 9)  # MeasureResonance fixed sweep
+snap = lambda f: 64e6 / np.round(64e6 / f)
+
+
+def resonance(f0, L=150e-6, R=3.0, vdrive=1.0):
+    """|I| of a series RLC resonating at f0"""
+    C = 1 / ((2 * np.pi * f0) ** 2 * L)
+    def amp(f):
+        w = 2 * np.pi * np.asarray(f, dtype=float)
+        return vdrive / np.abs(R + 1j * (w * L - 1 / (w * C)))
+    return amp
+
+
+@pytest.fixture(scope='module')
+def fixture():
+    # search_peak and estimate_peak only need the methods, not the drivers
+    return Fixture.__new__(Fixture)
+
+
+@pytest.mark.parametrize('offset', [-2600, -1300, 0, 240, 900, 2100])
+def test_search_agrees_with_fixed_sweep(fixture, offset):
+    f_true = F_CENTER + offset
+    amp = resonance(f_true)
+    batches = []
+    def measure(freqs):
+        batches.append(len(freqs))
+        return list(amp(freqs))
+
+    fs = F_CENTER + F_DELTAS
+    f_fixed = fixture.estimate_peak(fs, amp(fs))[0]
+    fs, amps = fixture.search_peak(measure, F_CENTER, 4e3, 1e3, 500.0, 100.0, 9, snap)
+    f_search = fixture.estimate_peak(fs, amps)[0]
+
+    assert np.all(np.diff(fs) > 0)
+    assert len(fs) == sum(batches) < len(F_DELTAS)
+    assert abs(f_search - f_fixed) < 100.0
+    assert abs(f_search - f_true) <= abs(f_fixed - f_true) + 25.0
+    if abs(offset) > 1000:
+        # The peak is off the first grid, its walk batch carries two points for the DSP pool
+        assert batches[1] == 2
@@ -0,0 +1,165 @@
+""" Stm32Bootloader against MockStm32Bootloader over a pseudo-terminal, flashing the config.csv Firmware images """
+
+import os
+import tty
+
+import pytest
+
+from src.configtables import ROOT, read_config_table
+from src.firmware import FirmwareRegistry
+from src.mockstm32boot import MockStm32Bootloader
+from src.stm32bootloader import (Stm32Bootloader, CMD_GET, CMD_GET_ID, CMD_READ_MEMORY, CMD_GO, CMD_WRITE_MEMORY,
+                                 CMD_EXTENDED_ERASE, FLASH_BASE, MASS_ERASE, ACK)
+
+
+def expected_flash(images, size):
+    flash = bytearray(b'\xFF' * size)
+    for fw in images:
+        offset = fw.address - FLASH_BASE
+        flash[offset:offset + len(fw.data)] = fw.data
+    return flash
+
+
+class SilentEraseBootloader(MockStm32Bootloader):
+    """Takes the erase command and its pages but never acknowledges them, like a hung flash erase"""
+    def _handle(self, cmd):
+        if cmd != CMD_EXTENDED_ERASE:
+            return super()._handle(cmd)
+        self._write([ACK])
+        self._read(3)
+
+
+@pytest.fixture(scope='module')
+def registry():
+    # Same loading as src.fixture.load_firmware_table, which needs the test framework
+    return FirmwareRegistry().load_table(read_config_table('Firmware'), ROOT)
+
+
+@pytest.fixture(scope='module')
+def images(registry):
+    return [registry['bootchecker'], registry['main']]
+
+
+@pytest.fixture
+def mock():
+    mock = MockStm32Bootloader().start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def boot(mock):
+    boot = Stm32Bootloader(mock.port, 115200, timeout=0.2, sync_timeout=0.5)
+    boot.connect()
+    yield boot
+    boot.disconnect()
+
+
+@pytest.fixture
+def programmed(mock, boot, images):
+    boot.mass_erase()
+    boot.program_firmware(images)
+    mock.writes.clear()
+    mock.erases.clear()
+    return mock
+
+
+def test_registry(registry):
+    assert 'main' in registry and 'bootchecker' in registry
+    assert registry['main'].address == 0x08000800
+    with pytest.raises(Exception, match='Unknown firmware image app, expected one of: bootchecker, main'):
+        registry['app']
+
+
+def test_registry_rejects_sha256_mismatch(registry, tmp_path):
+    path = tmp_path / 'main.bin'
+    path.write_bytes(registry['main'].data[:-1] + bytes([registry['main'].data[-1] ^ 0xFF]))
+    with pytest.raises(Exception, match='has SHA-256 [0-9a-f]{64}, expected %s' % registry['main'].sha256):
+        FirmwareRegistry().load('main', path, 0x08000800, registry['main'].sha256)
+    # Matching is case insensitive, like hashes pasted into config.csv
+    assert FirmwareRegistry().load('main', registry['main'].path, 0x08000800, registry['main'].sha256.upper())
+
+
+def test_sync_get_get_id(mock, boot):
+    assert mock.synced
+    assert boot.version == 0x31
+    assert boot.commands == [CMD_GET, 0x01, CMD_GET_ID, CMD_READ_MEMORY, CMD_GO, CMD_WRITE_MEMORY, CMD_EXTENDED_ERASE]
+    assert boot.get_id() == 0x466
+    # A second sync in the same session is answered with NACK, which still counts as alive
+    boot.sync(0.5)
+
+
+def test_program_firmware(mock, boot, images):
+    mock.flash[:] = os.urandom(len(mock.flash))
+    boot.mass_erase()
+    assert mock.erases == [MASS_ERASE]
+    boot.program_firmware(images)
+    assert mock.flash == expected_flash(images, len(mock.flash))
+    for fw in images:
+        assert boot.read_memory(fw.address, len(fw.data)) == fw.data
+
+
+def test_vector_word_written_last(mock, boot, images):
+    boot.mass_erase()
+    boot.program_firmware(images)
+    assert mock.writes[-1] == (FLASH_BASE, 8)
+    assert all(addr >= FLASH_BASE + 8 for addr, n in mock.writes[:-1])
+
+
+def test_program_diff_noop(programmed, boot, images):
+    assert boot.program_firmware(images, diff=True) == []
+    assert programmed.writes == []
+    assert programmed.erases == []
+
+
+@pytest.mark.parametrize('page', [0, 5])
+def test_program_diff_repairs_one_page(programmed, boot, images, page):
+    expected = expected_flash(images, len(programmed.flash))
+    programmed.flash[page * 2048 + 100] ^= 0x5A
+    assert boot.program_firmware(images, diff=True) == [page]
+    assert programmed.erases == [[page]]
+    assert all(page * 2048 <= addr - FLASH_BASE < (page + 1) * 2048 for addr, n in programmed.writes)
+    if page == 0:
+        assert programmed.writes[-1] == (FLASH_BASE, 8)
+    assert programmed.flash == expected
+
+
+def test_write_to_programmed_flash_is_rejected(programmed, boot):
+    with pytest.raises(Exception, match='rejected write at 0x08000800'):
+        boot.write_memory(FLASH_BASE + 0x800, b'\x00' * 8)
+
+
+def test_address_outside_flash_is_rejected(boot):
+    with pytest.raises(Exception, match='rejected address 0x20000000'):
+        boot.read_memory(0x20000000, 4)
+
+
+def test_verify_failure(programmed, boot, images):
+    programmed.flash[0x900] ^= 0xFF
+    assert not boot.verify(FLASH_BASE + 0x900, images[1].data[0x100:0x108])
+
+
+def test_erase_timeout():
+    mock = SilentEraseBootloader().start()
+    boot = Stm32Bootloader(mock.port, 115200, timeout=0.2, sync_timeout=0.5)
+    try:
+        boot.connect()
+        with pytest.raises(TimeoutError, match='did not acknowledge mass erase'):
+            boot.mass_erase(timeout=0.3)
+    finally:
+        boot.disconnect()
+        mock.stop()
+
+
+def test_sync_timeout():
+    # Nothing serves the other end of this pseudo-terminal
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    boot = Stm32Bootloader(os.ttyname(slave), 115200, timeout=0.1, sync_timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError, match='No response from bootloader'):
+            boot.connect()
+    finally:
+        boot.ser.close()
+        os.close(master)
+        os.close(slave)
@@ -0,0 +1,71 @@
+""" Stm32CoProcessor.measure_sweep against MockStm32CoProcessor over a pseudo-terminal, on both links """
+
+import numpy as np
+import pytest
+
+from src.mockstm32 import MockStm32CoProcessor
+from src.stm32coprocessor import Stm32CoProcessor, ADC_HS_CHANNELS, ADC_HS_SCALE
+
+FS = np.array([60e3, 65e3, 70e3, 75e3, 80e3])
+PERS = np.round(64e6 / FS).astype(int)
+CCRS = PERS // 2
+FTS = 64e6 / PERS
+
+
+class RecordingMock(MockStm32CoProcessor):
+    """Mock coprocessor remembering the PWM of every capture"""
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.pwms = []
+
+    def default_capture(self, per, ccr):
+        self.pwms.append((per, ccr))
+        return super().default_capture(per, ccr)
+
+
+@pytest.fixture(params=[False, True], ids=['echo', 'framed'])
+def mock(request):
+    mock = RecordingMock(framed=request.param).start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def stm(mock):
+    stm = Stm32CoProcessor(mock.port, 2000000, framed=mock.framed)
+    stm.connect()
+    yield stm
+    stm.disconnect()
+
+
+def test_sweep_raw(mock, stm):
+    captures = [np.array(c) for c in stm.measure_sweep(PERS, CCRS, FTS)]
+    assert mock.pwms == list(zip(PERS, CCRS))
+    assert mock.pwm is None
+    assert len(captures) == len(FS)
+    for capture, ft in zip(captures, FTS):
+        assert capture.shape == (ADC_HS_CHANNELS, mock.samples)
+        # The default capture model's tone is at the point's PWM frequency
+        iout = capture[0] * ADC_HS_SCALE
+        spectrum = abs(np.fft.rfft(iout - iout.mean()))
+        f_peak = np.argmax(spectrum) * mock.samplerate / mock.samples
+        assert f_peak == pytest.approx(ft, abs=mock.samplerate / mock.samples)
+
+
+def test_sweep_reduced(mock, stm):
+    results = list(stm.measure_sweep(PERS, CCRS, FTS, reduce=True))
+    assert len(results) == len(FS)
+    for dft, rms, isense in results:
+        # 0.3 A RMS tone on Iout and Isense, plus 2 mV of noise
+        assert dft == pytest.approx(0.3, rel=0.01)
+        assert rms == pytest.approx(0.3, rel=0.01)
+        assert isense == pytest.approx(0.3, rel=0.01)
+
+
+def test_sweep_abandoned_keeps_link_in_step(mock, stm):
+    sweep = stm.measure_sweep(PERS, CCRS, FTS, reduce=True)
+    assert len(next(sweep)) == 3
+    sweep.close()
+    assert len(mock.pwms) == len(FS)
+    assert stm.set_vdut(5.0) == pytest.approx(5.0)
+    assert len(list(stm.measure_sweep(PERS[:2], CCRS[:2], FTS[:2]))) == 2
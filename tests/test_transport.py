@@ -0,0 +1,152 @@
+""" FrameDecoder, and FramedLink against the FramedDeviceLink of MockStm32CoProcessor over a pseudo-terminal with injected faults """
+
+import numpy as np
+import pytest
+
+from src.mockstm32 import MockStm32CoProcessor
+from src.stm32coprocessor import Stm32CoProcessor
+from src.transport import FrameDecoder, FramedLink, encode_frame, FRAME_HEADER, FRAME_CRC, FRAME_MORE
+
+
+class FaultyMock(MockStm32CoProcessor):
+    """Framed mock coprocessor applying the queued faults to its next response frames that carry data"""
+    def __init__(self, **kw):
+        super().__init__(framed=True, **kw)
+        self.faults = []  # 'drop', 'corrupt' or 'noise' per data frame, None to pass one through
+        self.mute = False  # drop every frame
+
+    def _write_raw(self, data):
+        data = bytes(data)
+        if self.mute:
+            return
+        if len(data) > FRAME_HEADER.size + FRAME_CRC.size and self.faults:
+            fault = self.faults.pop(0)
+            if fault == 'drop':
+                return
+            if fault == 'corrupt':
+                data = data[:-1] + bytes([data[-1] ^ 0xFF])
+            elif fault == 'noise':
+                # A false start byte with a huge length, then line noise
+                data = b'\xA5\x00\x07\x00\x00\xFF\xFFnoise' + data
+        super()._write_raw(data)
+
+
+@pytest.fixture
+def mock():
+    mock = FaultyMock().start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def stm(mock):
+    stm = Stm32CoProcessor(mock.port, 2000000, framed=True)
+    stm.connect()
+    assert isinstance(stm.link, FramedLink)
+    yield stm
+    stm.disconnect()
+
+
+def test_decoder_frames_and_unframed_text():
+    decoder = FrameDecoder()
+    data = b'log\n' + encode_frame(1, 0, b'abc', FRAME_MORE) + b'more' + encode_frame(1, 1, b'')
+    # Byte at a time, frames only come out once complete
+    frames = [frame for b in data for frame in decoder.feed(bytes([b]))]
+    assert frames == [(FRAME_MORE, 1, 0, b'abc'), (0, 1, 1, b'')]
+    assert bytes(decoder.unframed) == b'log\nmore'
+    assert decoder.crc_errors == 0
+
+
+def test_decoder_drops_corrupt_crc_and_resyncs():
+    decoder = FrameDecoder()
+    bad = bytearray(encode_frame(2, 0, b'payload'))
+    bad[FRAME_HEADER.size] ^= 0x01
+    frames = decoder.feed(bytes(bad) + encode_frame(3, 0, b'next'))
+    assert frames == [(0, 3, 0, b'next')]
+    assert decoder.crc_errors == 1
+
+
+def test_decoder_corrupt_length():
+    decoder = FrameDecoder(max_payload=64)
+    frames = decoder.feed(b'\xA5\x00\x01\x00\x00\xFF\x7F' + encode_frame(4, 0, b'ok'))
+    assert frames == [(0, 4, 0, b'ok')]
+    assert decoder.crc_errors == 1
+
+
+def test_decoder_resync_after_stalled_frame():
+    decoder = FrameDecoder()
+    # The length claims more bytes than will ever arrive, the good frame is stuck behind it
+    frames = decoder.feed(b'\xA5\x00\x01\x00\x00\x40\x00' + encode_frame(5, 0, b'ok'))
+    assert frames == []
+    assert decoder.resync() == [(0, 5, 0, b'ok')]
+
+
+def test_round_trip(mock, stm):
+    assert stm.set_vdut(5.0) == pytest.approx(5.0)
+    assert stm.measure_vdut() == pytest.approx(5.0)
+    snap = stm.measure_snapshot()
+    assert snap.vdut == pytest.approx(5.0)
+    assert len(snap.adc_ls) == 4
+    assert stm.link.retransmits == 0
+
+
+def test_corrupt_response_is_retransmitted(mock, stm):
+    mock.faults = ['corrupt']
+    assert stm.set_vdut(3.0) == pytest.approx(3.0)
+    assert stm.link.decoder.crc_errors >= 1
+    assert stm.link.retransmits >= 1
+
+
+def test_dropped_response_is_retransmitted(mock, stm):
+    # The empty last part shows the gap, the request is retransmitted without waiting for a timeout
+    mock.faults = ['drop']
+    assert stm.measure_vdut() == pytest.approx(0.0)
+    assert stm.link.retransmits >= 1
+
+
+def test_stalled_response_is_retransmitted(mock, stm):
+    stm.set_vdut(2.0)
+    mock.mute = True
+    stm.loop.post(lambda: stm.loop.loop.call_later(0.5, setattr, mock, 'mute', False))
+    assert stm.measure_vdut() == pytest.approx(2.0)
+    assert stm.link.retransmits >= 1
+
+
+def test_dropped_part_of_multi_frame_response(mock, stm):
+    stm.set_vdut(5.0)
+    # Echo frame, then four capture frames, lose the second one
+    mock.faults = [None, None, 'drop']
+    capture = np.array(stm.measure_adc_hs(raw=True))
+    assert capture.shape == (4, mock.samples)
+    assert stm.link.retransmits >= 1
+    # Same length again, without faults, and the link is still in step
+    assert np.array(stm.measure_adc_hs(raw=True)).shape == (4, mock.samples)
+    assert stm.measure_vdut() == pytest.approx(5.0)
+
+
+def test_noise_before_frame(mock, stm):
+    mock.faults = ['noise']
+    assert stm.set_vdut(4.0) == pytest.approx(4.0)
+    assert stm.link.decoder.crc_errors >= 1
+
+
+def test_retries_exhausted(mock, stm):
+    mock.mute = True
+    with pytest.raises(TimeoutError):
+        stm.measure_vdut()
+    assert not stm.link.in_flight
+    mock.mute = False
+    assert stm.set_vdut(1.0) == pytest.approx(1.0)
+
+
+def test_pipelined_requests_stay_in_window(mock, stm):
+    link = stm.link
+    link.window = 3
+    peak = []
+    write = link.write
+    link.write = lambda data: (write(data), peak.append(len(link.in_flight)))
+    requests = [(b'\x02\x00\x00\x00\x00\x00\x00\x00', None)] * 20
+    responses = stm.loop.run(link.transact_many(requests))
+    assert len(responses) == 20 and all(r[:4] == b'\x02\x00\x00\x00' and len(r) == 8 for r in responses)
+    assert max(peak) == 3
+    assert link.retransmits == 0